@@ -1,8 +1,7 @@
+import argparse
 import os
 import csv
-import requests
 import tarfile
-import shutil
 from pathlib import Path
 import time
 
@@ -35,6 +34,7 @@ def download_paper_src(reference, download_dir):
     
     print(f"Downloading {reference} from {url}...")
     try:
+        import requests # Imported on first download, so reading references.csv stays fast
         response = requests.get(url, stream=True)
         
         if response.status_code == 200:
@@ -61,6 +61,7 @@ def download_paper_pdf(reference, download_dir):
     
     print(f"Downloading {reference} from {url}...")
     try:
+        import requests # Imported on first download, so reading references.csv stays fast
         response = requests.get(url, stream=True)
         
         if response.status_code == 200:
@@ -93,6 +94,8 @@ def extract_archive(archive_path, extract_dir):
         return False
 
 def main():
+    argparse.ArgumentParser(description="Download and extract the arXiv sources listed in references.csv").parse_args()
+    
     # Define paths
     base_dir = Path(__file__).parent
     references_file = base_dir / "references.csv"
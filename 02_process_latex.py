@@ -1,23 +1,28 @@
 #!/usr/bin/env python
+import argparse
 import os
 import re
 import glob
 import json
 from pathlib import Path
-import bibtexparser
-from bibtexparser.bparser import BibTexParser
-from bibtexparser.customization import convert_to_unicode
-import regex
-from pylatexenc.latex2text import LatexNodes2Text
-import pdfplumber
+from latex_normalize import normalize_latex
+# bibtexparser, pylatexenc and pdfplumber are imported on first use: they dominate the start-up time
+
+def latex_to_text(content):
+    """Convert LaTeX to plain text with pylatexenc."""
+    from pylatexenc.latex2text import LatexNodes2Text
+    return LatexNodes2Text().latex_to_text(content)
 
 class LatexProcessor:
     """Process LaTeX files for LLM training."""
     
-    def __init__(self, source_dir, output_dir):
-        """Initialize the LaTeX processor."""
+    def __init__(self, source_dir, output_dir, store=None, normalize=False):
+        """Initialize the LaTeX processor (``store``: an optional CorpusStore written instead of output_dir;
+        ``normalize``: expand user macros and canonicalize math first, see latex_normalize.py)."""
         self.source_dir = Path(source_dir)
         self.output_dir = Path(output_dir)
+        self.store = store
+        self.normalize = normalize
         self.citations = {}
         self.figures = {}
         self.tables = {}
@@ -64,6 +69,10 @@ class LatexProcessor:
         bib_files = list(reference_dir.glob("*.bib"))
         
         all_entries = {}
+        if bib_files:
+            import bibtexparser
+            from bibtexparser.bparser import BibTexParser
+            from bibtexparser.customization import convert_to_unicode
         
         for bib_file in bib_files:
             try:
@@ -122,7 +131,7 @@ class LatexProcessor:
                 caption = caption_match.group(1)
                 # Clean the caption
                 caption = re.sub(r'\\label{.*?}', '', caption)
-                caption = LatexNodes2Text().latex_to_text(caption)
+                caption = latex_to_text(caption)
                 figures.append({
                     'id': f"fig{i+1}",
                     'caption': caption.strip()
@@ -146,7 +155,7 @@ class LatexProcessor:
                 caption = caption_match.group(1)
                 # Clean the caption
                 caption = re.sub(r'\\label{.*?}', '', caption)
-                caption = LatexNodes2Text().latex_to_text(caption)
+                caption = latex_to_text(caption)
                 tables.append({
                     'id': f"tab{i+1}",
                     'caption': caption.strip()
@@ -169,7 +178,7 @@ class LatexProcessor:
             for match in matches:
                 title = match.group(1)
                 # Clean the title
-                title = LatexNodes2Text().latex_to_text(title)
+                title = latex_to_text(title)
                 sections.append({
                     'level': level,
                     'title': title.strip()
@@ -289,8 +298,7 @@ class LatexProcessor:
         content = re.sub(r'\\ref{(tab[^}]*)}', replace_table_ref, content)
 
         # Use pylatexenc for converting the rest of LaTeX to text
-        converter = LatexNodes2Text()
-        content = converter.latex_to_text(content)
+        content = latex_to_text(content)
 
         # Restore the math blocks
         for i, block in enumerate(math_blocks):
@@ -310,19 +318,19 @@ class LatexProcessor:
         # Replace multiple blank lines with a single blank line
         return re.sub(r'\n\s*\n\s*\n+', '\n\n', content)
 
-    def process_file_src(self, reference):
-        """Process a single LaTeX paper."""
+    def convert_file_src(self, reference):
+        """Convert a single LaTeX paper; returns ``(markdown, metadata)`` or None."""
         reference_dir = self.source_dir / reference
         
         if not reference_dir.exists():
             print(f"Directory not found: {reference_dir}")
-            return False
+            return None
         
         # Find main tex file
         main_tex_file = self.find_main_tex_file(reference_dir)
         if not main_tex_file:
             print(f"No .tex file found in {reference_dir}")
-            return False
+            return None
         
         print(f"Processing {reference}: {main_tex_file}")
         
@@ -330,6 +338,12 @@ class LatexProcessor:
         with open(main_tex_file, 'r', encoding='utf-8', errors='ignore') as f:
             content = f.read()
         
+        # Expand user macros and canonicalize math so it tokenizes more compactly
+        if self.normalize:
+            content, stats = normalize_latex(content)
+            print(f"Normalized {reference}: {stats['macro_expansions']} uses of {stats['macros']} macros expanded, "
+                  f"{stats['math_segments']} math segments, {stats['chars_before']} -> {stats['chars_after']} chars")
+        
         # Extract citation keys
         citation_keys = self.extract_citations(content)
         
@@ -363,6 +377,28 @@ class LatexProcessor:
         # Remove multiple blank lines
         final_content = self.remove_multiple_blank_lines(unindented_content)
         
+        # Metadata (structure, figures, tables, citations)
+        metadata = {
+            'structure': self.section_structure,
+            'figures': self.figures,
+            'tables': self.tables,
+            'citations': self.citations
+        }
+        return final_content, metadata
+
+    def process_file_src(self, reference):
+        """Process a single LaTeX paper."""
+        converted = self.convert_file_src(reference)
+        if converted is None:
+            return False
+        final_content, metadata = converted
+        
+        if self.store is not None:
+            # Buffered and written in bulk; process_all flushes the last batch
+            self.store.add(reference, final_content, metadata)
+            print(f"Processed {reference}: Output queued for {self.store.path}")
+            return True
+        
         # Create output directory
         output_dir = self.output_dir / reference
         os.makedirs(output_dir, exist_ok=True)
@@ -372,14 +408,6 @@ class LatexProcessor:
         with open(processed_file, 'w', encoding='utf-8') as f:
             f.write(final_content)
         
-        # Save metadata (structure, figures, tables, citations)
-        metadata = {
-            'structure': self.section_structure,
-            'figures': self.figures,
-            'tables': self.tables,
-            'citations': self.citations
-        }
-        
         metadata_file = output_dir / "metadata.json"
         with open(metadata_file, 'w', encoding='utf-8') as f:
             json.dump(metadata, f, indent=2, ensure_ascii=False)
@@ -388,6 +416,7 @@ class LatexProcessor:
         return True
 
     def process_file_pdf(self, reference):
+        import pdfplumber
         markdown_content = ""
         with pdfplumber.open(f"downloads/{reference}.pdf") as pdf:
             for page in pdf.pages:
@@ -430,6 +459,9 @@ class LatexProcessor:
                 print(f"Error processing {reference}: {str(e)}")
                 failed += 1
         
+        if self.store is not None:
+            self.store.flush()
+        
         print(f"\n--- Summary ---")
         print(f"Total papers: {total}")
         print(f"Successfully processed: {processed}")
@@ -438,21 +470,38 @@ class LatexProcessor:
         
 
 def main():
+    parser = argparse.ArgumentParser(description="Process the downloaded LaTeX sources into Markdown")
+    parser.add_argument("--store", help="Write papers to this corpus store (see corpus_store.py) instead of outputs/")
+    parser.add_argument("--normalize", action="store_true",
+                        help="Expand user macros and canonicalize math to shorten sequences (see latex_normalize.py)")
+    args = parser.parse_args()
+    
     # Define paths
     base_dir = Path(__file__).parent
     source_dir = base_dir / "sources"
     output_dir = base_dir / "outputs"
     
-    # Delete existing outputs directory if it exists
-    if os.path.exists(output_dir):
+    store = None
+    if args.store:
+        from corpus_store import CorpusStore
+        # Start from an empty store, as the directory layout starts from an empty outputs directory
+        for path in (args.store, f"{args.store}-wal", f"{args.store}-shm"):
+            if os.path.exists(path):
+                print(f"Removing existing corpus store file: {path}")
+                os.remove(path)
+        store = CorpusStore(args.store)
+    elif os.path.exists(output_dir):
+        # Delete existing outputs directory if it exists
         print(f"Removing existing outputs directory: {output_dir}")
         import shutil
         shutil.rmtree(output_dir)
     
     print("Starting LaTeX processing for LLM fine-tuning...")
     
-    processor = LatexProcessor(source_dir, output_dir)
+    processor = LatexProcessor(source_dir, output_dir, store=store, normalize=args.normalize)
     processor.process_all()
+    if store is not None:
+        store.close()
     
 
 if __name__ == "__main__":
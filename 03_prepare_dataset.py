@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import argparse
 import os
 import json
 import random
@@ -8,16 +9,25 @@ import re
 class DatasetPreparer:
     """Prepare processed papers for llama3 fine-tuning."""
     
-    def __init__(self, outputs_dir, dataset_dir):
-        """Initialize the dataset preparer."""
+    def __init__(self, outputs_dir, dataset_dir, store=None):
+        """Initialize the dataset preparer (``store``: an optional CorpusStore read instead of outputs_dir)."""
         self.outputs_dir = Path(outputs_dir)
         self.dataset_dir = Path(dataset_dir)
+        self.store = store
         self.papers = []
         
     def load_processed_papers(self):
-        """Load all processed papers from the outputs directory."""
+        """Load all processed papers from the corpus store or the outputs directory."""
         paper_count = 0
         
+        if self.store is not None:
+            # One sequential scan of a single file instead of two opens per paper
+            for paper in self.store.iter_papers():
+                self.papers.append(paper)
+                paper_count += 1
+            print(f"Loaded {paper_count} processed papers from {self.store.path}")
+            return paper_count
+        
         # Get all reference directories in the outputs folder
         for paper_dir in self.outputs_dir.iterdir():
             if paper_dir.is_dir():
@@ -309,13 +319,22 @@ class DatasetPreparer:
         return examples
 
 def main():
+    parser = argparse.ArgumentParser(description="Prepare the fine-tuning dataset from the processed papers")
+    parser.add_argument("--store", help="Read papers from this corpus store (see corpus_store.py) instead of outputs/")
+    args = parser.parse_args()
+    
     # Define paths
     base_dir = Path(__file__).parent
     outputs_dir = base_dir / "outputs"
     dataset_dir = base_dir / "dataset"
     
+    store = None
+    if args.store:
+        from corpus_store import CorpusStore
+        store = CorpusStore(args.store)
+    
     # Create dataset preparer
-    preparer = DatasetPreparer(outputs_dir, dataset_dir)
+    preparer = DatasetPreparer(outputs_dir, dataset_dir, store=store)
     
     # Create a simple dataset
     print("Preparing basic dataset for llama3 fine-tuning...")
@@ -1,126 +1,318 @@
+import argparse
+import os
 from pathlib import Path
-from datasets import load_dataset
-from unsloth import FastLanguageModel
-# import os
-# import json
-# import torch
-# from transformers import TrainingArguments
-# from trl import SFTConfig, SFTTrainer
+from dataset_cache import fingerprint_inputs, load_or_build
+# datasets, torch/transformers (via the callbacks, packing and the sampler), trl and unsloth are
+# imported inside the functions that use them, so importing this module for its settings stays fast
 
 MODEL_NAME = "unsloth/Meta-Llama-3.1-8B"
 # MODEL_NAME = "meta-llama/Llama-3.1-8B"
 DATASET_DIR = Path("dataset")
 TRAIN_FILE = DATASET_DIR / "train_enhanced.jsonl"
 VALIDATION_FILE = DATASET_DIR / "validation_enhanced.jsonl"
+DATASET_CACHE_DIR = DATASET_DIR / "cache" # Formatted + tokenized datasets keyed by content fingerprint
 
 max_seq_length = 2048 # Choose any! We auto support RoPE Scaling internally!
 dtype = None # None for auto detection. Float16 for Tesla T4, V100, Bfloat16 for Ampere+
 load_in_4bit = True
+packing = True # First-fit-decreasing packing of examples into max_seq_length rows (see packing.py)
+block_diagonal_mask = True # Explicit 4D mask for packed rows; Unsloth's patched attention is not known to honour position-id resets
+packing_check_tolerance = 0.05 # Max mean |logit| difference between packed and separate forward passes before training
+shuffle_window = 64 # Without packing: batches of similar length drawn from windows of this many batches (see length_sampler.py)
+eval_steps = 20 # Validation perplexity every N optimizer steps (see validation.py)
+eval_max_examples = 64 # Fixed random subsample of the validation set used at every evaluation
+eval_token_budget = 65536 # Cap on validation tokens per evaluation
+eval_batch_tokens = 16384 # Padded tokens per validation forward pass
+eval_time_budget = 120 # Seconds; an evaluation stops early and reports partial coverage after this
+telemetry_file = Path("outputs") / "telemetry.jsonl" # Per-step tokens, timings and memory (see telemetry.py)
+prometheus_textfile = None # e.g. "/var/lib/node_exporter/textfile/llm_fine_tuning.prom"
+checkpoint_dir = Path("lora_checkpoints") # LoRA-only checkpoints written in the background (see checkpointing.py)
+checkpoint_steps = 10 # Save adapter, optimizer and RNG state every N optimizer steps
+keep_checkpoints = 3 # Only the newest N checkpoints are kept
+resume = True # Resume from the newest checkpoint in checkpoint_dir if there is one
+dataset_num_proc = max(1, min(8, os.cpu_count() or 1)) # Processes used to format and tokenize the dataset
 
-model, tokenizer = FastLanguageModel.from_pretrained(
-    model_name = "unsloth/Meta-Llama-3.1-8B",
-    max_seq_length = max_seq_length,
-    dtype = dtype,
-    load_in_4bit = load_in_4bit,
-    # token = HF_TOKEN,
-)
-
-model = FastLanguageModel.get_peft_model(
-    model,
+# LoRA settings shared by Unsloth's get_peft_model and plain peft (benchmark_training.py)
+lora_config = dict(
     r = 16, # Choose any number > 0 ! Suggested 8, 16, 32, 64, 128
     target_modules = ["q_proj", "k_proj", "v_proj", "o_proj",
                       "gate_proj", "up_proj", "down_proj",],
     lora_alpha = 16,
     lora_dropout = 0, # Supports any, but = 0 is optimized
     bias = "none",    # Supports any, but = "none" is optimized
-    use_gradient_checkpointing = "unsloth", # True or "unsloth" for very long context
-    random_state = 3407,
-    use_rslora = False,  # We support rank stabilized LoRA
-    loftq_config = None, # And LoftQ
 )
 
+training_config = dict(
+    per_device_train_batch_size = 2,
+    gradient_accumulation_steps = 4,
+    warmup_steps = 5,
+    # num_train_epochs = 1, # Set this for 1 full training run.
+    max_steps = 60,
+    learning_rate = 2e-4,
+    logging_steps = 1,
+    optim = "adamw_8bit",
+    weight_decay = 0.01,
+    lr_scheduler_type = "linear",
+    seed = 3407,
+    output_dir = "outputs",
+    report_to = "none", # Use this for WandB etc
+    save_strategy = "no", # Full Trainer checkpoints stall training; AsyncAdapterCheckpointCallback saves instead
+)
 
-# Load dataset
-print("Loading dataset...")
-train_dataset = load_dataset("json", data_files=str(TRAIN_FILE), split="train")
-validation_dataset = load_dataset("json", data_files=str(VALIDATION_FILE), split="train")
+formatted_text = """<|system|>\nYou are an expert scientific assistant who helps explain complex mathematics and physics concepts from research papers.\n<|user|>\n{}\n<|assistant|>\n{}"""
 
-print(f"Train examples: {len(train_dataset)}")
-print(f"Validation examples: {len(validation_dataset)}")
 
-# Format dataset for training - making sure it works with our version of SFTTrainer
-EOS_TOKEN = tokenizer.eos_token # Must add EOS_TOKEN
-formatted_text = """<|system|>\nYou are an expert scientific assistant who helps explain complex mathematics and physics concepts from research papers.\n<|user|>\n{}\n<|assistant|>\n{}"""
-def formatting_prompts_func(examples):
-    prompts = examples["prompt"]
-    completions = examples["completion"]
-    
-    # Format for training directly with input/target separation instead of using dataset_text_field
-    # Using Llama 3.1 chat template formatting
-
-    texts = []
-    for prompt, completion in zip(prompts, completions):
-        # Must add EOS_TOKEN, otherwise your generation will go on forever!
-        text = formatted_text.format(prompt, completion) + EOS_TOKEN
-        texts.append(text)
-    return { "text" : texts, }
-
-print("Formatting training dataset...")
-train_dataset = train_dataset.map(formatting_prompts_func, batched=True)
-print("Formatting validation dataset...")
-validation_dataset = validation_dataset.map(formatting_prompts_func, batched=True)
-
-
-from trl import SFTConfig, SFTTrainer
-trainer = SFTTrainer(
-    model = model,
-    tokenizer = tokenizer,
-    train_dataset = train_dataset,
-    dataset_text_field = "text",
-    max_seq_length = max_seq_length,
-    packing = False, # Can make training 5x faster for short sequences.
-    args = SFTConfig(
-        dataset_num_proc=1,
-        per_device_train_batch_size = 2,
-        gradient_accumulation_steps = 4,
-        warmup_steps = 5,
-        # num_train_epochs = 1, # Set this for 1 full training run.
-        max_steps = 60,
-        learning_rate = 2e-4,
-        logging_steps = 1,
-        optim = "adamw_8bit",
-        weight_decay = 0.01,
-        lr_scheduler_type = "linear",
-        seed = 3407,
-        output_dir = "outputs",
-        report_to = "none", # Use this for WandB etc
-    ),
-)
+def load_model(model_name = MODEL_NAME):
+    """Load the 4-bit base model and tokenizer through Unsloth."""
+    from unsloth import FastLanguageModel
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        model_name = model_name,
+        max_seq_length = max_seq_length,
+        dtype = dtype,
+        load_in_4bit = load_in_4bit,
+        # token = HF_TOKEN,
+    )
+    return model, tokenizer
+
+
+def add_lora(model, **overrides):
+    """Wrap the base model with trainable LoRA adapters (``overrides`` update ``lora_config``)."""
+    from unsloth import FastLanguageModel
+    return FastLanguageModel.get_peft_model(
+        model,
+        **{**lora_config, **overrides},
+        use_gradient_checkpointing = "unsloth", # True or "unsloth" for very long context
+        random_state = 3407,
+        use_rslora = False,  # We support rank stabilized LoRA
+        loftq_config = None, # And LoftQ
+    )
+
+
+def remove_lora(model):
+    """Strip the LoRA layers and return the untouched base model, e.g. to attach a fresh adapter."""
+    return model.unload()
+
+
+def load_datasets(train_file = TRAIN_FILE, validation_file = VALIDATION_FILE):
+    """Load the train and validation JSONL files (``validation_file = None`` skips the validation split)."""
+    from datasets import load_dataset
+    print("Loading dataset...")
+    train_dataset = load_dataset("json", data_files=str(train_file), split="train")
+    print(f"Train examples: {len(train_dataset)}")
+    if validation_file is None:
+        return train_dataset, None
+
+    validation_dataset = load_dataset("json", data_files=str(validation_file), split="train")
+    print(f"Validation examples: {len(validation_dataset)}")
+    return train_dataset, validation_dataset
+
+
+def format_dataset(dataset, tokenizer, num_proc = dataset_num_proc):
+    """Add the chat-formatted ``text`` column used for training."""
+    EOS_TOKEN = tokenizer.eos_token # Must add EOS_TOKEN
+    def formatting_prompts_func(examples):
+        prompts = examples["prompt"]
+        completions = examples["completion"]
+
+        # Format for training directly with input/target separation instead of using dataset_text_field
+        # Using Llama 3.1 chat template formatting
+
+        texts = []
+        for prompt, completion in zip(prompts, completions):
+            # Must add EOS_TOKEN, otherwise your generation will go on forever!
+            text = formatted_text.format(prompt, completion) + EOS_TOKEN
+            texts.append(text)
+        return { "text" : texts, }
+
+    return dataset.map(formatting_prompts_func, batched=True, num_proc=num_proc)
+
+
+def make_data_collator(tokenizer, packing = packing, block_diagonal_mask = block_diagonal_mask, mask_dtype = None):
+    """Return the collator matching the rows built by ``prepare_train_dataset``.
 
-trainer_stats = trainer.train()
+    ``mask_dtype`` should be the model's compute dtype when the block-diagonal mask is used.
+    """
+    if packing:
+        import torch
+        from packing import PackedSequenceCollator
+        return PackedSequenceCollator(tokenizer.pad_token_id, block_diagonal_mask = block_diagonal_mask,
+                                      mask_dtype = mask_dtype or torch.float32)
+    from transformers import DataCollatorForLanguageModeling
+    return DataCollatorForLanguageModeling(tokenizer, mlm=False)
 
 
+def prepare_train_dataset(train_dataset, tokenizer, packing = packing, max_seq_length = max_seq_length,
+                          num_proc = dataset_num_proc):
+    """Tokenize the formatted training set and return ``(dataset, data_collator)``.
 
-FastLanguageModel.for_inference(model) # Enable native 2x faster inference
-inputs = tokenizer(
-[
-    formatted_text.format(
-        "Explain what a transmon is.", # prompt
-        "", # output - leave this blank for generation!
+    With packing, examples are packed into ``max_seq_length`` rows; otherwise
+    they are kept one per row and padded per batch by the collator.
+    """
+    from datasets import Dataset
+    from packing import pack_examples, packing_stats, print_packing_stats, tokenize_for_packing
+    def tokenize(examples):
+        input_ids = tokenize_for_packing(tokenizer, examples["text"])
+        return {"input_ids": [ids[:max_seq_length] for ids in input_ids]}
+
+    tokenized = train_dataset.map(tokenize, batched=True, num_proc=num_proc,
+                                  remove_columns=train_dataset.column_names)
+
+    if packing:
+        # Pack short section examples together with long full-paper ones instead of padding them.
+        # Position ids restart at every example boundary so examples never attend to each other.
+        print("Packing training dataset...")
+        input_ids = list(tokenized["input_ids"])
+        packed_rows = pack_examples(input_ids, max_seq_length)
+        print_packing_stats(packing_stats([len(ids) for ids in input_ids], packed_rows, max_seq_length,
+                                          batch_size=training_config["per_device_train_batch_size"]))
+        tokenized = Dataset.from_list(packed_rows)
+
+    return tokenized, make_data_collator(tokenizer, packing)
+
+
+def load_train_dataset(tokenizer, train_file = TRAIN_FILE, packing = packing, max_seq_length = max_seq_length,
+                       num_proc = dataset_num_proc, cache_dir = DATASET_CACHE_DIR, mask_dtype = None):
+    """Format, tokenize and pack the training set, reusing the on-disk result when inputs are unchanged.
+
+    The cache key covers the JSONL contents, the prompt template, the
+    tokenizer (vocab, merges, special tokens) and the packing settings.
+    """
+    fingerprint = fingerprint_inputs(
+        [train_file], formatted_text, tokenizer,
+        packing = packing, max_seq_length = max_seq_length,
+        batch_size = training_config["per_device_train_batch_size"],
+    )
+
+    def build():
+        from datasets import load_dataset
+        train_dataset = load_dataset("json", data_files=str(train_file), split="train")
+        print(f"Train examples: {len(train_dataset)}")
+        print("Formatting training dataset...")
+        train_dataset = format_dataset(train_dataset, tokenizer, num_proc)
+        train_dataset, _ = prepare_train_dataset(train_dataset, tokenizer, packing, max_seq_length, num_proc)
+        return train_dataset
+
+    train_dataset = load_or_build(cache_dir, fingerprint, build)
+    return train_dataset, make_data_collator(tokenizer, packing, mask_dtype = mask_dtype)
+
+
+def check_packed_attention(model, train_dataset, data_collator, num_rows = 2, tolerance = packing_check_tolerance):
+    """Fail before training if packed examples attend to each other in ``model``'s actual forward pass.
+
+    Compares the logits of the first packed rows holding several examples
+    with a separate forward pass per example, through the same (Unsloth
+    patched) model and collator used for training.
+    """
+    from packing import packed_logit_difference
+    rows = [row for row in train_dataset.select(range(min(len(train_dataset), 64))) if len(row["seq_lengths"]) > 1]
+    if not rows:
+        print("Packed attention check skipped: no row holds more than one example")
+        return
+    diff = packed_logit_difference(model, data_collator, rows[:num_rows])
+    print(f"Packed vs separate examples: mean |logit difference| {diff['mean_diff']:.2e}, max {diff['max_diff']:.2e}")
+    if diff["mean_diff"] > tolerance:
+        raise RuntimeError("Packed examples attend to each other with this model's attention; "
+                           "set block_diagonal_mask = True or packing = False")
+
+
+def build_validation_callback(validation_dataset, tokenizer):
+    """Build the periodic validation callback from the formatted validation set."""
+    from validation import FastValidationCallback, prepare_validation_examples, select_examples
+    examples = prepare_validation_examples(validation_dataset, tokenizer, max_seq_length)
+    examples = select_examples(examples, eval_max_examples, eval_token_budget, seed = training_config["seed"])
+    print(f"Validation subsample: {len(examples)} examples, {sum(len(e['input_ids']) for e in examples)} tokens")
+    return FastValidationCallback(
+        examples,
+        tokenizer.pad_token_id,
+        eval_steps = eval_steps,
+        max_batch_tokens = eval_batch_tokens,
+        time_budget = eval_time_budget,
     )
-], return_tensors = "pt").to("cuda")
 
-outputs = model.generate(**inputs, max_new_tokens = 64, use_cache = True)
-response = tokenizer.batch_decode(outputs)
-print("Generated response:", response)
-model.save_pretrained("lora_model")  # Local saving
-tokenizer.save_pretrained("lora_model")
+
+def build_trainer(model, tokenizer, train_dataset, data_collator, packing = packing, callbacks = None, **overrides):
+    """Build the SFTTrainer for an already tokenized training set."""
+    from trl import SFTConfig, SFTTrainer
+    from length_sampler import LengthGroupedTrainerMixin
+
+    class BucketedSFTTrainer(LengthGroupedTrainerMixin, SFTTrainer):
+        """SFTTrainer that batches examples of similar length to cut padding."""
+    BucketedSFTTrainer.shuffle_window = shuffle_window
+
+    if packing:
+        model.config.use_cache = False # Packed position ids are ignored when a KV cache is built
+
+    # Packed rows are already full, so length grouping only matters for unpacked training
+    trainer_class = SFTTrainer if packing else BucketedSFTTrainer
+    return trainer_class(
+        model = model,
+        tokenizer = tokenizer,
+        train_dataset = train_dataset,
+        max_seq_length = max_seq_length,
+        packing = False, # TRL's own packing concatenates examples without boundaries; we pack ourselves.
+        data_collator = data_collator,
+        dataset_kwargs = {"skip_prepare_dataset": True}, # Already tokenized by prepare_train_dataset
+        callbacks = callbacks,
+        args = SFTConfig(
+            dataset_num_proc=1,
+            remove_unused_columns = False, # Keep seq_lengths for the packed collator
+            **{**training_config, **overrides},
+        ),
+    )
+
+
+def sample_generation(model, tokenizer, prompt = "Explain what a transmon is."):
+    """Generate a short answer with the trained model as a sanity check."""
+    from unsloth import FastLanguageModel
+    FastLanguageModel.for_inference(model) # Enable native 2x faster inference
+    inputs = tokenizer(
+    [
+        formatted_text.format(
+            prompt, # prompt
+            "", # output - leave this blank for generation!
+        )
+    ], return_tensors = "pt").to(model.device)
+
+    outputs = model.generate(**inputs, max_new_tokens = 64, use_cache = True)
+    response = tokenizer.batch_decode(outputs)
+    print("Generated response:", response)
+    return response
 
 
+def main():
+    argparse.ArgumentParser(description="Fine-tune the LoRA adapter; settings are the constants at the top of this file").parse_args()
+    from datasets import load_dataset
+    from checkpointing import AsyncAdapterCheckpointCallback, latest_checkpoint
+    from telemetry import TelemetryCallback
 
+    model, tokenizer = load_model()
+    model = add_lora(model)
 
+    # Format and tokenize the dataset - making sure it works with our version of SFTTrainer
+    train_dataset, data_collator = load_train_dataset(tokenizer, mask_dtype = model.dtype)
+    if packing:
+        check_packed_attention(model, train_dataset, data_collator)
+    validation_dataset = load_dataset("json", data_files=str(VALIDATION_FILE), split="train")
+    print(f"Validation examples: {len(validation_dataset)}")
+    print("Formatting validation dataset...")
+    validation_dataset = format_dataset(validation_dataset, tokenizer)
 
+    # Batched held-out perplexity per example type; SFTTrainer's own eval loop is left off
+    validation_callback = build_validation_callback(validation_dataset, tokenizer)
+    telemetry_callback = TelemetryCallback(telemetry_file, tokenizer.pad_token_id, prometheus_textfile)
+    checkpoint_callback = AsyncAdapterCheckpointCallback(checkpoint_dir, checkpoint_steps, keep_checkpoints)
+    trainer = build_trainer(model, tokenizer, train_dataset, data_collator,
+                            callbacks = [validation_callback, telemetry_callback, checkpoint_callback])
 
+    resume_from_checkpoint = latest_checkpoint(checkpoint_dir) if resume else None
+    if resume_from_checkpoint:
+        print(f"Resuming from {resume_from_checkpoint}")
+    trainer_stats = trainer.train(resume_from_checkpoint = resume_from_checkpoint)
 
+    sample_generation(model, tokenizer)
+    model.save_pretrained("lora_model")  # Local saving
+    tokenizer.save_pretrained("lora_model")
 
 
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,8 @@
+import argparse
+import time
+
+from model_loading import ADAPTER_DIR, MERGED_DIR, load_finetuned
+
 max_seq_length = 2048 # Choose any! We auto support RoPE Scaling internally!
 dtype = None # None for auto detection. Float16 for Tesla T4, V100, Bfloat16 for Ampere+
 load_in_4bit = True
@@ -11,38 +16,95 @@ load_in_4bit = True
 # )
 # FastLanguageModel.for_inference(model) # Enable native 2x faster inference
 
-#############
-from peft import AutoPeftModelForCausalLM
-from transformers import AutoTokenizer
-model = AutoPeftModelForCausalLM.from_pretrained(
-    "lora_model", # YOUR MODEL YOU USED FOR TRAINING
-    load_in_4bit = load_in_4bit,
-)
-tokenizer = AutoTokenizer.from_pretrained("lora_model")
+formatted_text = """<|system|>\nYou are an expert scientific assistant who helps explain complex mathematics and physics concepts from research papers.\n<|user|>\n{}\n<|assistant|>\n{}"""
 
 
+def load_model(cpu_threads = None):
+    """Load the fine-tuned model: the merged export from export_merged.py if current, else the adapter.
 
+    Without CUDA the model is loaded on CPU with dynamic int8 linear layers (cpu_inference.py).
+    """
+    import torch
+    if not torch.cuda.is_available():
+        from cpu_inference import load_cpu_model
+        return load_cpu_model(ADAPTER_DIR, MERGED_DIR, int8 = True, num_threads = cpu_threads)
+    return load_finetuned(
+        ADAPTER_DIR, # YOUR MODEL YOU USED FOR TRAINING
+        MERGED_DIR,
+        load_in_4bit = load_in_4bit,
+    )
 
-EOS_TOKEN = tokenizer.eos_token # Must add EOS_TOKEN
-formatted_text = """<|system|>\nYou are an expert scientific assistant who helps explain complex mathematics and physics concepts from research papers.\n<|user|>\n{}\n<|assistant|>\n{}"""
 
+def build_prompt(prompt, retriever = None, top_k = 3):
+    """Chat-formatted prompt text; with a ``retriever`` (retrieval.RetrievalIndex) the top-k passages from the
+    papers are injected through the benchmark's ``format_prompt`` template."""
+    if retriever is None:
+        return formatted_text.format(
+            prompt, # prompt
+            "", # output - leave this blank for generation!
+        )
+    from benchmark_models import format_prompt
+    from retrieval import format_context
+    return format_prompt(prompt, format_context(retriever.search(prompt, top_k)))
+
+
+def generate(model, tokenizer, prompt, max_new_tokens = 64, draft_model = None, retriever = None, top_k = 3,
+             stats = None):
+    """Generate a response for a single prompt, optionally with a draft model (greedy, same tokenizer).
+
+    With a draft model, acceptance counts and timing are accumulated in ``stats`` (speculative.new_stats()).
+    ``retriever`` and ``top_k`` ground the prompt as in ``build_prompt``.
+    """
+    text = build_prompt(prompt, retriever, top_k)
+    if draft_model is not None:
+        from speculative import speculative_generate
+        return [speculative_generate(model, draft_model, tokenizer, text, max_new_tokens, stats = stats)]
+
+    inputs = tokenizer([text], return_tensors = "pt").to(model.device)
+
+    outputs = model.generate(**inputs, max_new_tokens = max_new_tokens, use_cache = True)
+    return tokenizer.batch_decode(outputs)
 
-inputs = tokenizer(
-[
-    formatted_text.format(
-        "Explain how to do entanglement metrology with a single measurement channel.", # prompt
-        "", # output - leave this blank for generation!
-    )
-], return_tensors = "pt").to("cuda")
 
-outputs = model.generate(**inputs, max_new_tokens = 64, use_cache = True)
-response = tokenizer.batch_decode(outputs)
-print("Generated response:", response)
+def main():
+    parser = argparse.ArgumentParser(description="Generate an answer with the fine-tuned model")
+    parser.add_argument("--prompt", default="Explain how to do entanglement metrology with a single measurement channel.")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--draft-model", help="Small model with the same tokenizer for speculative decoding")
+    parser.add_argument("--retrieval-index", help="Ground the prompt with passages from this index (retrieval.py)")
+    parser.add_argument("--top-k", type=int, default=3, help="Passages retrieved for the prompt")
+    parser.add_argument("--threads", type=int, default=None, help="CPU intra-op threads (default: torch's choice)")
+    args = parser.parse_args()
+    retriever = None
+    if args.retrieval_index:
+        from retrieval import RetrievalIndex
+        retriever = RetrievalIndex(args.retrieval_index)
+    model, tokenizer = load_model(cpu_threads = args.threads)
+    if args.draft_model is None:
+        response = generate(model, tokenizer, args.prompt, args.max_new_tokens, retriever = retriever, top_k = args.top_k)
+        print("Generated response:", response)
+        return
 
-# from transformers import TextStreamer
-# text_streamer = TextStreamer(tokenizer)
-# _ = model.generate(**inputs, streamer = text_streamer, max_new_tokens = 128)
+    from generation import generate_batch
+    from speculative import load_draft_model, new_stats, report
+    draft_model = load_draft_model(args.draft_model, device_map = "auto")
+    stats = new_stats()
+    response = generate(model, tokenizer, args.prompt, args.max_new_tokens, draft_model = draft_model,
+                        retriever = retriever, top_k = args.top_k, stats = stats)
+    print("Generated response:", response)
+    report(stats)
 
+    # Plain greedy decoding of the same prompt gives the speedup and checks the output is unchanged
+    start = time.perf_counter()
+    greedy = generate_batch(model, tokenizer, [build_prompt(args.prompt, retriever, args.top_k)], args.max_new_tokens)
+    greedy_seconds = time.perf_counter() - start
+    print(f"Plain greedy decoding: {greedy_seconds:.1f}s, speculative speedup {greedy_seconds / stats['seconds']:.2f}x, "
+          f"identical output: {greedy[0] == response[0]}")
 
+    # from transformers import TextStreamer
+    # text_streamer = TextStreamer(tokenizer)
+    # _ = model.generate(**inputs, streamer = text_streamer, max_new_tokens = 128)
 
 
+if __name__ == "__main__":
+    main()
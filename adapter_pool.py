@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from pathlib import Path
+
+BASE_ADAPTER = "base" # Name that routes a request to the base model with every adapter disabled
+TINY_ADAPTERS = ["resonators", "benchmarking", "transmons", "readout", "calibration"]
+
+
+class AdapterPool:
+    """One resident base model with at most ``capacity`` LoRA adapters loaded, least recently used evicted first.
+
+    ``adapters`` maps names to adapter directories saved by
+    ``model.save_pretrained``; nothing is loaded until a request asks for it.
+    The first load wraps the base in a ``PeftModel``, so use ``pool.model``
+    (not the model passed in) for generation. A new adapter is loaded before
+    the least recently used one is deleted, so for a moment ``capacity + 1``
+    adapters are resident.
+    """
+
+    def __init__(self, model, adapters, capacity=4):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.model = model
+        self.adapters = {name: str(path) for name, path in adapters.items()}
+        self.capacity = capacity
+        self.resident = OrderedDict() # name -> None, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_times = []
+        self.evict_times = []
+        self.requests = {}
+
+    def __contains__(self, name):
+        return name == BASE_ADAPTER or name in self.adapters
+
+    def _timed(self, fn, *args, **kwargs):
+        import torch
+        cuda = torch.cuda.is_available()
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        if cuda:
+            torch.cuda.synchronize()
+        return result, time.perf_counter() - start
+
+    def _load(self, name):
+        from peft import PeftModel
+        if not self.resident and not isinstance(self.model, PeftModel):
+            self.model, seconds = self._timed(PeftModel.from_pretrained, self.model, self.adapters[name],
+                                              adapter_name=name)
+        else:
+            _, seconds = self._timed(self.model.load_adapter, self.adapters[name], adapter_name=name)
+        self.model.eval()
+        self.load_times.append(seconds)
+        self.resident[name] = None
+
+    def _evict(self, name):
+        _, seconds = self._timed(self.model.delete_adapter, name)
+        self.evict_times.append(seconds)
+        self.evictions += 1
+        del self.resident[name]
+
+    def ensure(self, name):
+        """Make ``name`` resident and most recently used; returns True on a hit."""
+        if name not in self.adapters:
+            raise KeyError(f"Unknown adapter '{name}'")
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            self.hits += 1
+            return True
+        self.misses += 1
+        self._load(name)
+        self.model.set_adapter(name) # Never delete the active adapter
+        while len(self.resident) > self.capacity:
+            self._evict(next(iter(self.resident)))
+        return False
+
+    def select(self, name, requests=1):
+        """Context manager under which ``pool.model`` generates with adapter ``name`` (or the base)."""
+        self.requests[name] = self.requests.get(name, 0) + requests
+        if name == BASE_ADAPTER:
+            return self.model.disable_adapter() if self.resident else nullcontext()
+        self.ensure(name)
+        self.model.set_adapter(name)
+        return nullcontext()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        def mean_ms(times):
+            return sum(times) / len(times) * 1000 if times else 0.0
+        print(f"Adapter pool: {len(self.resident)}/{self.capacity} resident ({', '.join(self.resident) or '-'}), "
+              f"hit rate {self.hit_rate:.1%} ({self.hits} hits, {self.misses} misses), {self.evictions} evictions")
+        print(f"Adapter load: mean {mean_ms(self.load_times):.1f} ms over {len(self.load_times)}, "
+              f"evict: mean {mean_ms(self.evict_times):.1f} ms over {len(self.evict_times)}")
+
+    def metrics(self):
+        """Prometheus lines for hits, misses, evictions, load/evict time and requests per adapter."""
+        lines = []
+        for name, help_text, value in (
+                ("inference_adapter_hits_total", "Adapter selections served by a resident adapter", self.hits),
+                ("inference_adapter_misses_total", "Adapter selections that had to load the adapter", self.misses),
+                ("inference_adapter_evictions_total", "Adapters evicted from the pool", self.evictions),
+                ("inference_adapter_load_seconds_total", "Time spent loading adapters", sum(self.load_times)),
+                ("inference_adapter_evict_seconds_total", "Time spent evicting adapters", sum(self.evict_times))):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+        lines += ["# HELP inference_adapter_resident Adapters currently loaded",
+                  "# TYPE inference_adapter_resident gauge",
+                  f"inference_adapter_resident {len(self.resident)}",
+                  "# HELP inference_adapter_requests_total Requests routed to each adapter",
+                  "# TYPE inference_adapter_requests_total counter"]
+        lines += [f'inference_adapter_requests_total{{adapter="{name}"}} {count}'
+                  for name, count in sorted(self.requests.items())]
+        return lines
+
+
+def save_dummy_adapters(directory, names, seed=3407):
+    """Save one random LoRA adapter per name for the tiny model; returns ``{name: directory}``."""
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    adapters = {}
+    for i, name in enumerate(names):
+        model, _ = build_tiny_model_and_tokenizer()
+        torch.manual_seed(seed + i)
+        # Random B matrices so each adapter changes the output (the usual zero init would not)
+        model = get_peft_model(model, LoraConfig(task_type="CAUSAL_LM", r=16, init_lora_weights=False,
+                                                 target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]))
+        adapters[name] = Path(directory) / name
+        model.save_pretrained(str(adapters[name]))
+    return adapters
+
+
+def reference_answers(adapter_dir, prompts, max_new_tokens):
+    """Greedy answers of a fresh tiny model with only ``adapter_dir`` attached (or none)."""
+    from peft import PeftModel
+    from generation import generate_batch
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    model, tokenizer = build_tiny_model_and_tokenizer()
+    if adapter_dir is not None:
+        model = PeftModel.from_pretrained(model, str(adapter_dir))
+    model.eval()
+    return [generate_batch(model, tokenizer, [prompt], max_new_tokens)[0] for prompt in prompts]
+
+
+async def self_check(num_adapters=4, capacity=2, num_requests=24, max_new_tokens=8, seed=3407):
+    """Serve dummy adapters of a tiny CPU model through the batching server with a small pool.
+
+    Requests are routed to random adapters (and the base) so adapters are
+    evicted and reloaded; every answer must match a fresh model that only
+    has the requested adapter attached.
+    """
+    import inference_server
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    names = TINY_ADAPTERS[:num_adapters]
+    rng = random.Random(seed)
+    questions = ["What is a qubit?", "Explain what a transmon is.", "Why are superconducting resonators useful?"]
+    workload = [(rng.choice(names + [BASE_ADAPTER]), rng.choice(questions)) for _ in range(num_requests)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        adapters = save_dummy_adapters(tmp, names, seed)
+        model, tokenizer = build_tiny_model_and_tokenizer()
+        model.eval()
+        pool = AdapterPool(model, adapters, capacity)
+        server, listener, batcher = await inference_server.serve(
+            model, tokenizer, port=0, max_batch_size=4, batch_window=0.02, max_new_tokens=max_new_tokens,
+            adapter_pool=pool)
+        port = listener.sockets[0].getsockname()[1]
+
+        # Waves of concurrent requests, so batches mix adapters and the pool has to swap
+        results = []
+        for start in range(0, len(workload), 6):
+            results += await asyncio.gather(*(
+                inference_server.client_generate("127.0.0.1", port, question, stream=False, adapter=name)
+                for name, question in workload[start:start + 6]))
+        metrics = server.metrics()
+        batcher.cancel()
+        listener.close()
+        await listener.wait_closed()
+
+        prompts = [inference_server.inference.formatted_text.format(q, "") for q in questions]
+        expected = {name: dict(zip(questions, reference_answers(adapters.get(name), prompts, max_new_tokens)))
+                    for name in names + [BASE_ADAPTER]}
+
+    mismatches = sum(final.get("response") != expected[name][question]
+                     for (name, question), (_, final) in zip(workload, results))
+    distinct = len({tuple(answers.values()) for answers in expected.values()})
+    print(f"{len(workload)} requests over {len(names)} adapters + base, pool capacity {capacity}, "
+          f"{server.batch_sizes.count} batches")
+    pool.report()
+    print("\n".join(line for line in metrics.splitlines() if line.startswith("inference_adapter_")))
+    print(f"Distinct answer sets: {distinct}/{len(expected)}")
+    print(f"Pool vs single-adapter model mismatches: {mismatches}/{len(workload)}")
+    if mismatches or distinct < len(expected) or len(pool.resident) > capacity or (
+            capacity < len(names) and pool.evictions == 0):
+        raise RuntimeError("Routed answers differ from single-adapter models or the pool did not evict")
+    print("Adapter pool verification passed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify LRU hot-swapping of LoRA adapters with a tiny CPU model "
+                                                 "(serve real adapters with inference_server.py --adapter)")
+    parser.add_argument("--adapters", type=int, default=4, help=f"Dummy adapters (at most {len(TINY_ADAPTERS)})")
+    parser.add_argument("--capacity", type=int, default=2, help="Adapters kept resident")
+    parser.add_argument("--requests", type=int, default=24)
+    parser.add_argument("--max-new-tokens", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(self_check(args.adapters, args.capacity, args.requests, args.max_new_tokens))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+from generation import generate_all
+from prefix_cache import PrefixCache
+
+# The inference script name starts with a digit, so it cannot be imported with a plain import statement
+inference = importlib.import_module("05_inference")
+
+_DONE = object()
+
+
+def read_completed(output_file):
+    """Ids already answered in ``output_file``; the output itself is the resume checkpoint."""
+    completed = set()
+    if not Path(output_file).exists():
+        return completed
+    with open(output_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)["id"])
+            except (json.JSONDecodeError, KeyError):
+                continue # Torn last line from an interrupted run
+    return completed
+
+
+def truncate_torn_line(output_file):
+    """Drop a partially written last line so appended results start on a fresh line."""
+    path = Path(output_file)
+    if not path.exists() or path.stat().st_size == 0:
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data.endswith(b"\n"):
+            return
+        f.truncate(data.rfind(b"\n") + 1)
+
+
+def read_prompts(input_file, prompt_queue, completed, field="prompt", errors=None):
+    """Producer: put ``(id, prompt)`` for every unanswered line on the bounded queue, then a sentinel.
+
+    Records without an ``id`` are identified by their line number. Reading
+    stops at the first unreadable line; the error is appended to ``errors``
+    so the consumer can fail once the prompts before it are answered.
+    """
+    line_number = -1
+    try:
+        with open(input_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if not isinstance(record, dict) or not isinstance(record.get(field), str):
+                    raise ValueError(f"no string '{field}' field")
+                record_id = record.get("id", line_number)
+                if record_id not in completed:
+                    prompt_queue.put((record_id, record[field]))
+    except Exception as e:
+        if errors is None:
+            raise
+        errors.append(ValueError(f"{input_file} line {line_number + 1}: {e}"))
+    finally:
+        prompt_queue.put(_DONE)
+
+
+def next_window(prompt_queue, size):
+    """Take up to ``size`` prompts from the queue; the second value is False once input is exhausted."""
+    window = []
+    while len(window) < size:
+        item = prompt_queue.get()
+        if item is _DONE:
+            return window, False
+        window.append(item)
+    return window, True
+
+
+def run_batch_inference(model, tokenizer, input_file, output_file, batch_size=8, max_new_tokens=256,
+                        sort_window=16, queue_size=1024, field="prompt", use_prefix_cache=True):
+    """Answer every prompt in ``input_file`` and append ``{id, prompt, response}`` lines to ``output_file``.
+
+    A reader thread fills a bounded queue, so memory stays flat however large
+    the input is. Prompts are taken ``batch_size * sort_window`` at a time,
+    sorted by length and generated batch by batch; each batch is flushed to
+    disk before the next starts, so an interrupted job resumes where it stopped.
+    An unreadable input line raises ValueError after the prompts before it are answered.
+    """
+    completed = read_completed(output_file)
+    if completed:
+        print(f"Resuming: {len(completed)} prompt(s) already answered in {output_file}")
+    truncate_torn_line(output_file)
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+
+    prompt_queue = queue.Queue(maxsize=queue_size)
+    reader_errors = []
+    reader = threading.Thread(target=read_prompts, args=(input_file, prompt_queue, completed, field, reader_errors),
+                              daemon=True)
+    reader.start()
+
+    template_prefix = inference.formatted_text.split("{}")[0]
+    prefix_cache = PrefixCache(tokenizer, template_prefix) if use_prefix_cache else None
+
+    answered = 0
+    new_tokens = 0
+    start = time.perf_counter()
+    with open(output_file, 'a', encoding='utf-8') as out:
+        more = True
+        while more:
+            window, more = next_window(prompt_queue, batch_size * sort_window)
+            if not window:
+                break
+            formatted = [inference.formatted_text.format(prompt, "") for _, prompt in window]
+            order = sorted(range(len(window)), key=lambda i: len(tokenizer(formatted[i])["input_ids"]))
+
+            for batch_start in range(0, len(order), batch_size):
+                batch = order[batch_start:batch_start + batch_size]
+                stats = {}
+                answers = generate_all(model, tokenizer, [formatted[i] for i in batch], batch_size=batch_size,
+                                       max_new_tokens=max_new_tokens, prefix_cache=prefix_cache, stats=stats)
+                for i, answer in zip(batch, answers):
+                    record_id, prompt = window[i]
+                    out.write(json.dumps({"id": record_id, "prompt": prompt, "response": answer}) + "\n")
+                new_tokens += stats["new_tokens"]
+                out.flush()
+                os.fsync(out.fileno())
+                answered += len(batch)
+
+                elapsed = time.perf_counter() - start
+                print(f"Answered {answered} prompt(s), {new_tokens / elapsed:.1f} generated tokens/sec")
+
+    reader.join()
+    if reader_errors:
+        # Answers written so far are kept, so rerunning after fixing the input resumes from there
+        raise reader_errors[0]
+    elapsed = time.perf_counter() - start
+    summary = {
+        "answered": answered,
+        "skipped": len(completed),
+        "new_tokens": new_tokens,
+        "seconds": elapsed,
+        "tokens_per_sec": new_tokens / elapsed if elapsed else 0.0,
+    }
+    print(f"Done: {answered} answered ({len(completed)} already done), {new_tokens} tokens "
+          f"in {elapsed:.1f}s = {summary['tokens_per_sec']:.1f} tokens/sec")
+    if prefix_cache is not None:
+        prefix_cache.report()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of prompts with the fine-tuned model")
+    parser.add_argument("input_file", help="JSONL with one {\"prompt\": ...} (and optional \"id\") per line")
+    parser.add_argument("output_file", help="JSONL that answers are appended to; also the resume checkpoint")
+    parser.add_argument("--model", default=None, help="'tiny' for a CPU smoke run; defaults to the fine-tuned model")
+    parser.add_argument("--field", default="prompt", help="Input field holding the prompt")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--sort-window", type=int, default=16, help="Batches' worth of prompts sorted by length together")
+    parser.add_argument("--queue-size", type=int, default=1024, help="Prompts read ahead of generation")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="Prefill the system prompt for every batch")
+    args = parser.parse_args()
+
+    if args.model == "tiny":
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer()
+    else:
+        model, tokenizer = inference.load_model()
+    model.eval()
+
+    run_batch_inference(model, tokenizer, args.input_file, args.output_file, args.batch_size, args.max_new_tokens,
+                        args.sort_window, args.queue_size, args.field, not args.no_prefix_cache)
+
+
+if __name__ == "__main__":
+    main()
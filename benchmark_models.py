@@ -1,7 +1,13 @@
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import AutoPeftModelForCausalLM
-import gc
+import argparse
+import json
+import time
+from generation_cache import GENERATION_CACHE_DIR, GenerationCache, cached_generate, model_fingerprint
+from model_loading import load_base_with_adapters
+# torch and the modules built on it are imported where they are used, so that importing QUESTIONS
+# or format_prompt (latency_benchmark.py, cpu_inference.py, ...) and --help stay fast
+
+GPU_BASE_MODEL = "unsloth/meta-llama-3.1-8b-unsloth-bnb-4bit"
+CPU_BASE_MODEL = "unsloth/Meta-Llama-3.1-8B" # bitsandbytes checkpoints need CUDA; int8 on CPU starts from full precision
 
 # 10 Questions based on the scientific articles
 QUESTIONS = [
@@ -19,95 +25,311 @@ QUESTIONS = [
 
 SYSTEM_PROMPT = """You are an expert scientists with expertise in quantum computing with superconducting qubits who helps explain complex mathematics and physics concepts discussed in research papers. You are able to condense your responses into one-paragraphs."""
 
-def format_prompt(question):
-    return f"""<|system|>
+# Every prompt starts with this block; prefix_cache.py prefills it once per model arm
+PROMPT_PREFIX = f"""<|system|>
 {SYSTEM_PROMPT}
 <|user|>
-{question}
+"""
+
+def format_prompt(question, context=""):
+    return f"""{PROMPT_PREFIX}{context}{question}
 <|assistant|>
 """
 
-def generate_responses(model_name, is_peft=False):
-    print(f"Loading model: {model_name}")
-    
-    if is_peft:
-        # Load Fine-Tuned Model
-        model = AutoPeftModelForCausalLM.from_pretrained(
-            model_name,
-            load_in_4bit=True,
-            device_map="auto"
-        )
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-    else:
-        # Load Base Model
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            load_in_4bit=True,
-            device_map="auto"
-        )
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-    logger = []
-    
+def build_prompts(retriever=None, top_k=3):
+    """Benchmark prompts, optionally grounded with the top-k passages retrieved for each question."""
+    if retriever is None:
+        return [format_prompt(question) for question in QUESTIONS]
+    from retrieval import format_context
+    return [format_prompt(question, format_context(retriever.search(question, top_k))) for question in QUESTIONS]
+
+def generate_responses(model, tokenizer, batch_size=8, max_new_tokens=256, prefix_cache=None, arm="default",
+                       cache=None, fingerprint=None, meta=None, draft_model=None, speculative_stats=None,
+                       prompts=None):
     print("Starting generation...")
-    for i, question in enumerate(QUESTIONS):
-        print(f"Processing Q{i+1}/{len(QUESTIONS)}")
-        prompt = format_prompt(question)
-        inputs = tokenizer(prompt, return_tensors="pt").to("cuda")
-        
-        outputs = model.generate(**inputs, max_new_tokens=256, use_cache=True)
-        response_text = tokenizer.batch_decode(outputs, skip_special_tokens=True)[0]
-        
-        # Extract just the assistant's part if possible, though batch_decode returns full text usually
-        # The cleaning depends on the exact model output format, but usually we get the prompt back.
-        # We'll save the full raw text for now or split if clear.
-        
-        # Simple split to try and get only the answer
-        try:
-            answer = response_text.split("<|assistant|>\n")[-1].strip()
-        except:
-            answer = response_text
-
-        logger.append({
-            "question": question,
-            "response": answer
-        })
-
-    # Cleanup
-    del model
-    del tokenizer
-    gc.collect()
-    torch.cuda.empty_cache()
-    
-    return logger
-
-def save_comparison(base_results, ft_results):
+    # Greedy, left-padded batches; the batch size is halved automatically on OOM
+    prompts = prompts or build_prompts()
+
+    def generate_fn(batch_prompts):
+        from generation import generate_all
+        from speculative import speculative_generate_all
+        if draft_model is not None:
+            # Greedy output is unchanged, so cached answers stay valid with or without a draft model
+            return speculative_generate_all(model, draft_model, tokenizer, batch_prompts, max_new_tokens,
+                                            stats=speculative_stats)
+        return generate_all(model, tokenizer, batch_prompts, batch_size=batch_size, max_new_tokens=max_new_tokens,
+                            prefix_cache=prefix_cache, prefix_key=arm)
+
+    if cache is None:
+        answers = generate_fn(prompts)
+    else:
+        # Only questions without a cached answer for these exact weights and settings are generated
+        params = {"max_new_tokens": max_new_tokens, "do_sample": False}
+        answers = cached_generate(cache, fingerprint, meta, prompts, SYSTEM_PROMPT, params, generate_fn, arm)
+
+    return [
+        {"question": question, "response": answer}
+        for question, answer in zip(QUESTIONS, answers)
+    ]
+
+def run_arms(model, tokenizer, adapters, batch_size=8, prefix_cache=None, cache=None, draft_model=None,
+             speculative_stats=None, prompts=None, max_new_tokens=256):
+    """Generate answers for the base model and each adapter (name -> directory) from one resident model.
+
+    The system-prompt KV cache differs per arm, so each arm gets its own prefix cache entry.
+    """
+    results = {}
+
+    def arm_kwargs(arm, adapter_dir=None):
+        kwargs = {"max_new_tokens": max_new_tokens, "prefix_cache": prefix_cache, "arm": arm,
+                  "draft_model": draft_model, "speculative_stats": speculative_stats, "prompts": prompts}
+        if cache is None:
+            return kwargs
+        meta = {"arm": arm, "base_model": model.config.name_or_path,
+                "adapter_dir": str(adapter_dir) if adapter_dir is not None else None}
+        return {**kwargs, "cache": cache, "fingerprint": model_fingerprint(model.config, adapter_dir), "meta": meta}
+
+    print("=== Benchmarking Base Model ===")
+    if adapters:
+        with model.disable_adapter():
+            results["Base Model"] = generate_responses(model, tokenizer, batch_size, **arm_kwargs("Base Model"))
+    else:
+        results["Base Model"] = generate_responses(model, tokenizer, batch_size, **arm_kwargs("Base Model"))
+
+    for name, adapter_dir in adapters.items():
+        print(f"\n=== Benchmarking adapter: {name} ===")
+        model.set_adapter(name)
+        results[name] = generate_responses(model, tokenizer, batch_size, **arm_kwargs(name, adapter_dir))
+
+    return results
+
+def run_cpu_arms(base_model, adapters, batch_size=8, use_prefix_cache=True, cache=None, draft_model=None,
+                 speculative_stats=None, prompts=None, max_new_tokens=256, int8=True, num_threads=None):
+    """CPU counterpart of run_arms; returns ``(results, prefix cache or None)``.
+
+    Dynamic int8 quantization needs plain linear layers, so adapters cannot be
+    toggled on one model: each arm loads the fp32 base, merges its adapter and
+    quantizes (cpu_inference.load_cpu_base), and only one arm is resident at a time.
+    """
+    from cpu_inference import load_cpu_base
+    from prefix_cache import PrefixCache
+
+    variant = "cpu-int8" if int8 else "cpu-fp32"
+    results = {}
+    prefix_cache = None
+    for arm, adapter_dir in [("Base Model", None)] + list(adapters.items()):
+        print(f"=== Benchmarking {arm if adapter_dir is None else 'adapter: ' + arm} on CPU ({variant}) ===")
+        start = time.perf_counter()
+        model, tokenizer = load_cpu_base(base_model, adapter_dir, int8, num_threads)
+        print(f"Model load time: {time.perf_counter() - start:.1f}s")
+        if use_prefix_cache and prefix_cache is None:
+            prefix_cache = PrefixCache(tokenizer, PROMPT_PREFIX)
+        kwargs = {"max_new_tokens": max_new_tokens, "prefix_cache": prefix_cache, "arm": arm,
+                  "draft_model": draft_model, "speculative_stats": speculative_stats, "prompts": prompts}
+        if cache is not None:
+            meta = {"arm": arm, "base_model": base_model, "variant": variant,
+                    "adapter_dir": str(adapter_dir) if adapter_dir is not None else None}
+            kwargs.update(cache=cache, fingerprint=model_fingerprint(model.config, adapter_dir, variant), meta=meta)
+        results[arm] = generate_responses(model, tokenizer, batch_size, **kwargs)
+        del model
+    return results, prefix_cache
+
+def smoke_test(batch_size=8, max_new_tokens=32, num_threads=None, int8=True):
+    """Run the CPU benchmark path on a tiny random model with a random adapter; nothing is cached or saved."""
+    import tempfile
+    from adapter_pool import save_dummy_adapters
+
+    with tempfile.TemporaryDirectory() as tmp:
+        adapters = save_dummy_adapters(tmp, ["fine_tuned"])
+        start = time.perf_counter()
+        results, prefix_cache = run_cpu_arms("tiny", adapters, batch_size, True, None, None, None, None,
+                                             max_new_tokens, int8, num_threads)
+        elapsed = time.perf_counter() - start
+    prefix_cache.report()
+    answers = {arm: [r["response"] for r in responses] for arm, responses in results.items()}
+    differing = sum(a != b for a, b in zip(answers["Base Model"], answers["fine_tuned"]))
+    print(f"{len(results)} arms x {len(QUESTIONS)} questions in {elapsed:.1f}s, "
+          f"{differing}/{len(QUESTIONS)} adapter answers differ from the base")
+    print(f"Peak memory: {peak_memory_report()}")
+    if any(len(arm_answers) != len(QUESTIONS) for arm_answers in answers.values()) or not differing:
+        raise RuntimeError("CPU benchmark did not answer every question or the adapter was not applied")
+    print("CPU benchmark smoke test passed.")
+
+def load_reference_pairs(path):
+    """Question / reference answer pairs from a JSONL file with ``prompt`` and ``completion`` fields."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def score_arms(model, tokenizer, adapters, pairs, max_seq_length=2048, max_batch_tokens=16384):
+    """Conditional log-likelihood of every reference answer under the base model and each adapter.
+
+    One forward pass per length-sorted batch and no sampling, so comparing
+    arms over hundreds of pairs takes seconds rather than a generation run.
+    """
+    from validation import evaluate_perplexity, example_type, prepare_conditional_examples
+    examples = prepare_conditional_examples(
+        [format_prompt(pair["prompt"]) for pair in pairs],
+        [pair["completion"].strip() for pair in pairs],
+        tokenizer, max_seq_length, types=[example_type(pair["prompt"]) for pair in pairs])
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    reports = {}
+    print("=== Scoring Base Model ===")
+    if adapters:
+        with model.disable_adapter():
+            reports["Base Model"] = evaluate_perplexity(model, examples, pad_token_id, max_batch_tokens)
+    else:
+        reports["Base Model"] = evaluate_perplexity(model, examples, pad_token_id, max_batch_tokens)
+    for name in adapters:
+        print(f"=== Scoring adapter: {name} ===")
+        model.set_adapter(name)
+        reports[name] = evaluate_perplexity(model, examples, pad_token_id, max_batch_tokens)
+    return reports
+
+def save_likelihood_comparison(reports, base_model_name, adapters, reference_file, path="likelihood_comparison.md"):
+    """Write per-arm reference-answer perplexity, per example type, and per-pair wins over the base model."""
+    base = reports["Base Model"]
+    with open(path, "w") as f:
+        f.write("# Model Comparison: Reference Answer Likelihood\n\n")
+        f.write(f"**Base Model**: {base_model_name}\n")
+        for name, adapter_dir in adapters.items():
+            f.write(f"**Adapter `{name}`**: {adapter_dir}\n")
+        f.write(f"**References**: {reference_file} ({base['examples']} pairs, {base['tokens']} answer tokens)\n\n")
+
+        f.write("| Model | Loss | Perplexity | Pairs better than base | Time (s) |\n")
+        f.write("|---|---|---|---|---|\n")
+        for arm, report in reports.items():
+            wins = "-"
+            if arm != "Base Model":
+                better = sum(
+                    stats["nll"] / max(stats["tokens"], 1)
+                    < base["per_example"][i]["nll"] / max(base["per_example"][i]["tokens"], 1)
+                    for i, stats in report["per_example"].items())
+                wins = f"{better}/{len(report['per_example'])}"
+            f.write(f"| {arm} | {report['loss']:.4f} | {report['perplexity']:.3f} | {wins} | {report['elapsed']:.1f} |\n")
+
+        f.write("\n## Perplexity by example type\n\n")
+        f.write("| Type | " + " | ".join(reports) + " |\n")
+        f.write("|---|" + "---|" * len(reports) + "\n")
+        for name in base["types"]:
+            cells = " | ".join(f"{report['types'][name]['perplexity']:.3f}" for report in reports.values())
+            f.write(f"| {name} ({base['types'][name]['examples']}) | {cells} |\n")
+
+def peak_memory_report():
+    """Peak accelerator memory (or host RSS on CPU) as a printable string."""
+    import torch
+    if torch.cuda.is_available():
+        return f"{torch.cuda.max_memory_allocated() / 2**30:.2f} GiB GPU"
+    import resource
+    return f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20:.2f} GiB host RSS"
+
+def save_comparison(results, base_model_name, adapters, cache_stats=None):
+    """Write every arm's answers side by side to model_comparison.md."""
+    arm_titles = {"Base Model": "Base Model"}
+    if list(adapters) == ["fine_tuned"]:
+        arm_titles["fine_tuned"] = "Fine-Tuned Model"
+    else:
+        arm_titles.update({name: f"Adapter `{name}`" for name in adapters})
+
     with open("model_comparison.md", "w") as f:
         f.write("# Model Comparison: Base vs Fine-Tuned\n\n")
-        f.write(f"**Base Model**: unsloth/meta-llama-3.1-8b-unsloth-bnb-4bit\n")
-        f.write(f"**Fine-Tuned Model**: lora_model\n\n")
-        
-        for i, (base, ft) in enumerate(zip(base_results, ft_results)):
+        f.write(f"**Base Model**: {base_model_name}\n")
+        for name, path in adapters.items():
+            f.write(f"**{arm_titles[name]}**: {path}\n")
+        for arm, stats in (cache_stats or {}).items():
+            f.write(f"**Generation cache ({arm_titles[arm]})**: {stats['hits']} hits, {stats['misses']} misses\n")
+        f.write("\n")
+
+        for i, question in enumerate(QUESTIONS):
             f.write(f"## Question {i+1}\n")
-            f.write(f"**Q: {base['question']}**\n\n")
-            
-            f.write("### Base Model Response\n")
-            f.write(f"{base['response']}\n\n")
-            
-            f.write("### Fine-Tuned Model Response\n")
-            f.write(f"{ft['response']}\n\n")
+            f.write(f"**Q: {question}**\n\n")
+
+            for arm, answers in results.items():
+                f.write(f"### {arm_titles[arm]} Response\n")
+                f.write(f"{answers[i]['response']}\n\n")
             f.write("---\n\n")
 
-if __name__ == "__main__":
-    base_model_name = "unsloth/meta-llama-3.1-8b-unsloth-bnb-4bit"
-    ft_model_name = "lora_model"
+def main():
+    parser = argparse.ArgumentParser(description="Compare base and fine-tuned model answers")
+    parser.add_argument("--batch-size", type=int, default=8, help="Questions generated per batch")
+    parser.add_argument("--base-model", default=None,
+                        help=f"Defaults to {GPU_BASE_MODEL} with CUDA and {CPU_BASE_MODEL} without; "
+                             "'tiny' runs a CPU smoke test with a random model and adapter")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=None, help="CPU intra-op threads (default: torch's choice)")
+    parser.add_argument("--fp32", action="store_true", help="On CPU, skip the int8 quantization of linear layers")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="Prefill the system prompt for every question")
+    parser.add_argument("--no-cache", action="store_true", help="Regenerate every answer instead of using the cache")
+    parser.add_argument("--cache-dir", default=str(GENERATION_CACHE_DIR))
+    parser.add_argument("--draft-model", help="Small model with the same tokenizer for speculative decoding")
+    parser.add_argument("--retrieval-index", help="Ground each question with passages from this index (retrieval.py)")
+    parser.add_argument("--top-k", type=int, default=3, help="Passages retrieved per question")
+    parser.add_argument("--likelihood", nargs="?", const="dataset/validation_enhanced.jsonl", metavar="REFERENCES",
+                        help="Score reference answers (JSONL prompt/completion) by likelihood instead of generating")
+    parser.add_argument("--max-seq-length", type=int, default=2048, help="Prompt + reference tokens scored per pair")
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="Adapter to compare (repeatable); defaults to fine_tuned=lora_model")
+    args = parser.parse_args()
 
-    print("=== Benchmarking Base Model ===")
-    base_results = generate_responses(base_model_name, is_peft=False)
-    
-    print("\n=== Benchmarking Fine-Tuned Model ===")
-    ft_results = generate_responses(ft_model_name, is_peft=True)
-    
-    print("\nSaving results...")
-    save_comparison(base_results, ft_results)
-    print("Done! Results saved to model_comparison.md")
+    import torch
+    cpu = not torch.cuda.is_available() or args.base_model == "tiny"
+    base_model = args.base_model or (CPU_BASE_MODEL if cpu else GPU_BASE_MODEL)
+    if cpu and "bnb-4bit" in base_model:
+        parser.error(f"{base_model} is quantized with bitsandbytes, which needs CUDA; pass a full-precision "
+                     f"--base-model such as {CPU_BASE_MODEL}")
+    if base_model == "tiny":
+        if args.likelihood:
+            parser.error("--base-model tiny only smoke-tests generation")
+        smoke_test(args.batch_size, min(args.max_new_tokens, 32), args.threads, not args.fp32)
+        return
+
+    adapters = dict(spec.split("=", 1) for spec in args.adapter) or {"fine_tuned": "lora_model"}
+
+    if args.likelihood:
+        # One base load serves every arm: adapters are toggled instead of reloading the base weights
+        start = time.perf_counter()
+        if cpu:
+            model, tokenizer = load_base_with_adapters(base_model, adapters, load_in_4bit=False, dtype=torch.float32)
+        else:
+            model, tokenizer = load_base_with_adapters(base_model, adapters, load_in_4bit=True, device_map="auto")
+        print(f"Model load time: {time.perf_counter() - start:.1f}s")
+        reports = score_arms(model, tokenizer, adapters, load_reference_pairs(args.likelihood), args.max_seq_length)
+        for arm, arm_report in reports.items():
+            print(f"{arm}: reference answer loss {arm_report['loss']:.4f}, perplexity {arm_report['perplexity']:.3f} "
+                  f"({arm_report['examples']} pairs in {arm_report['elapsed']:.1f}s)")
+        save_likelihood_comparison(reports, base_model, adapters, args.likelihood)
+        print("Done! Results saved to likelihood_comparison.md")
+    else:
+        from prefix_cache import PrefixCache
+        from retrieval import RetrievalIndex
+        from speculative import load_draft_model, new_stats, report
+        cache = None if args.no_cache else GenerationCache(args.cache_dir)
+        draft_model = load_draft_model(args.draft_model, device_map="auto") if args.draft_model else None
+        speculative_stats = new_stats() if draft_model is not None else None
+        retriever = RetrievalIndex(args.retrieval_index) if args.retrieval_index else None
+        prompts = build_prompts(retriever, args.top_k)
+        if cpu:
+            results, prefix_cache = run_cpu_arms(base_model, adapters, args.batch_size, not args.no_prefix_cache,
+                                                 cache, draft_model, speculative_stats, prompts, args.max_new_tokens,
+                                                 not args.fp32, args.threads)
+        else:
+            start = time.perf_counter()
+            model, tokenizer = load_base_with_adapters(base_model, adapters, load_in_4bit=True, device_map="auto")
+            print(f"Model load time: {time.perf_counter() - start:.1f}s")
+            prefix_cache = None if args.no_prefix_cache else PrefixCache(tokenizer, PROMPT_PREFIX)
+            results = run_arms(model, tokenizer, adapters, args.batch_size, prefix_cache, cache, draft_model,
+                               speculative_stats, prompts, args.max_new_tokens)
+        if draft_model is not None:
+            report(speculative_stats)
+        elif prefix_cache is not None:
+            prefix_cache.report()
+        if cache is not None:
+            cache.report()
+        print(f"Peak memory: {peak_memory_report()}")
+
+        print("\nSaving results...")
+        save_comparison(results, base_model, adapters, cache.stats if cache is not None else None)
+        print("Done! Results saved to model_comparison.md")
+
+if __name__ == "__main__":
+    main()
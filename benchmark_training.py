@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import resource
+import time
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+
+from length_sampler import LengthGroupedBatchSampler
+from packing import PackedSequenceCollator
+
+# The training script name starts with a digit, so it cannot be imported with a plain import statement
+fine_tuning = importlib.import_module("04_fine_tuning")
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_benchmark_model(model_name, hidden_size, num_layers):
+    """Load the tiny random Llama (``tiny``) or the real model through the training script, LoRA-wrapped."""
+    if model_name == "tiny":
+        from peft import LoraConfig, get_peft_model
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer(hidden_size=hidden_size, num_layers=num_layers)
+        model = get_peft_model(model, LoraConfig(task_type="CAUSAL_LM", **fine_tuning.lora_config))
+        return model, tokenizer
+
+    model, tokenizer = fine_tuning.load_model(model_name)
+    return fine_tuning.add_lora(model), tokenizer
+
+
+def build_dataloader(train_dataset, data_collator, packing, batch_size, seed):
+    """Build the same sampler/collator pairing the trainer uses."""
+    if packing:
+        generator = torch.Generator().manual_seed(seed)
+        return DataLoader(train_dataset, batch_size=batch_size, sampler=RandomSampler(train_dataset, generator=generator),
+                          collate_fn=data_collator)
+
+    lengths = [len(ids) for ids in train_dataset["input_ids"]]
+    batch_sampler = LengthGroupedBatchSampler(lengths, batch_size, shuffle_window=fine_tuning.shuffle_window, seed=seed)
+    return DataLoader(train_dataset, batch_sampler=batch_sampler, collate_fn=data_collator)
+
+
+def run_benchmark(model, dataloader, steps, warmup_steps, learning_rate, weight_decay):
+    """Run ``warmup_steps + steps`` optimizer steps and time data wait vs compute."""
+    device = next(model.parameters()).device
+    synchronize = torch.cuda.synchronize if device.type == "cuda" else (lambda: None)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],
+                                  lr=learning_rate, weight_decay=weight_decay)
+    if packing_collator(dataloader):
+        model.config.use_cache = False
+    model.train()
+
+    records = []
+    iterator = iter(dataloader)
+    for step in range(warmup_steps + steps):
+        start = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            iterator = iter(dataloader)
+            batch = next(iterator)
+        batch = {k: v.to(device) for k, v in batch.items()}
+        data_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        synchronize()
+        compute_time = time.perf_counter() - start
+
+        if step >= warmup_steps:
+            records.append({
+                "data_time": data_time,
+                "compute_time": compute_time,
+                "token_slots": batch["input_ids"].numel(),
+                "trained_tokens": int((batch["labels"] != -100).sum()),
+                "loss": loss.item(),
+            })
+
+    return records
+
+
+def packing_collator(dataloader):
+    """Whether the dataloader feeds packed rows."""
+    return isinstance(dataloader.collate_fn, PackedSequenceCollator)
+
+
+def summarize(records):
+    """Aggregate per-step records into throughput and timing totals."""
+    data_time = sum(r["data_time"] for r in records)
+    compute_time = sum(r["compute_time"] for r in records)
+    total_time = data_time + compute_time
+    trained_tokens = sum(r["trained_tokens"] for r in records)
+    token_slots = sum(r["token_slots"] for r in records)
+    return {
+        "steps": len(records),
+        "tokens_per_sec": trained_tokens / total_time if total_time else 0.0,
+        "token_slots_per_sec": token_slots / total_time if total_time else 0.0,
+        "real_token_fraction": trained_tokens / token_slots if token_slots else 0.0,
+        "mean_step_time": total_time / len(records) if records else 0.0,
+        "mean_data_wait": data_time / len(records) if records else 0.0,
+        "mean_compute": compute_time / len(records) if records else 0.0,
+        "data_wait_fraction": data_time / total_time if total_time else 0.0,
+        "final_loss": records[-1]["loss"] if records else float("nan"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_summary(summary):
+    """Print the benchmark summary."""
+    print(f"\n--- Training throughput ({summary['steps']} measured steps) ---")
+    print(f"Trained tokens/sec: {summary['tokens_per_sec']:.1f}")
+    print(f"Token slots/sec (incl. padding): {summary['token_slots_per_sec']:.1f}")
+    print(f"Real token fraction: {summary['real_token_fraction']:.1%}")
+    print(f"Mean step time: {summary['mean_step_time'] * 1000:.1f} ms "
+          f"(data wait {summary['mean_data_wait'] * 1000:.1f} ms, compute {summary['mean_compute'] * 1000:.1f} ms, "
+          f"{summary['data_wait_fraction']:.1%} waiting on data)")
+    print(f"Final loss: {summary['final_loss']:.4f}")
+    print(f"Peak RSS: {summary['peak_rss_mb']:.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Training-throughput benchmark for the 04_fine_tuning.py data path")
+    parser.add_argument("--model", default="tiny", help="'tiny' for a random CPU Llama, or a model name for Unsloth")
+    parser.add_argument("--train-file", default=str(fine_tuning.VALIDATION_FILE),
+                        help="JSONL file to train on (the validation set is small enough for CPU)")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N examples")
+    parser.add_argument("--max-seq-length", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=fine_tuning.training_config["per_device_train_batch_size"])
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup-steps", type=int, default=2)
+    parser.add_argument("--no-packing", action="store_true", help="Use length-grouped batches instead of packing")
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    args = parser.parse_args()
+
+    packing = not args.no_packing
+    start = time.perf_counter()
+    model, tokenizer = load_benchmark_model(args.model, args.hidden_size, args.layers)
+    print(f"Model ready in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    train_dataset, _ = fine_tuning.load_datasets(args.train_file, validation_file=None)
+    if args.limit:
+        train_dataset = train_dataset.select(range(min(args.limit, len(train_dataset))))
+    train_dataset = fine_tuning.format_dataset(train_dataset, tokenizer)
+    train_dataset, data_collator = fine_tuning.prepare_train_dataset(
+        train_dataset, tokenizer, packing=packing, max_seq_length=args.max_seq_length)
+    print(f"Data pipeline ready in {time.perf_counter() - start:.1f}s")
+
+    dataloader = build_dataloader(train_dataset, data_collator, packing, args.batch_size,
+                                  fine_tuning.training_config["seed"])
+    records = run_benchmark(
+        model, dataloader, args.steps, args.warmup_steps,
+        fine_tuning.training_config["learning_rate"], fine_tuning.training_config["weight_decay"],
+    )
+    print_summary(summarize(records))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import dataclasses
+import json
+import os
+import random
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+from transformers import TrainerCallback
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)$")
+
+
+def cpu_copy(obj):
+    """Recursively copy tensors in a (nested) state dict to CPU so training can keep mutating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """Capture RNG state in the layout Trainer restores from ``rng_state.pth``."""
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "cpu": torch.random.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.random.get_rng_state()
+    return states
+
+
+def list_checkpoints(checkpoint_dir):
+    """Return completed checkpoint directories sorted by step."""
+    checkpoint_dir = Path(checkpoint_dir)
+    if not checkpoint_dir.exists():
+        return []
+    found = []
+    for path in checkpoint_dir.iterdir():
+        match = CHECKPOINT_PATTERN.match(path.name)
+        if match and path.is_dir():
+            found.append((int(match.group(1)), path))
+    return [path for _, path in sorted(found)]
+
+
+def latest_checkpoint(checkpoint_dir):
+    """Return the newest completed checkpoint, or None."""
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return str(checkpoints[-1]) if checkpoints else None
+
+
+class AsyncAdapterCheckpointCallback(TrainerCallback):
+    """Periodically save LoRA weights, optimizer, scheduler and RNG state from a background thread.
+
+    On the training thread the callback only copies the (small) adapter and
+    optimizer state to CPU; serialisation happens on a single writer thread.
+    Checkpoints use the Trainer layout (``adapter_model.safetensors``,
+    ``optimizer.pt``, ``scheduler.pt``, ``rng_state.pth``,
+    ``trainer_state.json``), so ``trainer.train(resume_from_checkpoint=...)``
+    resumes exactly. Each checkpoint is written to a temporary directory and
+    renamed, so a crash mid-write never leaves a partial checkpoint; only the
+    newest ``keep_last`` are kept.
+    """
+
+    def __init__(self, checkpoint_dir, save_steps=10, keep_last=3):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.save_steps = save_steps
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="adapter-checkpoint")
+        self.pending = None
+        self.snapshot_time = 0.0
+        self.blocked_time = 0.0
+        self.saved = 0
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        if not self.save_steps or state.global_step % self.save_steps != 0:
+            return
+        if not state.is_world_process_zero:
+            return
+
+        # Only one write in flight: bounds host memory to a single snapshot
+        start = time.perf_counter()
+        self.wait()
+        self.blocked_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        from peft import get_peft_model_state_dict
+        snapshot = {
+            "step": state.global_step,
+            "adapter": cpu_copy(get_peft_model_state_dict(model)),
+            "peft_config": model.peft_config,
+            "optimizer": cpu_copy(optimizer.state_dict()) if optimizer is not None else None,
+            "scheduler": lr_scheduler.state_dict() if lr_scheduler is not None else None,
+            "rng": rng_state(),
+            "trainer_state": json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n",
+        }
+        self.snapshot_time += time.perf_counter() - start
+
+        self.pending = self.executor.submit(self.write, snapshot)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.wait()
+        print(f"Adapter checkpoints: {self.saved} written, {self.snapshot_time:.2f}s snapshotting, "
+              f"{self.blocked_time:.2f}s waiting on the writer")
+
+    def wait(self):
+        """Block until the in-flight write finishes, re-raising any error from the writer thread."""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def write(self, snapshot):
+        """Serialise one snapshot (runs on the writer thread)."""
+        from safetensors.torch import save_file
+
+        name = f"checkpoint-{snapshot['step']}"
+        final_dir = self.checkpoint_dir / name
+        tmp_dir = self.checkpoint_dir / f".{name}.tmp"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        for adapter_config in snapshot["peft_config"].values():
+            adapter_config.save_pretrained(str(tmp_dir))
+        save_file(snapshot["adapter"], str(tmp_dir / "adapter_model.safetensors"), metadata={"format": "pt"})
+        if snapshot["optimizer"] is not None:
+            torch.save(snapshot["optimizer"], tmp_dir / "optimizer.pt")
+        if snapshot["scheduler"] is not None:
+            torch.save(snapshot["scheduler"], tmp_dir / "scheduler.pt")
+        torch.save(snapshot["rng"], tmp_dir / "rng_state.pth")
+        with open(tmp_dir / "trainer_state.json", 'w', encoding='utf-8') as f:
+            f.write(snapshot["trainer_state"])
+
+        if final_dir.exists():
+            shutil.rmtree(final_dir)
+        os.replace(tmp_dir, final_dir)
+        self.saved += 1
+        self.rotate()
+
+    def rotate(self):
+        """Delete all but the newest ``keep_last`` checkpoints."""
+        if not self.keep_last:
+            return
+        for path in list_checkpoints(self.checkpoint_dir)[:-self.keep_last]:
+            shutil.rmtree(path, ignore_errors=True)
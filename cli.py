@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import json
+import subprocess
+import sys
+import time
+
+# Subcommand -> (module, description). A module is only imported when its subcommand runs.
+COMMANDS = {
+    "download": ("01_download_and_extract", "Download and extract the papers in references.csv"),
+    "process": ("02_process_latex", "Convert the LaTeX sources to Markdown"),
+    "dataset": ("03_prepare_dataset", "Build the JSONL training and validation sets"),
+    "train": ("04_fine_tuning", "Fine-tune the LoRA adapter"),
+    "infer": ("05_inference", "Generate one answer with the fine-tuned model"),
+    "benchmark": ("benchmark_models", "Compare base and fine-tuned answers"),
+    "pipeline": ("pipeline", "Run every out-of-date stage"),
+    "batch": ("batch_inference", "Answer a JSONL file of prompts"),
+    "serve": ("inference_server", "Serve the model over HTTP with dynamic batching"),
+    "adapters": ("adapter_pool", "Verify LRU hot-swapping of LoRA adapters on a tiny CPU model"),
+    "latency": ("latency_benchmark", "Measure time-to-first-token and inter-token latency"),
+    "retrieval": ("retrieval", "Build or query the BM25 index over the papers"),
+    "corpus": ("corpus_store", "Import, inspect or benchmark the sqlite corpus store"),
+    "fertility": ("token_fertility", "Tokens per character by LaTeX construct"),
+    "export": ("export_merged", "Merge the adapter into a standalone checkpoint"),
+    "sweep": ("sweep_lora", "Compare LoRA configurations"),
+    "train-bench": ("benchmark_training", "Training throughput on a tiny CPU model"),
+    "cpu": ("cpu_inference", "Compare fp32 and int8 CPU inference"),
+    "cache": ("generation_cache", "List or invalidate cached benchmark answers"),
+}
+
+# Modules that must import without pulling in the heavy dependencies below
+STARTUP_MODULES = ["cli", "01_download_and_extract", "02_process_latex", "03_prepare_dataset", "04_fine_tuning",
+                   "05_inference", "benchmark_models", "pipeline", "corpus_store", "latex_normalize",
+                   "token_fertility", "adapter_pool", "model_loading", "dataset_cache", "generation_cache"]
+HEAVY_MODULES = ["torch", "transformers", "datasets", "trl", "peft", "unsloth", "pdfplumber", "pylatexenc",
+                 "bibtexparser", "requests"]
+
+IMPORT_PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - start,
+                  "heavy": sorted(m for m in json.loads(sys.argv[2]) if m in sys.modules)}))
+"""
+
+
+def import_time(module, repeats=3):
+    """Best-of-``repeats`` import time of ``module`` in a fresh interpreter, and the heavy modules it loaded."""
+    best = None
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", IMPORT_PROBE, module, json.dumps(HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def help_time(repeats=3):
+    """Best-of-``repeats`` wall time of ``python cli.py --help``, interpreter start-up included."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, __file__, "--help"], capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_startup(max_import_seconds=0.5, max_help_seconds=1.0, repeats=3):
+    """Print import times of STARTUP_MODULES and return the list of budget or heavy-import violations."""
+    failures = []
+    print(f"{'module':<26}  {'import ms':>9}  heavy dependencies loaded")
+    for module in STARTUP_MODULES:
+        result = import_time(module, repeats)
+        print(f"{module:<26}  {result['seconds'] * 1000:9.1f}  {', '.join(result['heavy']) or '-'}")
+        if result["heavy"]:
+            failures.append(f"{module} imports {', '.join(result['heavy'])} at module load")
+        if result["seconds"] > max_import_seconds:
+            failures.append(f"{module} takes {result['seconds']:.2f}s to import (budget {max_import_seconds:.2f}s)")
+    seconds = help_time(repeats)
+    print(f"{'cli.py --help (wall)':<26}  {seconds * 1000:9.1f}")
+    if seconds > max_help_seconds:
+        failures.append(f"cli.py --help takes {seconds:.2f}s (budget {max_help_seconds:.2f}s)")
+    return failures
+
+
+def main():
+    commands = "\n".join(f"  {name:<12} {description}" for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        description="Single entry point for the pipeline stages and tools",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"commands:\n{commands}\n  {'startup':<12} Check import times of the entry points\n\n"
+               "Arguments after the command go to it, e.g. 'python cli.py retrieval query \"transmon\"'.")
+    parser.add_argument("command", choices=list(COMMANDS) + ["startup"], metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if args.command == "startup":
+        startup = argparse.ArgumentParser(prog="cli.py startup", description="Guard start-up latency")
+        startup.add_argument("--max-import-seconds", type=float, default=0.5)
+        startup.add_argument("--max-help-seconds", type=float, default=1.0)
+        startup.add_argument("--repeats", type=int, default=3)
+        options = startup.parse_args(args.args)
+        failures = check_startup(options.max_import_seconds, options.max_help_seconds, options.repeats)
+        for failure in failures:
+            print(f"STARTUP REGRESSION: {failure}")
+        if failures:
+            sys.exit(1)
+        print("Start-up within budget.")
+        return
+
+    module_name, _ = COMMANDS[args.command]
+    sys.argv = [f"{module_name}.py"] + args.args
+    importlib.import_module(module_name).main()
+
+
+if __name__ == "__main__":
+    main()
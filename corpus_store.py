@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+CORPUS_STORE = Path("corpus.sqlite")
+METADATA_FIELDS = ("structure", "figures", "tables", "citations")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    reference TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    structure TEXT NOT NULL,
+    figures TEXT NOT NULL,
+    tables TEXT NOT NULL,
+    citations TEXT NOT NULL
+)
+"""
+
+
+class CorpusStore:
+    """Processed papers (text, structure, figures, tables, citations) in one sqlite file, keyed by reference.
+
+    A drop-in for the ``outputs/<reference>/{processed_text.md,metadata.json}``
+    layout: ``add`` buffers papers and writes them ``batch_size`` at a time in
+    one transaction, ``iter_papers`` streams them in reference order, and
+    ``get`` looks one up by id. Papers are returned in the
+    ``{'paper_id', 'content', 'metadata'}`` form DatasetPreparer uses.
+    """
+
+    def __init__(self, path=CORPUS_STORE, batch_size=500):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.pending = []
+        if self.path.parent != Path(""):
+            os.makedirs(self.path.parent, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        # WAL lets readers stream while a writer commits; NORMAL only fsyncs at checkpoints
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        self.flush()
+        return self.conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+
+    def __contains__(self, reference):
+        self.flush()
+        return self.conn.execute("SELECT 1 FROM papers WHERE reference = ?", (reference,)).fetchone() is not None
+
+    def add(self, reference, content, metadata):
+        """Queue a paper (replacing any earlier version); written with the next batch."""
+        self.pending.append((reference, content) + tuple(
+            json.dumps(metadata.get(field), ensure_ascii=False) for field in METADATA_FIELDS))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def delete(self, reference):
+        self.flush()
+        with self.conn:
+            self.conn.execute("DELETE FROM papers WHERE reference = ?", (reference,))
+
+    def references(self):
+        self.flush()
+        return [row[0] for row in self.conn.execute("SELECT reference FROM papers ORDER BY reference")]
+
+    def get(self, reference):
+        """The paper stored under ``reference``, or None."""
+        self.flush()
+        row = self.conn.execute("SELECT * FROM papers WHERE reference = ?", (reference,)).fetchone()
+        return self._paper(row) if row else None
+
+    def iter_papers(self, chunk_size=256):
+        """Yield every paper in reference order, holding only ``chunk_size`` rows in memory."""
+        self.flush()
+        cursor = self.conn.execute("SELECT * FROM papers ORDER BY reference")
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._paper(row)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    @staticmethod
+    def _paper(row):
+        reference, content = row[:2]
+        # Fields missing from the original metadata were stored as null and stay missing
+        metadata = {field: json.loads(value) for field, value in zip(METADATA_FIELDS, row[2:]) if value != "null"}
+        return {'paper_id': reference, 'content': content, 'metadata': metadata}
+
+
+def import_directory(outputs_dir, store):
+    """Copy every paper of an ``outputs/`` directory layout into ``store``; returns the number copied."""
+    count = 0
+    for paper_dir in sorted(Path(outputs_dir).iterdir()):
+        md_file = paper_dir / "processed_text.md"
+        metadata_file = paper_dir / "metadata.json"
+        if md_file.exists() and metadata_file.exists():
+            with open(md_file, 'r', encoding='utf-8') as f:
+                content = f.read()
+            with open(metadata_file, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            store.add(paper_dir.name, content, metadata)
+            count += 1
+    store.flush()
+    return count
+
+
+def synthetic_paper(rng, sections=8, paragraphs=5, citations=40):
+    """Random text and metadata roughly the size of a processed paper (~30 KB of Markdown)."""
+    words = [f"w{i}" for i in range(5000)]
+    structure, body = [], []
+    for s in range(sections):
+        title = f"Section {s}"
+        structure.append({"level": 1, "title": title})
+        body.append(f"## {title}")
+        for _ in range(paragraphs):
+            body.append(" ".join(rng.choices(words, k=120)))
+    metadata = {
+        "structure": structure,
+        "figures": {f"fig{i}": {"caption": " ".join(rng.choices(words, k=20))} for i in range(4)},
+        "tables": {f"tab{i}": {"caption": " ".join(rng.choices(words, k=20))} for i in range(2)},
+        "citations": {f"ref{i}": {"title": " ".join(rng.choices(words, k=10)), "author": "A. Author", "year": "2020"}
+                      for i in range(citations)},
+    }
+    return "\n\n".join(body), metadata
+
+
+def write_directory(outputs_dir, reference, content, metadata):
+    """Write one paper the way LatexProcessor.process_file_src does."""
+    output_dir = Path(outputs_dir) / reference
+    os.makedirs(output_dir, exist_ok=True)
+    with open(output_dir / "processed_text.md", 'w', encoding='utf-8') as f:
+        f.write(content)
+    with open(output_dir / "metadata.json", 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+
+
+def disk_usage(path):
+    """Allocated bytes (not apparent size) of a file or directory tree, and its number of files."""
+    paths = [Path(path)] if Path(path).is_file() else [p for p in Path(path).rglob("*") if p.is_file()]
+    return sum(p.stat().st_blocks * 512 for p in paths), len(paths)
+
+
+def benchmark(num_papers, lookups=1000, seed=3407):
+    """Compare write, full-scan and random-access time and disk usage of the two layouts."""
+    preparer_module = importlib.import_module("03_prepare_dataset")
+    rng = random.Random(seed)
+    template = [synthetic_paper(rng) for _ in range(50)] # Generating text should not dominate the timings
+    papers = [(f"{2100 + i // 100000}.{i % 100000:05d}",) + template[i % len(template)] for i in range(num_papers)]
+    ids = [rng.choice(papers)[0] for _ in range(lookups)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs_dir = Path(tmp) / "outputs"
+        store_path = Path(tmp) / "corpus.sqlite"
+        results = {}
+
+        start = time.perf_counter()
+        for reference, content, metadata in papers:
+            write_directory(outputs_dir, reference, content, metadata)
+        results["directory"] = {"write": time.perf_counter() - start}
+        start = time.perf_counter()
+        with CorpusStore(store_path) as store:
+            for reference, content, metadata in papers:
+                store.add(reference, content, metadata)
+        results["sqlite"] = {"write": time.perf_counter() - start}
+
+        start = time.perf_counter()
+        preparer = preparer_module.DatasetPreparer(outputs_dir, Path(tmp) / "dataset")
+        preparer.load_processed_papers()
+        results["directory"]["scan"] = time.perf_counter() - start
+        start = time.perf_counter()
+        with CorpusStore(store_path) as store:
+            preparer = preparer_module.DatasetPreparer(outputs_dir, Path(tmp) / "dataset", store=store)
+            preparer.load_processed_papers()
+        results["sqlite"]["scan"] = time.perf_counter() - start
+        del preparer
+
+        start = time.perf_counter()
+        for reference in ids:
+            with open(outputs_dir / reference / "processed_text.md", 'r', encoding='utf-8') as f:
+                f.read()
+            with open(outputs_dir / reference / "metadata.json", 'r', encoding='utf-8') as f:
+                json.load(f)
+        results["directory"]["lookup"] = time.perf_counter() - start
+        start = time.perf_counter()
+        with CorpusStore(store_path) as store:
+            for reference in ids:
+                store.get(reference)
+        results["sqlite"]["lookup"] = time.perf_counter() - start
+
+        for name, path in (("directory", outputs_dir), ("sqlite", store_path)):
+            results[name]["bytes"], results[name]["files"] = disk_usage(path)
+
+    print(f"{num_papers} papers, {lookups} random lookups (warm page cache)")
+    print(f"{'layout':>10}  {'write s':>8}  {'scan s':>8}  {'lookup ms':>9}  {'MiB':>8}  {'files':>7}")
+    for name, r in results.items():
+        print(f"{name:>10}  {r['write']:8.2f}  {r['scan']:8.2f}  {r['lookup'] / lookups * 1000:9.3f}  "
+              f"{r['bytes'] / 2**20:8.1f}  {r['files']:7d}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-file sqlite store for the processed papers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("import", help="Copy an outputs/ directory layout into a store")
+    migrate.add_argument("--outputs-dir", default="outputs")
+    migrate.add_argument("--store", default=str(CORPUS_STORE))
+    show = subparsers.add_parser("get", help="Print one paper")
+    show.add_argument("reference")
+    show.add_argument("--store", default=str(CORPUS_STORE))
+    bench = subparsers.add_parser("bench", help="Compare with the directory layout on synthetic papers")
+    bench.add_argument("--papers", type=int, default=10000)
+    bench.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        with CorpusStore(args.store) as store:
+            count = import_directory(args.outputs_dir, store)
+            print(f"Imported {count} papers into {args.store} ({len(store)} stored)")
+    elif args.command == "get":
+        with CorpusStore(args.store) as store:
+            paper = store.get(args.reference)
+        if paper is None:
+            print(f"{args.reference} not in {args.store}")
+        else:
+            print(json.dumps(paper["metadata"]["structure"], indent=2, ensure_ascii=False))
+            print(paper["content"])
+    elif args.command == "bench":
+        benchmark(args.papers, args.lookups)
+
+
+if __name__ == "__main__":
+    main()
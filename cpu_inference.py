@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import argparse
+import copy
+import resource
+import time
+import warnings
+
+import torch
+
+from model_loading import ADAPTER_DIR, MERGED_DIR, load_finetuned
+
+
+def configure_threads(num_threads=None):
+    """Set the intra-op thread count (None keeps torch's default of one per physical core)."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
+
+
+def quantize_int8(model):
+    """Dynamically quantize every ``nn.Linear`` (weights int8, activations quantized per batch) for CPU."""
+    from torch.ao.quantization import quantize_dynamic
+
+    with warnings.catch_warnings():
+        # Eager-mode quantization is deprecated in favour of torchao, which is not a dependency here
+        warnings.simplefilter("ignore")
+        return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def footprint_bytes(model):
+    """Bytes held by the state dict, including packed int8 weights, which are not parameters."""
+    seen = set()
+
+    def size(value):
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        if not isinstance(value, torch.Tensor):
+            return 0
+        key = id(value) if value.is_quantized else value.data_ptr()
+        if key in seen:
+            return 0
+        seen.add(key)
+        return value.numel() * value.element_size()
+
+    return sum(size(value) for value in model.state_dict().values())
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_cpu_model(adapter_dir=ADAPTER_DIR, merged_dir=MERGED_DIR, int8=True, num_threads=None):
+    """Load the fine-tuned model in fp32 on CPU, merged into plain linear layers, optionally int8-quantized.
+
+    Prefers the merged export (see export_merged.py); an adapter is merged
+    in memory so quantization sees ordinary ``nn.Linear`` layers.
+    """
+    threads = configure_threads(num_threads)
+    model, tokenizer = load_finetuned(adapter_dir, merged_dir, load_in_4bit=False, dtype=torch.float32)
+    return prepare_cpu_model(model, int8, threads), tokenizer
+
+
+def load_cpu_base(base_model, adapter_dir=None, int8=True, num_threads=None):
+    """Load a full-precision base (or 'tiny') in fp32 on CPU, merge ``adapter_dir`` into it if given, optionally int8.
+
+    Pre-quantized bitsandbytes checkpoints need CUDA, so ``base_model`` must
+    hold fp16/bf16/fp32 weights.
+    """
+    threads = configure_threads(num_threads)
+    if base_model == "tiny":
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer()
+    else:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        print(f"Loading base model on CPU: {base_model}")
+        model = AutoModelForCausalLM.from_pretrained(base_model, dtype=torch.float32)
+        tokenizer = AutoTokenizer.from_pretrained(str(adapter_dir) if adapter_dir is not None else base_model)
+    if adapter_dir is not None:
+        from peft import PeftModel
+        print(f"Merging adapter: {adapter_dir}")
+        model = PeftModel.from_pretrained(model, str(adapter_dir))
+    return prepare_cpu_model(model, int8, threads), tokenizer
+
+
+def prepare_cpu_model(model, int8, threads):
+    """Merge any PEFT adapter into plain linear layers, then optionally quantize them to int8."""
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+    model.eval()
+    if int8:
+        model = quantize_int8(model)
+    print(f"CPU model ready: {'int8 dynamic' if int8 else 'fp32'}, {threads} thread(s), "
+          f"{footprint_bytes(model) / 2**20:.1f} MiB weights")
+    return model
+
+
+def measure(model, tokenizer, prompts, batch_size, max_new_tokens):
+    """Generate all prompts and return the answers, generated tokens/sec and elapsed seconds."""
+    from generation import generate_all
+
+    stats = {}
+    start = time.perf_counter()
+    answers = generate_all(model, tokenizer, prompts, batch_size=batch_size, max_new_tokens=max_new_tokens, stats=stats)
+    elapsed = time.perf_counter() - start
+    return answers, stats["new_tokens"] / elapsed, elapsed
+
+
+def compare_fp32_int8(model, tokenizer, prompts, batch_size=4, max_new_tokens=32):
+    """Report weight footprint, tokens/sec and greedy agreement of the fp32 model and its int8 copy."""
+    int8_model = quantize_int8(copy.deepcopy(model))
+    results = {}
+    for name, candidate in (("fp32", model), ("int8", int8_model)):
+        measure(candidate, tokenizer, prompts[:1], 1, 4) # Warm up kernels and allocator
+        answers, tokens_per_sec, elapsed = measure(candidate, tokenizer, prompts, batch_size, max_new_tokens)
+        results[name] = {"footprint_mb": footprint_bytes(candidate) / 2**20, "tokens_per_sec": tokens_per_sec,
+                         "seconds": elapsed, "answers": answers}
+
+    agreement = sum(a == b for a, b in zip(results["fp32"]["answers"], results["int8"]["answers"])) / len(prompts)
+    print(f"{'':>6}  {'weights (MiB)':>14}  {'tokens/sec':>10}")
+    for name, r in results.items():
+        print(f"{name:>6}  {r['footprint_mb']:14.1f}  {r['tokens_per_sec']:10.1f}")
+    print(f"int8 vs fp32: {results['fp32']['footprint_mb'] / results['int8']['footprint_mb']:.2f}x smaller, "
+          f"{results['int8']['tokens_per_sec'] / results['fp32']['tokens_per_sec']:.2f}x tokens/sec, "
+          f"identical greedy answers for {agreement:.0%} of prompts")
+    print(f"Peak RSS: {peak_rss_mb():.0f} MiB, threads: {torch.get_num_threads()}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU inference with dynamic int8 quantization vs fp32")
+    parser.add_argument("--model", default=None, help="'tiny' for a random CPU Llama; defaults to the fine-tuned model")
+    parser.add_argument("--adapter-dir", default=ADAPTER_DIR)
+    parser.add_argument("--merged-dir", default=MERGED_DIR)
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads (default: torch's choice)")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=512, help="Tiny model width")
+    parser.add_argument("--layers", type=int, default=4, help="Tiny model depth")
+    args = parser.parse_args()
+
+    from benchmark_models import QUESTIONS, format_prompt
+
+    configure_threads(args.threads)
+    if args.model == "tiny":
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer(hidden_size=args.hidden_size, num_layers=args.layers)
+        model.eval()
+    else:
+        model, tokenizer = load_cpu_model(args.adapter_dir, args.merged_dir, int8=False)
+
+    compare_fp32_int8(model, tokenizer, [format_prompt(q) for q in QUESTIONS], args.batch_size, args.max_new_tokens)
+
+
+if __name__ == "__main__":
+    main()
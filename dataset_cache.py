@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+# Bump when the formatting/tokenization/packing code changes in a way that alters the cached rows
+PIPELINE_VERSION = 1
+
+
+def hash_file(path, digest=None, chunk_size=1 << 20):
+    """Feed the bytes of ``path`` into ``digest`` (a new sha256 if None) and return it."""
+    digest = digest or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash everything about a tokenizer that changes its output ids."""
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # Fast tokenizers serialise vocab, merges, normalizer and post-processor (BOS) in one string
+        digest.update(backend.to_str().encode('utf-8'))
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode('utf-8'))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprint_inputs(data_files, template, tokenizer, **settings):
+    """Return a content fingerprint of the data files, prompt template, tokenizer and settings."""
+    digest = hashlib.sha256()
+    digest.update(f"pipeline-v{PIPELINE_VERSION}".encode('utf-8'))
+    for path in data_files:
+        hash_file(path, digest)
+    digest.update(template.encode('utf-8'))
+    digest.update(tokenizer_fingerprint(tokenizer).encode('utf-8'))
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def load_or_build(cache_dir, fingerprint, build_fn):
+    """Load the dataset cached under ``fingerprint`` or build it with ``build_fn`` and save it.
+
+    The dataset is written to a temporary directory and renamed into place,
+    so an interrupted build never leaves a half-written cache entry behind.
+    """
+    from datasets import load_from_disk
+
+    cache_dir = Path(cache_dir)
+    target = cache_dir / fingerprint
+    if target.exists():
+        print(f"Loading cached dataset: {target}")
+        return load_from_disk(str(target))
+
+    dataset = build_fn()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = cache_dir / f".{fingerprint}.tmp"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    dataset.save_to_disk(str(tmp_dir))
+    os.replace(tmp_dir, target)
+    print(f"Cached dataset: {target}")
+
+    # Re-open from disk so the returned dataset is memory-mapped like a cache hit
+    return load_from_disk(str(target))
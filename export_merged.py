@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+from model_loading import (
+    ADAPTER_DIR,
+    FINGERPRINT_FILE,
+    MERGED_DIR,
+    adapter_fingerprint,
+    current_base_fingerprint,
+    load_finetuned,
+    merged_is_current,
+)
+
+DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+
+
+def merge_and_export(adapter_dir=ADAPTER_DIR, output_dir=MERGED_DIR, base_model=None,
+                     dtype="bfloat16", max_shard_size="2GB"):
+    """Fold the LoRA deltas into the base weights and save a standalone sharded safetensors checkpoint.
+
+    The base is loaded unquantized: merging into 4-bit weights would round
+    the deltas away. ``base_model`` overrides the base recorded in the adapter
+    config, e.g. to merge an adapter trained on a bnb-4bit base into the
+    full-precision weights.
+    """
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    adapter_dir = Path(adapter_dir)
+    output_dir = Path(output_dir)
+    with open(adapter_dir / "adapter_config.json", 'r', encoding='utf-8') as f:
+        adapter_config = json.load(f)
+    base_model = base_model or adapter_config["base_model_name_or_path"]
+
+    start = time.perf_counter()
+    print(f"Loading base model: {base_model}")
+    model = AutoModelForCausalLM.from_pretrained(base_model, torch_dtype=DTYPES[dtype], low_cpu_mem_usage=True)
+    # From the stored config, as merged_is_current re-resolves it (the loaded model's config records the load dtype)
+    base_print = current_base_fingerprint(base_model)
+    model = PeftModel.from_pretrained(model, str(adapter_dir))
+
+    print("Merging adapter into base weights...")
+    model = model.merge_and_unload()
+
+    # Write to a temporary directory first so a failed export never looks current
+    tmp_dir = output_dir.with_name(f".{output_dir.name}.tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    model.save_pretrained(str(tmp_dir), safe_serialization=True, max_shard_size=max_shard_size)
+    AutoTokenizer.from_pretrained(str(adapter_dir)).save_pretrained(str(tmp_dir))
+
+    record = {
+        "base_model": base_model,
+        "base_fingerprint": base_print,
+        "adapter_dir": str(adapter_dir),
+        "adapter_fingerprint": adapter_fingerprint(adapter_dir),
+        "dtype": dtype,
+        "max_shard_size": max_shard_size,
+    }
+    with open(tmp_dir / FINGERPRINT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(record, f, indent=2)
+
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    os.replace(tmp_dir, output_dir)
+
+    shards = sorted(p.name for p in output_dir.glob("*.safetensors"))
+    print(f"Exported merged model to {output_dir} ({len(shards)} shard(s)) in {time.perf_counter() - start:.1f}s")
+    return record
+
+
+def self_check():
+    """Export a tiny random Llama + LoRA on CPU and check the merged logits match the adapter's."""
+    from peft import LoraConfig, get_peft_model
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        model, tokenizer = build_tiny_model_and_tokenizer()
+        model.save_pretrained(str(tmp / "base"))
+        tokenizer.save_pretrained(str(tmp / "base"))
+
+        # Random (non-zero) LoRA B matrices so the merge actually changes the weights
+        lora = LoraConfig(task_type="CAUSAL_LM", r=8, lora_alpha=16, init_lora_weights=False,
+                          target_modules=["q_proj", "k_proj", "v_proj", "o_proj",
+                                          "gate_proj", "up_proj", "down_proj"])
+        peft_model = get_peft_model(model, lora)
+        peft_model.save_pretrained(str(tmp / "adapter"))
+        tokenizer.save_pretrained(str(tmp / "adapter"))
+
+        merge_and_export(tmp / "adapter", tmp / "merged", base_model=str(tmp / "base"),
+                         dtype="float32", max_shard_size="200KB")
+
+        merged, _ = load_finetuned(tmp / "adapter", tmp / "merged", load_in_4bit=False)
+        inputs = tokenizer(["Explain what a transmon is."], return_tensors="pt")
+        with torch.no_grad():
+            expected = peft_model(**inputs).logits
+            actual = merged(**inputs).logits
+        diff = (expected - actual).abs().max().item()
+        print(f"Merged model class: {type(merged).__name__}")
+        print(f"Max |adapter - merged| logit difference: {diff:.2e}")
+        if diff > 1e-4:
+            raise RuntimeError("Merged model does not reproduce the adapter model")
+
+        # Replacing the base weights (here: re-saving them in float16) must make the export stale
+        current_before = merged_is_current(tmp / "merged", tmp / "adapter")
+        base, _ = build_tiny_model_and_tokenizer()
+        base.half().save_pretrained(str(tmp / "base"))
+        current_after = merged_is_current(tmp / "merged", tmp / "adapter")
+        print(f"Export current before / after the base changed: {current_before} / {current_after}")
+        if not current_before or current_after:
+            raise RuntimeError("Merged export staleness does not follow the base model")
+        print("Merge verification passed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the LoRA adapter into the base model for fast inference loading")
+    parser.add_argument("--adapter-dir", default=ADAPTER_DIR)
+    parser.add_argument("--output-dir", default=MERGED_DIR)
+    parser.add_argument("--base-model", default=None, help="Full-precision base (defaults to the adapter's base)")
+    parser.add_argument("--dtype", default="bfloat16", choices=sorted(DTYPES))
+    parser.add_argument("--max-shard-size", default="2GB")
+    parser.add_argument("--self-check", action="store_true", help="Verify the merge on CPU with a tiny random model")
+    args = parser.parse_args()
+
+    if args.self_check:
+        self_check()
+        return
+
+    merge_and_export(args.adapter_dir, args.output_dir, args.base_model, args.dtype, args.max_shard_size)
+
+
+if __name__ == "__main__":
+    main()
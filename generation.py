@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+import torch
+
+
+def is_oom_error(error):
+    """True for CUDA out-of-memory errors (raised as OutOfMemoryError or a plain RuntimeError)."""
+    oom_type = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_type is not None and isinstance(error, oom_type):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+
+def decode_new_tokens(tokenizer, new_tokens, pad_token_id, stats=None):
+    """Decode generated ids; if ``stats`` is a dict, add the non-padding token count to ``stats["new_tokens"]``."""
+    if stats is not None:
+        stats["new_tokens"] = stats.get("new_tokens", 0) + int((new_tokens != pad_token_id).sum())
+    return [text.strip() for text in tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+
+def generate_batch(model, tokenizer, prompts, max_new_tokens=256, stats=None, **generate_kwargs):
+    """Greedy-decode a batch of prompts with left padding and return only the new text of each."""
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left" # Decoder-only models must continue right after the prompt
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    try:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    generate_kwargs.setdefault("do_sample", False)
+    with torch.inference_mode():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            pad_token_id=tokenizer.pad_token_id,
+            **generate_kwargs,
+        )
+
+    # Everything after the (padded) prompt width is newly generated
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+    return decode_new_tokens(tokenizer, new_tokens, tokenizer.pad_token_id, stats)
+
+
+def stream_batch(model, tokenizer, prompts, max_new_tokens=256, on_tokens=None):
+    """Greedy-decode a left-padded batch step by step, calling ``on_tokens(step, tokens)`` after each step.
+
+    ``tokens`` holds the new token id of every row, or None for rows that
+    already finished (EOS or their own entry of ``max_new_tokens``, which may
+    be a list). Produces the same tokens as ``generate_batch``; returns the
+    generated ids of each row.
+    """
+    if isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * len(prompts)
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    try:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
+    # generate() derives positions from the mask so left padding does not shift them; do the same
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    eos_token_ids = model.generation_config.eos_token_id
+    if eos_token_ids is None:
+        eos_token_ids = tokenizer.eos_token_id
+    eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids])
+
+    generated = [[] for _ in prompts]
+    finished = [limit <= 0 for limit in max_new_tokens]
+    past_key_values = None
+    step = 0
+    with torch.inference_mode():
+        while not all(finished):
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                            past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+            next_tokens = outputs.logits[:, -1].argmax(-1)
+
+            tokens = []
+            for row, token in enumerate(next_tokens.tolist()):
+                if finished[row]:
+                    tokens.append(None)
+                    continue
+                generated[row].append(token)
+                tokens.append(token)
+                finished[row] = token in eos_token_ids or len(generated[row]) >= max_new_tokens[row]
+            if on_tokens is not None:
+                on_tokens(step, tokens)
+            step += 1
+
+            # Finished rows keep decoding padding until the whole batch is done; their outputs are ignored
+            next_tokens = torch.tensor([t if t is not None else tokenizer.pad_token_id for t in tokens],
+                                       device=input_ids.device)
+            input_ids = next_tokens[:, None]
+            attention_mask = torch.cat([attention_mask, torch.ones_like(input_ids)], dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+    return generated
+
+
+def generate_all(model, tokenizer, prompts, batch_size=8, max_new_tokens=256, prefix_cache=None,
+                 prefix_key="default", stats=None, **generate_kwargs):
+    """Generate answers for all prompts in batches, halving the batch size on CUDA OOM.
+
+    Prompts are batched in order of length to keep padding low; answers are
+    returned in the original prompt order. With a ``prefix_cache``
+    (see prefix_cache.py) the shared prompt prefix is not prefilled again;
+    ``prefix_key`` selects the cache entry, e.g. one per adapter. A ``stats``
+    dict accumulates the number of generated tokens under ``"new_tokens"``.
+    """
+    order = sorted(range(len(prompts)), key=lambda i: len(tokenizer(prompts[i])["input_ids"]))
+    answers = [None] * len(prompts)
+
+    start = 0
+    while start < len(order):
+        batch_indices = order[start:start + batch_size]
+        try:
+            batch_prompts = [prompts[i] for i in batch_indices]
+            if prefix_cache is not None:
+                from prefix_cache import generate_with_prefix
+                batch_answers = generate_with_prefix(
+                    model, tokenizer, prefix_cache, batch_prompts, max_new_tokens, prefix_key, stats, **generate_kwargs)
+            else:
+                batch_answers = generate_batch(model, tokenizer, batch_prompts, max_new_tokens, stats,
+                                               **generate_kwargs)
+        except Exception as e:
+            if not is_oom_error(e) or batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+            print(f"Out of memory; retrying with batch size {batch_size}")
+            continue
+
+        for i, answer in zip(batch_indices, batch_answers):
+            answers[i] = answer
+        start += len(batch_indices)
+        print(f"Generated {start}/{len(prompts)}")
+
+    return answers
+
+
+def main():
+    """Check on CPU with a tiny random model that batched greedy decoding matches serial decoding."""
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    model, tokenizer = build_tiny_model_and_tokenizer()
+    prompts = [
+        "Explain what a transmon is.",
+        "Why are superconducting resonators useful?",
+        "Describe cross-entropy benchmarking in the characterization of multi-qubit processors.",
+        "What is a qubit?",
+        "Explain the circle fit of resonator transmission data in the complex plane.",
+    ]
+    serial = [generate_batch(model, tokenizer, [p], max_new_tokens=24)[0] for p in prompts]
+    batched = generate_all(model, tokenizer, prompts, batch_size=4, max_new_tokens=24)
+    mismatches = sum(s != b for s, b in zip(serial, batched))
+    print(f"Batched vs serial greedy mismatches: {mismatches}/{len(prompts)}")
+    if mismatches:
+        raise RuntimeError("Batched generation differs from serial greedy decoding")
+
+    streamed = [text.strip() for text in tokenizer.batch_decode(
+        stream_batch(model, tokenizer, prompts, max_new_tokens=24), skip_special_tokens=True)]
+    if streamed != serial:
+        raise RuntimeError("Step-wise streamed decoding differs from serial greedy decoding")
+    print("Batched generation verification passed.")
+
+
+if __name__ == "__main__":
+    main()
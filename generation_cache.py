@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import shutil
+import time
+from pathlib import Path
+
+from model_loading import adapter_fingerprint, base_fingerprint
+
+GENERATION_CACHE_DIR = Path("generation_cache")
+
+# Bump when generation.py / prefix_cache.py change in a way that alters the generated text
+GENERATION_VERSION = 1
+
+
+def model_fingerprint(config, adapter_dir=None, variant=None):
+    """Identify the weights an answer came from: the base model plus, optionally, one adapter.
+
+    ``variant`` names a transformation of those weights that changes the
+    answers, such as ``"cpu-int8"`` for dynamically quantized CPU models.
+    """
+    digest = hashlib.sha256()
+    digest.update(base_fingerprint(config).encode('utf-8'))
+    if adapter_dir is not None:
+        digest.update(adapter_fingerprint(adapter_dir).encode('utf-8'))
+    if variant is not None:
+        digest.update(variant.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def entry_key(prompt, system_prompt, params):
+    """Hash of everything besides the weights that determines a generated answer."""
+    record = {"version": GENERATION_VERSION, "prompt": prompt, "system_prompt": system_prompt, "params": params}
+    return hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class GenerationCache:
+    """Persistent prompt -> answer cache, one append-only JSONL file per model fingerprint.
+
+    Each ``<fingerprint>.jsonl`` has a ``<fingerprint>.json`` sidecar that
+    records which base model and adapter it belongs to, so entries can be
+    invalidated by adapter or base model from the command line.
+    """
+
+    def __init__(self, cache_dir=GENERATION_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.entries = {}
+        self.stats = {}
+
+    def _load(self, fingerprint):
+        if fingerprint not in self.entries:
+            entries = {}
+            path = self.cache_dir / f"{fingerprint}.jsonl"
+            if path.exists():
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue # Torn last line from an interrupted run
+                        entries[record["key"]] = record["response"]
+            self.entries[fingerprint] = entries
+        return self.entries[fingerprint]
+
+    def lookup(self, fingerprint, keys, arm="default"):
+        """Return the cached answer (or None) for each key and count hits and misses under ``arm``."""
+        entries = self._load(fingerprint)
+        answers = [entries.get(key) for key in keys]
+        stats = self.stats.setdefault(arm, {"hits": 0, "misses": 0})
+        stats["hits"] += sum(answer is not None for answer in answers)
+        stats["misses"] += sum(answer is None for answer in answers)
+        return answers
+
+    def store(self, fingerprint, keys, answers, meta):
+        """Append newly generated answers and write the fingerprint's sidecar on first use."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        meta_path = self.cache_dir / f"{fingerprint}.json"
+        if not meta_path.exists():
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({**meta, "created": time.time()}, f, indent=2)
+
+        entries = self._load(fingerprint)
+        with open(self.cache_dir / f"{fingerprint}.jsonl", 'a', encoding='utf-8') as f:
+            for key, answer in zip(keys, answers):
+                entries[key] = answer
+                f.write(json.dumps({"key": key, "response": answer}) + "\n")
+
+    def report(self):
+        """Print hits and misses per arm."""
+        for arm, stats in self.stats.items():
+            print(f"Generation cache [{arm}]: {stats['hits']} hits, {stats['misses']} misses")
+
+
+def cached_generate(cache, fingerprint, meta, prompts, system_prompt, params, generate_fn, arm="default"):
+    """Answer ``prompts`` from the cache and call ``generate_fn(missing_prompts)`` only for misses."""
+    keys = [entry_key(prompt, system_prompt, params) for prompt in prompts]
+    answers = cache.lookup(fingerprint, keys, arm)
+    missing = [i for i, answer in enumerate(answers) if answer is None]
+    if missing:
+        generated = generate_fn([prompts[i] for i in missing])
+        cache.store(fingerprint, [keys[i] for i in missing], generated, meta)
+        for i, answer in zip(missing, generated):
+            answers[i] = answer
+    return answers
+
+
+def list_entries(cache_dir):
+    """Sidecar metadata of every cached model, with its entry count."""
+    cache_dir = Path(cache_dir)
+    rows = []
+    for meta_path in sorted(cache_dir.glob("*.json")):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        data_path = meta_path.with_suffix(".jsonl")
+        count = sum(1 for _ in open(data_path, 'r', encoding='utf-8')) if data_path.exists() else 0
+        rows.append({"fingerprint": meta_path.stem, "entries": count, **meta})
+    return rows
+
+
+def invalidate(cache_dir, adapter=None, base_model=None):
+    """Delete the cache files of every model matching ``adapter`` and/or ``base_model``; return them."""
+    removed = []
+    for row in list_entries(cache_dir):
+        if adapter is not None and adapter not in (row.get("arm"), row.get("adapter_dir")):
+            continue
+        if base_model is not None and row.get("base_model") != base_model:
+            continue
+        for suffix in (".json", ".jsonl"):
+            path = Path(cache_dir) / f"{row['fingerprint']}{suffix}"
+            if path.exists():
+                path.unlink()
+        removed.append(row)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the benchmark generation cache")
+    parser.add_argument("--cache-dir", default=str(GENERATION_CACHE_DIR))
+    parser.add_argument("--adapter", help="Invalidate entries of this adapter (arm name or directory)")
+    parser.add_argument("--base-model", help="Invalidate entries generated from this base model")
+    parser.add_argument("--clear", action="store_true", help="Delete the whole cache")
+    args = parser.parse_args()
+
+    if args.clear:
+        if Path(args.cache_dir).exists():
+            shutil.rmtree(args.cache_dir)
+        print(f"Cleared {args.cache_dir}")
+        return
+
+    if args.adapter or args.base_model:
+        removed = invalidate(args.cache_dir, args.adapter, args.base_model)
+        for row in removed:
+            print(f"Removed {row['fingerprint']} ({row.get('arm')}, {row['entries']} entries)")
+        print(f"Invalidated {len(removed)} cached model(s)")
+        return
+
+    rows = list_entries(args.cache_dir)
+    for row in rows:
+        print(f"{row['fingerprint']}  {row['entries']:5d} entries  arm={row.get('arm')}  "
+              f"base={row.get('base_model')}  adapter={row.get('adapter_dir')}")
+    print(f"{len(rows)} cached model(s) in {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import bisect
+import importlib
+import json
+import time
+
+from adapter_pool import BASE_ADAPTER
+from generation import stream_batch
+
+# The inference script name starts with a digit, so it cannot be imported with a plain import statement
+inference = importlib.import_module("05_inference")
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+MAX_BODY_BYTES = 1 << 20
+
+
+class Histogram:
+    """Cumulative-bucket histogram rendered in the Prometheus text format."""
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Request:
+    """One pending generation: prompt, limits, adapter, timing and the queue its text chunks are streamed to."""
+
+    def __init__(self, prompt, max_new_tokens, adapter=None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.adapter = adapter
+        self.chunks = asyncio.Queue()
+        self.enqueued = time.perf_counter()
+        self.first_token = None
+        self.token_ids = []
+        self.text = ""
+
+
+class BatchingServer:
+    """Keeps one model resident and coalesces concurrent requests into batches.
+
+    The batcher waits for the first queued request, then up to
+    ``batch_window`` seconds for more (at most ``max_batch_size``), and decodes
+    the batch in a worker thread so the event loop keeps accepting and
+    streaming. Each generated token is pushed to its request's chunk queue.
+
+    With an ``adapter_pool`` (adapter_pool.AdapterPool) each request names
+    its adapter and a batch only holds requests for one adapter; requests for
+    other adapters wait, in arrival order, for a later batch.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, batch_window=0.02, max_new_tokens=256, adapter_pool=None,
+                 default_adapter=None):
+        self.model = model
+        self.adapter_pool = adapter_pool
+        self.default_adapter = default_adapter
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_new_tokens = max_new_tokens
+        self.queue = asyncio.Queue()
+        self.deferred = [] # Requests for another adapter than the batch being collected
+        self.in_flight = 0
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        self.time_to_first_token = Histogram(LATENCY_BUCKETS)
+        self.request_latency = Histogram(LATENCY_BUCKETS)
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.generated_tokens = 0
+
+    async def submit(self, prompt, max_new_tokens=None, adapter=None):
+        if self.adapter_pool is not None:
+            adapter = adapter or self.default_adapter or BASE_ADAPTER
+            if adapter not in self.adapter_pool:
+                raise ValueError(f"Unknown adapter '{adapter}'")
+        elif adapter is not None:
+            raise ValueError("This server has no adapter pool")
+        # One long request would hold its batch slot (and the whole batch) for the full generation
+        if max_new_tokens is not None and (isinstance(max_new_tokens, bool) or not isinstance(max_new_tokens, int)
+                                           or not 1 <= max_new_tokens <= self.max_new_tokens):
+            raise ValueError(f"'max_new_tokens' must be an integer from 1 to {self.max_new_tokens}")
+        request = Request(inference.formatted_text.format(prompt, ""), max_new_tokens or self.max_new_tokens, adapter)
+        await self.queue.put(request)
+        return request
+
+    async def next_batch(self):
+        batch = [self.deferred.pop(0) if self.deferred else await self.queue.get()]
+        for request in list(self.deferred):
+            if len(batch) < self.max_batch_size and request.adapter == batch[0].adapter:
+                batch.append(request)
+                self.deferred.remove(request)
+        deadline = asyncio.get_running_loop().time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if request.adapter == batch[0].adapter:
+                batch.append(request)
+            else:
+                self.deferred.append(request)
+        return batch
+
+    def _decode(self, batch, on_tokens):
+        """Worker-thread side: select the batch's adapter (loading it if needed) and decode."""
+        prompts = [r.prompt for r in batch]
+        max_new_tokens = [r.max_new_tokens for r in batch]
+        if self.adapter_pool is None:
+            return stream_batch(self.model, self.tokenizer, prompts, max_new_tokens, on_tokens)
+        with self.adapter_pool.select(batch[0].adapter, len(batch)):
+            return stream_batch(self.adapter_pool.model, self.tokenizer, prompts, max_new_tokens, on_tokens)
+
+    def _emit(self, request, token):
+        """Event-loop side of a decode step: decode incrementally and stream the new text."""
+        if request.first_token is None:
+            request.first_token = time.perf_counter()
+            self.time_to_first_token.observe(request.first_token - request.enqueued)
+        request.token_ids.append(token)
+        text = self.tokenizer.decode(request.token_ids, skip_special_tokens=True)
+        # Hold back incomplete multi-byte characters until the next token completes them
+        if not text.endswith("\ufffd") and len(text) > len(request.text):
+            request.chunks.put_nowait(text[len(request.text):])
+            request.text = text
+
+    def _finish(self, request, error=None):
+        self.request_latency.observe(time.perf_counter() - request.enqueued)
+        text = self.tokenizer.decode(request.token_ids, skip_special_tokens=True)
+        if error is None and len(text) > len(request.text):
+            request.chunks.put_nowait(text[len(request.text):]) # Flush any held-back partial character
+            request.text = text
+        request.chunks.put_nowait(error)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            self.in_flight = len(batch)
+            self.batch_sizes.observe(len(batch))
+            started = time.perf_counter()
+            for request in batch:
+                self.queue_wait.observe(started - request.enqueued)
+
+            def on_tokens(step, tokens):
+                for request, token in zip(batch, tokens):
+                    if token is not None:
+                        loop.call_soon_threadsafe(self._emit, request, token)
+
+            try:
+                generated = await loop.run_in_executor(None, self._decode, batch, on_tokens)
+                self.generated_tokens += sum(len(ids) for ids in generated)
+                error = None
+            except Exception as e:
+                error = RuntimeError(f"Generation failed: {e}")
+            # Queued after every token callback, so clients see all tokens before the end marker
+            for request in batch:
+                loop.call_soon_threadsafe(self._finish, request, error)
+            self.in_flight = 0
+
+    def metrics(self):
+        lines = [
+            "# HELP inference_queue_depth Requests waiting for a batch",
+            "# TYPE inference_queue_depth gauge",
+            f"inference_queue_depth {self.queue.qsize() + len(self.deferred)}",
+            "# HELP inference_in_flight Requests in the batch being decoded",
+            "# TYPE inference_in_flight gauge",
+            f"inference_in_flight {self.in_flight}",
+            "# HELP inference_generated_tokens_total Tokens generated since start",
+            "# TYPE inference_generated_tokens_total counter",
+            f"inference_generated_tokens_total {self.generated_tokens}",
+        ]
+        lines += self.queue_wait.render("inference_queue_wait_seconds", "Time from arrival to batch start")
+        lines += self.time_to_first_token.render("inference_time_to_first_token_seconds", "Time from arrival to first token")
+        lines += self.request_latency.render("inference_request_latency_seconds", "Time from arrival to last token")
+        lines += self.batch_sizes.render("inference_batch_size", "Requests per decoded batch")
+        if self.adapter_pool is not None:
+            lines += self.adapter_pool.metrics()
+        return "\n".join(lines) + "\n"
+
+
+async def read_request(reader):
+    """Parse one HTTP/1.1 request into ``(method, path, body bytes)``; raises ValueError on a bad Content-Length."""
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) < 2:
+        return None, None, b""
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get("content-length", "0")
+    if not length.isdigit() or int(length) > MAX_BODY_BYTES:
+        raise ValueError(f"Content-Length must be an integer from 0 to {MAX_BODY_BYTES}")
+    body = await reader.readexactly(int(length))
+    return request_line[0], request_line[1], body
+
+
+def write_response(writer, status, body, content_type="application/json"):
+    body = body.encode('utf-8')
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                 f"Connection: close\r\n\r\n".encode('latin-1') + body)
+
+
+def write_chunk(writer, data):
+    data = data.encode('utf-8')
+    writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+
+
+def parse_generate_request(body):
+    """Validate a ``POST /generate`` body; returns ``(prompt, max_new_tokens, adapter, stream)`` or raises ValueError."""
+    payload = json.loads(body or b"{}")
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a JSON object")
+    if not isinstance(payload.get("prompt"), str):
+        raise ValueError("'prompt' must be a string")
+    max_new_tokens = payload.get("max_new_tokens") # Range-checked by BatchingServer.submit
+    adapter = payload.get("adapter")
+    if adapter is not None and not isinstance(adapter, str):
+        raise ValueError("'adapter' must be a string")
+    return payload["prompt"], max_new_tokens, adapter, bool(payload.get("stream", False))
+
+
+async def handle_client(server, reader, writer):
+    """``POST /generate`` with ``{"prompt", "max_new_tokens", "stream", "adapter"}``; ``GET /metrics`` for Prometheus.
+
+    Malformed requests (bad Content-Length or body, ``max_new_tokens`` outside
+    1 to the server's limit) get ``400 Bad Request`` with ``{"error": ...}``.
+    Streaming responses are chunked NDJSON: ``{"token": text}`` lines, then
+    ``{"done": true, "response": ..., "ttft": ..., "latency": ...}``.
+    """
+    try:
+        try:
+            method, path, body = await read_request(reader)
+        except ValueError as e:
+            write_response(writer, "400 Bad Request", json.dumps({"error": str(e)}))
+            await writer.drain()
+            return
+        if method == "GET" and path == "/metrics":
+            write_response(writer, "200 OK", server.metrics(), "text/plain; version=0.0.4")
+        elif method == "POST" and path == "/generate":
+            try:
+                prompt, max_new_tokens, adapter, stream = parse_generate_request(body)
+                request = await server.submit(prompt, max_new_tokens, adapter)
+            except (ValueError, KeyError, TypeError) as e:
+                write_response(writer, "400 Bad Request", json.dumps({"error": str(e)}))
+                await writer.drain()
+                return
+            if stream:
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                             b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+            while True:
+                chunk = await request.chunks.get()
+                if chunk is None or isinstance(chunk, Exception):
+                    break
+                if stream:
+                    write_chunk(writer, json.dumps({"token": chunk}) + "\n")
+                    await writer.drain()
+
+            if isinstance(chunk, Exception):
+                result = {"error": str(chunk)}
+            else:
+                result = {
+                    "response": request.text.strip(),
+                    "new_tokens": len(request.token_ids),
+                    "ttft": request.first_token - request.enqueued if request.first_token else None,
+                    "latency": time.perf_counter() - request.enqueued,
+                }
+            if stream:
+                write_chunk(writer, json.dumps({"done": True, **result}) + "\n")
+                writer.write(b"0\r\n\r\n")
+            else:
+                write_response(writer, "500 Internal Server Error" if "error" in result else "200 OK",
+                               json.dumps(result))
+        else:
+            write_response(writer, "404 Not Found", json.dumps({"error": "not found"}))
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(model, tokenizer, host="127.0.0.1", port=8000, max_batch_size=8, batch_window=0.02,
+                max_new_tokens=256, adapter_pool=None, default_adapter=None):
+    """Start the batcher and the HTTP listener; returns ``(server, listener, batcher task)``."""
+    server = BatchingServer(model, tokenizer, max_batch_size, batch_window, max_new_tokens, adapter_pool,
+                            default_adapter)
+    batcher = asyncio.create_task(server.run())
+    listener = await asyncio.start_server(lambda r, w: handle_client(server, r, w), host, port)
+    return server, listener, batcher
+
+
+async def client_generate(host, port, prompt, max_new_tokens=None, stream=True, adapter=None):
+    """Minimal client: returns the streamed text chunks and the final record."""
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps({"prompt": prompt, "max_new_tokens": max_new_tokens, "stream": stream,
+                       "adapter": adapter}).encode('utf-8')
+    writer.write(f"POST /generate HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+
+    head, _, payload = raw.partition(b"\r\n\r\n")
+    if not stream:
+        return [], json.loads(payload)
+    # De-chunk, then split the NDJSON lines
+    data = b""
+    while payload:
+        size_line, _, payload = payload.partition(b"\r\n")
+        size = int(size_line, 16)
+        if size == 0:
+            break
+        data += payload[:size]
+        payload = payload[size + 2:]
+    records = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+    return [r["token"] for r in records if "token" in r], records[-1]
+
+
+async def post_raw(host, port, body, content_length=None):
+    """POST raw bytes to ``/generate``; returns ``(HTTP status code, parsed JSON body)``."""
+    reader, writer = await asyncio.open_connection(host, port)
+    content_length = len(body) if content_length is None else content_length
+    writer.write(f"POST /generate HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {content_length}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    head, _, payload = raw.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(payload)
+
+
+# Malformed /generate bodies that must get a 400 instead of a dropped connection
+BAD_REQUESTS = [b"{not json", b"[1, 2]", b'"prompt"', b"{}", b'{"prompt": 42}', b'{"prompt": "hi", "max_new_tokens": 0}',
+                b'{"prompt": "hi", "max_new_tokens": "many"}', b'{"prompt": "hi", "max_new_tokens": 100000}',
+                b'{"prompt": "hi", "adapter": "resonators"}']
+BAD_CONTENT_LENGTHS = ["abc", "-5", str(MAX_BODY_BYTES + 1)]
+
+
+async def self_check():
+    """Serve a tiny CPU model, fire concurrent streaming clients and compare with serial greedy decoding.
+
+    Also checks that malformed requests are rejected with 400 and do not disturb the server.
+    """
+    from generation import generate_batch
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    model, tokenizer = build_tiny_model_and_tokenizer()
+    model.eval()
+    prompts = [
+        "What is a qubit?",
+        "Explain what a transmon is.",
+        "Describe cross-entropy benchmarking in the characterization of multi-qubit processors.",
+        "Why are superconducting resonators useful?",
+        "Explain the circle fit of resonator transmission data in the complex plane.",
+    ]
+    server, listener, batcher = await serve(model, tokenizer, port=0, max_batch_size=4, batch_window=0.05,
+                                            max_new_tokens=16)
+    port = listener.sockets[0].getsockname()[1]
+
+    rejected = 0
+    for body in BAD_REQUESTS:
+        status, response = await post_raw("127.0.0.1", port, body)
+        rejected += status == 400 and "error" in response
+    for content_length in BAD_CONTENT_LENGTHS:
+        status, response = await post_raw("127.0.0.1", port, b'{"prompt": "hi"}', content_length)
+        rejected += status == 400 and "error" in response
+    results = await asyncio.gather(*(client_generate("127.0.0.1", port, p, stream=i % 2 == 0)
+                                     for i, p in enumerate(prompts)))
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    metrics = (await reader.read()).decode('utf-8')
+    writer.close()
+    batcher.cancel()
+    listener.close()
+    await listener.wait_closed()
+
+    expected = [generate_batch(model, tokenizer, [inference.formatted_text.format(p, "")], max_new_tokens=16)[0]
+                for p in prompts]
+    mismatches = 0
+    for (chunks, final), answer in zip(results, expected):
+        if final["response"] != answer or (chunks and "".join(chunks).strip() != answer):
+            mismatches += 1
+    print(f"Batches decoded: {server.batch_sizes.count} for {len(prompts)} requests")
+    print(f"Median TTFT: {sorted(final['ttft'] for _, final in results)[len(results) // 2]:.3f}s")
+    print("\n".join(line for line in metrics.splitlines() if line.startswith("inference_batch_size_")))
+    print(f"Server vs serial greedy mismatches: {mismatches}/{len(prompts)}")
+    print(f"Malformed requests rejected with 400: {rejected}/{len(BAD_REQUESTS) + len(BAD_CONTENT_LENGTHS)}")
+    if mismatches or server.batch_sizes.count >= len(prompts):
+        raise RuntimeError("Server output differs from serial decoding or requests were not batched")
+    if rejected != len(BAD_REQUESTS) + len(BAD_CONTENT_LENGTHS):
+        raise RuntimeError("A malformed request was not answered with 400 Bad Request")
+    print("Inference server verification passed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fine-tuned model over HTTP with dynamic batching")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default=None, help="'tiny' for a CPU smoke run; defaults to the fine-tuned model")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--batch-window-ms", type=float, default=20, help="How long to wait for more requests")
+    parser.add_argument("--max-new-tokens", type=int, default=256, help="Default and upper limit per request")
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="Serve this adapter on top of --base-model (repeatable); requests pick one by name")
+    parser.add_argument("--base-model", default="unsloth/meta-llama-3.1-8b-unsloth-bnb-4bit",
+                        help="Base model shared by the --adapter adapters")
+    parser.add_argument("--max-adapters", type=int, default=4, help="Adapters kept resident (least recently used "
+                                                                    "are evicted)")
+    parser.add_argument("--default-adapter", default=None, help="Adapter for requests that name none "
+                                                                "(default: the base model)")
+    parser.add_argument("--self-check", action="store_true", help="Verify batching and streaming with a tiny CPU model")
+    args = parser.parse_args()
+
+    if args.self_check:
+        asyncio.run(self_check())
+        return
+
+    adapter_pool = None
+    if args.adapter:
+        from adapter_pool import AdapterPool
+        from model_loading import load_base_with_adapters
+        adapters = dict(spec.split("=", 1) for spec in args.adapter)
+        # Only the base is loaded here; adapters are loaded on first request
+        model, tokenizer = load_base_with_adapters(args.base_model, {}, load_in_4bit=True, device_map="auto")
+        adapter_pool = AdapterPool(model, adapters, args.max_adapters)
+        if (args.default_adapter or BASE_ADAPTER) not in adapter_pool:
+            parser.error(f"--default-adapter {args.default_adapter} is not one of the --adapter names")
+    elif args.model == "tiny":
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer()
+    else:
+        model, tokenizer = inference.load_model()
+    model.eval()
+
+    async def run():
+        _, listener, batcher = await serve(model, tokenizer, args.host, args.port, args.max_batch_size,
+                                           args.batch_window_ms / 1000, args.max_new_tokens, adapter_pool,
+                                           args.default_adapter)
+        print(f"Serving on http://{args.host}:{args.port} (POST /generate, GET /metrics)")
+        async with listener:
+            await asyncio.gather(listener.serve_forever(), batcher)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
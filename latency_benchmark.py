@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import argparse
+import json
+import sys
+import time
+from contextlib import nullcontext
+
+from benchmark_models import QUESTIONS, format_prompt
+from generation import stream_batch
+
+LATENCY_REPORT = "latency_report.json"
+
+
+def percentile(values, q):
+    """Linear-interpolated percentile of ``values`` (q in 0-100)."""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None, "n": len(values)}
+
+
+def make_prompt(tokenizer, target_tokens, offset=0):
+    """A benchmark-format prompt grown from the benchmark questions to about ``target_tokens`` tokens."""
+    words = " ".join(QUESTIONS[offset % len(QUESTIONS):] + QUESTIONS[:offset % len(QUESTIONS)]).split()
+    text = ""
+    i = 0
+    while len(tokenizer(format_prompt(text))["input_ids"]) < target_tokens:
+        text = f"{text} {words[i % len(words)]}".strip()
+        i += 1
+    return format_prompt(text)
+
+
+def resolve_prompt_lengths(tokenizer, prompt_lengths, max_overshoot=0.25):
+    """Drop targets that build the same prompt as an earlier one, warning about targets below the template floor.
+
+    ``make_prompt`` cannot go below the fixed template plus one word, so
+    every short target produces the same prompt; measuring each of them
+    would give duplicate rows under different labels.
+    """
+    kept = {}
+    for target in prompt_lengths:
+        actual = len(tokenizer(make_prompt(tokenizer, target))["input_ids"])
+        if actual in kept:
+            print(f"Warning: prompt length {target} builds the same {actual}-token prompt as {kept[actual]}; skipped")
+            continue
+        if actual > target * (1 + max_overshoot):
+            print(f"Warning: prompt length {target} is below the {actual}-token minimum of the prompt template; "
+                  f"measuring {actual} tokens")
+        kept[actual] = target
+    return list(kept.values())
+
+
+def time_batch(model, tokenizer, prompts, max_new_tokens):
+    """Stream one batch and return its time to first token and the gaps between later decode steps."""
+    step_times = []
+    start = time.perf_counter()
+    stream_batch(model, tokenizer, prompts, max_new_tokens, lambda step, tokens: step_times.append(time.perf_counter()))
+    ttft = step_times[0] - start
+    inter_token = [b - a for a, b in zip(step_times, step_times[1:])]
+    return ttft, inter_token, len(step_times)
+
+
+def benchmark_arm(model, tokenizer, prompt_lengths, batch_sizes, max_new_tokens, repeats, warmup=1):
+    """Latency percentiles for every (prompt length, batch size) pair."""
+    results = []
+    for prompt_tokens in prompt_lengths:
+        for batch_size in batch_sizes:
+            prompts = [make_prompt(tokenizer, prompt_tokens, offset=i) for i in range(batch_size)]
+            # The fixed template sets a floor, so record what was actually measured
+            actual_tokens = max(len(tokenizer(p)["input_ids"]) for p in prompts)
+            for _ in range(warmup):
+                time_batch(model, tokenizer, prompts, max_new_tokens)
+
+            ttfts, inter_token, steps, total = [], [], 0, 0.0
+            for _ in range(repeats):
+                start = time.perf_counter()
+                ttft, gaps, n = time_batch(model, tokenizer, prompts, max_new_tokens)
+                total += time.perf_counter() - start
+                ttfts.append(ttft)
+                inter_token.extend(gaps)
+                steps += n
+            results.append({
+                "prompt_tokens": prompt_tokens,
+                "batch_size": batch_size,
+                "actual_prompt_tokens": actual_tokens,
+                "ttft": summarize(ttfts),
+                "inter_token": summarize(inter_token),
+                "tokens_per_sec": steps * batch_size / total if total else 0.0,
+            })
+            print(f"  prompt {actual_tokens:5d} tok, batch {batch_size:3d}: "
+                  f"TTFT p50 {results[-1]['ttft']['p50'] * 1000:8.1f} ms, "
+                  f"ITL p50 {results[-1]['inter_token']['p50'] * 1000:7.2f} ms "
+                  f"p99 {results[-1]['inter_token']['p99'] * 1000:7.2f} ms")
+    return results
+
+
+def load_arms(model_name, adapters):
+    """Return ``(model, tokenizer, {arm name: context manager that selects it})``."""
+    if model_name == "tiny":
+        from peft import LoraConfig, get_peft_model
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer()
+        # Random LoRA weights so the adapter arm does the same extra matmuls as a trained adapter
+        model = get_peft_model(model, LoraConfig(task_type="CAUSAL_LM", r=16, init_lora_weights=False,
+                                                 target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]))
+        adapters = {"default": None}
+    else:
+        from model_loading import load_base_with_adapters
+        model, tokenizer = load_base_with_adapters(model_name, adapters, load_in_4bit=True, device_map="auto")
+    model.eval()
+
+    def select(name):
+        model.set_adapter(name)
+        return nullcontext()
+
+    arms = {"Base Model": model.disable_adapter}
+    for name in adapters:
+        arms[name] = lambda name=name: select(name)
+    return model, tokenizer, arms
+
+
+def print_side_by_side(report):
+    """One row per (prompt length, batch size) with every arm's p50 TTFT / inter-token latency in ms."""
+    arms = list(report["arms"])
+    print("prompt  batch  " + "  ".join(f"{arm[:24]:>24}" for arm in arms))
+    for i, row in enumerate(report["arms"][arms[0]]):
+        cells = []
+        for arm in arms:
+            other = report["arms"][arm][i]
+            cells.append(f"{other['ttft']['p50'] * 1000:10.1f} / {other['inter_token']['p50'] * 1000:7.2f} ms")
+        print(f"{row['actual_prompt_tokens']:6d}  {row['batch_size']:5d}  " + "  ".join(f"{c:>24}" for c in cells))
+
+
+def compare(report, baseline, max_regression):
+    """Regressions of p50 TTFT and inter-token latency beyond ``max_regression`` (a fraction) vs ``baseline``."""
+    failures = []
+    for arm, rows in report["arms"].items():
+        baseline_rows = {(r["prompt_tokens"], r["batch_size"]): r for r in baseline["arms"].get(arm, [])}
+        for row in rows:
+            old = baseline_rows.get((row["prompt_tokens"], row["batch_size"]))
+            if old is None:
+                continue
+            for metric in ("ttft", "inter_token"):
+                if row[metric]["p50"] > old[metric]["p50"] * (1 + max_regression):
+                    failures.append(f"{arm} prompt={row['prompt_tokens']} batch={row['batch_size']} {metric} "
+                                    f"p50 {old[metric]['p50'] * 1000:.2f} -> {row[metric]['p50'] * 1000:.2f} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure time-to-first-token and inter-token latency")
+    parser.add_argument("--base-model", default="unsloth/meta-llama-3.1-8b-unsloth-bnb-4bit",
+                        help="Base model, or 'tiny' for a CPU run with a random adapter")
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="Adapter to compare (repeatable); defaults to fine_tuned=lora_model")
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=LATENCY_REPORT)
+    parser.add_argument("--baseline", help="Earlier report to compare against; exits non-zero on regressions")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed p50 slowdown vs the baseline")
+    args = parser.parse_args()
+
+    adapters = dict(spec.split("=", 1) for spec in args.adapter) or {"fine_tuned": "lora_model"}
+    model, tokenizer, arms = load_arms(args.base_model, adapters)
+    prompt_lengths = resolve_prompt_lengths(tokenizer, args.prompt_lengths)
+
+    report = {
+        "base_model": args.base_model,
+        "adapters": adapters if args.base_model != "tiny" else {"default": "random LoRA"},
+        "max_new_tokens": args.max_new_tokens,
+        "repeats": args.repeats,
+        "arms": {},
+    }
+    for arm, select in arms.items():
+        print(f"=== {arm} ===")
+        with select():
+            report["arms"][arm] = benchmark_arm(model, tokenizer, prompt_lengths, args.batch_sizes,
+                                                args.max_new_tokens, args.repeats)
+
+    print_side_by_side(report)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Latency report saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            failures = compare(report, json.load(f), args.max_regression)
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        if failures:
+            sys.exit(1)
+        print("No latency regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
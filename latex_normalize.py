@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+import argparse
+import re
+
+# Macro definitions in the preamble (or anywhere in the file)
+NEWCOMMAND_PATTERN = re.compile(r'\\(?:re)?newcommand\*?|\\providecommand\*?')
+DEF_PATTERN = re.compile(r'\\def\s*\\([A-Za-z]+)((?:#\d)*)\s*(?=\{)')
+OPERATOR_PATTERN = re.compile(r'\\DeclareMathOperator(\*?)\s*')
+CONTROL_WORD = re.compile(r'\\([A-Za-z]+)(?![A-Za-z])')
+
+# Math segments in raw LaTeX, delimiters included
+MATH_PATTERN = re.compile(
+    r'\$\$.+?\$\$|(?<!\\)\$.+?(?<!\\)\$|\\\[.+?\\\]|\\\(.+?\\\)'
+    r'|\\begin\{(equation|align|eqnarray|multline|gather|alignat)(\*?)\}.+?\\end\{\1\2\}',
+    re.DOTALL)
+
+TRAILING_CONTROL_WORD = re.compile(r'\\[A-Za-z]+$')
+
+
+def separated(replacement):
+    """Wrap a replacement so it cannot fuse with a preceding control word: "\\int\\!dx" must not become "\\intdx"."""
+    def replace(match):
+        text = match.expand(replacement)
+        following = (text + match.string[match.end():])[:1]
+        if following.isalpha() and TRAILING_CONTROL_WORD.search(match.string, 0, match.start()):
+            return ' ' + text
+        return text
+    return replace
+
+
+# Canonicalization rules applied inside math: (name, pattern, replacement). Order matters: sizing
+# delimiters with an empty "." go before the general rule, braces are stripped last. Rules that
+# delete a command or unwrap a letter use ``separated`` so the result stays a separate token.
+MATH_RULES = [
+    ("sizing", re.compile(r'\\(?:left|right|[Bb]igg?[lrm]?)\s*\.'), separated('')),
+    ("sizing", re.compile(r'\\(?:left|right|[Bb]igg?[lrm]?)(?![A-Za-z])\s*'), separated('')),
+    ("spacing", re.compile(r'(?<!\\)\\!'), separated('')),
+    ("spacing", re.compile(r'(?<!\\)\\[,;:]|\\q?quad(?![A-Za-z])|\\[hv]space\*?\{[^}]*\}|~'), ' '),
+    ("style", re.compile(r'\\(?:displaystyle|textstyle|scriptstyle|nonumber|notag)(?![A-Za-z])\s*'), separated('')),
+    ("labels", re.compile(r'\\label\{[^}]*\}'), separated('')),
+    ("fonts", re.compile(r'\\(?:mathrm|rm|mathit)\s*\{\s*([A-Za-z0-9])\s*\}'), separated(r'\1')),
+    ("fractions", re.compile(r'\\[dt]frac(?![A-Za-z])'), r'\\frac'),
+    ("primes", re.compile(r"\^\{\s*((?:\\prime\s*)+)\}|\^\\prime(?![A-Za-z])"),
+     lambda m: "'" * (m.group(1).count("\\prime") if m.group(1) else 1)),
+    ("braces", re.compile(r'([_^])\{\s*([A-Za-z0-9])\s*\}'), r'\1\2'),
+    # A control word keeps its braces before a letter: "^{\mu}x" must not become "^\mux"
+    ("braces", re.compile(r'([_^])\{\s*(\\[A-Za-z]+)\s*\}(?![A-Za-z])'), r'\1\2'),
+    ("whitespace", re.compile(r'[ \t]{2,}'), ' '),
+]
+
+
+def skip_spaces(text, i):
+    while i < len(text) and text[i] in ' \t\n':
+        i += 1
+    return i
+
+
+def read_group(text, i):
+    """Return ``(content, end)`` of the balanced ``{...}`` group at ``text[i]`` (after spaces), or ``(None, i)``."""
+    j = skip_spaces(text, i)
+    if j >= len(text) or text[j] != '{':
+        return None, i
+    depth = 0
+    k = j
+    while k < len(text):
+        if text[k] == '\\':
+            k += 2
+            continue
+        if text[k] == '{':
+            depth += 1
+        elif text[k] == '}':
+            depth -= 1
+            if depth == 0:
+                return text[j + 1:k], k + 1
+        k += 1
+    return None, i
+
+
+def read_optional(text, i):
+    """Return ``(content, end)`` of a ``[...]`` argument at ``text[i]`` (after spaces), or ``(None, i)``."""
+    j = skip_spaces(text, i)
+    if j >= len(text) or text[j] != '[':
+        return None, i
+    end = text.find(']', j)
+    return (text[j + 1:end], end + 1) if end != -1 else (None, i)
+
+
+def read_argument(text, i):
+    """A TeX macro argument: a brace group, a control word or a single character."""
+    j = skip_spaces(text, i)
+    if j >= len(text):
+        return None, i
+    if text[j] == '{':
+        return read_group(text, j)
+    if text[j] == '\\':
+        match = CONTROL_WORD.match(text, j)
+        end = match.end() if match else j + 2
+        return text[j:end], end
+    return text[j], j + 1
+
+
+def parse_macros(content):
+    """Find user macro definitions; returns ``({name: (num_args, default or None, body)}, [(start, end)])``.
+
+    Handles ``\\newcommand``/``\\renewcommand``/``\\providecommand`` (with an
+    optional default first argument), parameterless or ``#1#2`` style ``\\def``
+    and ``\\DeclareMathOperator``. Definitions that cannot be parsed are left alone.
+    """
+    macros = {}
+    spans = []
+    for match in NEWCOMMAND_PATTERN.finditer(content):
+        i = match.end()
+        name, i = read_group(content, i)
+        if name is None:
+            word = CONTROL_WORD.match(content, skip_spaces(content, match.end()))
+            if not word:
+                continue
+            name, i = word.group(0), word.end()
+        name = name.strip()
+        if not CONTROL_WORD.fullmatch(name):
+            continue
+        num_args, i = read_optional(content, i)
+        default, i = read_optional(content, i) if num_args else (None, i)
+        body, end = read_group(content, i)
+        if body is None or (num_args and not num_args.strip().isdigit()):
+            continue
+        macros[name[1:]] = (int(num_args) if num_args else 0, default, body.strip())
+        spans.append((match.start(), end))
+
+    for match in DEF_PATTERN.finditer(content):
+        body, end = read_group(content, match.end())
+        if body is not None:
+            macros[match.group(1)] = (len(match.group(2)) // 2, None, body.strip())
+            spans.append((match.start(), end))
+
+    for match in OPERATOR_PATTERN.finditer(content):
+        name, i = read_group(content, match.end())
+        if name is None:
+            word = CONTROL_WORD.match(content, match.end())
+            if not word:
+                continue
+            name, i = word.group(0), word.end()
+        body, end = read_group(content, i)
+        if body is not None and CONTROL_WORD.fullmatch(name.strip()):
+            macros[name.strip()[1:]] = (0, None, f"\\operatorname{match.group(1)}{{{body.strip()}}}")
+            spans.append((match.start(), end))
+    return macros, sorted(spans)
+
+
+def remove_spans(content, spans):
+    """Drop the (sorted, possibly nested) character spans from ``content``."""
+    pieces = []
+    last = 0
+    for start, end in spans:
+        if start >= last:
+            pieces.append(content[last:start])
+            last = end
+    pieces.append(content[last:])
+    return ''.join(pieces)
+
+
+def expand_macros(content, macros, max_passes=10):
+    """Replace uses of user macros with their bodies; returns ``(content, number of expansions)``.
+
+    Nested macros are expanded over several passes; self-referential ones
+    stop after ``max_passes``. A use whose arguments cannot be read is kept.
+    """
+    expansions = 0
+    for _ in range(max_passes):
+        pieces = []
+        last = 0
+        changed = False
+        for match in CONTROL_WORD.finditer(content):
+            if match.start() < last or match.group(1) not in macros:
+                continue
+            if match.start() > 0 and content[match.start() - 1] == '\\':
+                continue # "\\name" is a line break followed by text
+            num_args, default, body = macros[match.group(1)]
+            args = []
+            i = match.end()
+            if default is not None:
+                optional, i = read_optional(content, i)
+                args.append(default if optional is None else optional)
+            while len(args) < num_args:
+                arg, i = read_argument(content, i)
+                if arg is None:
+                    break
+                args.append(arg)
+            if len(args) < num_args:
+                continue
+            expanded = re.sub(r'#(\d)', lambda m: args[int(m.group(1)) - 1] if int(m.group(1)) <= len(args) else m.group(0),
+                              body)
+            # Keep "\alpha" + "x" from fusing into "\alphax"
+            if re.search(r'\\[A-Za-z]+$', expanded) and i < len(content) and content[i].isalpha():
+                expanded += ' '
+            pieces.append(content[last:match.start()])
+            pieces.append(expanded)
+            last = i
+            expansions += 1
+            changed = True
+        pieces.append(content[last:])
+        content = ''.join(pieces)
+        if not changed:
+            break
+    return content, expansions
+
+
+def normalize_math(math, stats=None):
+    """Apply MATH_RULES to one math segment, counting rewrites per rule in ``stats``."""
+    for name, pattern, replacement in MATH_RULES:
+        math, count = pattern.subn(replacement, math)
+        if stats is not None and count:
+            stats[name] = stats.get(name, 0) + count
+    return math
+
+
+def normalize_latex(content):
+    """Expand user macros and canonicalize math in a LaTeX document; returns ``(content, stats)``.
+
+    Macro definitions are removed once expanded, so the output no longer
+    depends on the preamble. Text outside math is only touched by macro
+    expansion.
+    """
+    stats = {"chars_before": len(content)}
+    macros, spans = parse_macros(content)
+    content = remove_spans(content, spans)
+    content, stats["macro_expansions"] = expand_macros(content, macros)
+    stats["macros"] = len(macros)
+
+    segments = 0
+
+    def replace(match):
+        nonlocal segments
+        segments += 1
+        return normalize_math(match.group(0), stats)
+
+    content = MATH_PATTERN.sub(replace, content)
+    stats["math_segments"] = segments
+    stats["chars_after"] = len(content)
+    return content, stats
+
+
+# (math segment, expected normalization) pairs checked by --self-check
+SELF_CHECK_CASES = [
+    (r"$e^{\mu}x$", r"$e^{\mu}x$"),
+    (r"$x_{\alpha}b$", r"$x_{\alpha}b$"),
+    (r"$e^{\mu} + x_{\alpha}$", r"$e^\mu + x_\alpha$"),
+    (r"$f^{\prime\prime}(x)$", "$f''(x)$"),
+    (r"$f^{\prime}(x) + g^\prime$", "$f'(x) + g'$"),
+    (r"$\left( \dfrac{a}{b_{i}} \right)$", r"$( \frac{a}{b_i} )$"),
+    (r"$\int\!dx$", r"$\int dx$"),
+    (r"$\int\!\mathrm{d}x$", r"$\int dx$"),
+    (r"$\hbar\mathrm{d}t$", r"$\hbar dt$"),
+    (r"$\alpha\displaystyle x$", r"$\alpha x$"),
+    (r"$f(x)\!\mathrm{d}x + \mathrm{e}^{x}$", r"$f(x)dx + e^x$"),
+]
+
+
+def self_check():
+    """Normalize SELF_CHECK_CASES and fail on any output that differs from the expected one."""
+    failures = 0
+    for math, expected in SELF_CHECK_CASES:
+        result = normalize_math(math)
+        if result != expected:
+            failures += 1
+            print(f"FAIL {math!r}: got {result!r}, expected {expected!r}")
+    print(f"Math normalization cases failed: {failures}/{len(SELF_CHECK_CASES)}")
+    if failures:
+        raise RuntimeError("Math normalization changed the meaning or structure of a formula")
+    print("LaTeX normalization verification passed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expand user macros and canonicalize math in a .tex file")
+    parser.add_argument("tex_file", nargs="?")
+    parser.add_argument("--self-check", action="store_true", help="Verify the math rules on known formulas")
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+        return
+    if args.tex_file is None:
+        parser.error("tex_file is required unless --self-check is given")
+    with open(args.tex_file, 'r', encoding='utf-8', errors='ignore') as f:
+        content, stats = normalize_latex(f.read())
+    print(content)
+    print(f"% {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+import argparse
+import json
+import random
+
+from torch.utils.data import DataLoader
+
+
+class LengthGroupedBatchSampler:
+    """Yield batches of similar-length examples while staying random across epochs.
+
+    Each epoch the indices are shuffled, cut into windows of ``shuffle_window``
+    batches, sorted by length inside each window and split into batches. The
+    batch order is then shuffled again so long and short batches interleave.
+    A larger window groups lengths more tightly; a window of 1 is plain
+    random batching.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle_window=64, seed=3407, drop_last=False):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.shuffle_window = max(1, shuffle_window)
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Select the shuffle for ``epoch`` (called by the trainer/accelerate)."""
+        self.epoch = epoch
+
+    def batches(self, epoch):
+        """Return the list of index batches for ``epoch``."""
+        rng = random.Random(self.seed + epoch)
+        indices = list(range(len(self.lengths)))
+        rng.shuffle(indices)
+
+        window_size = self.shuffle_window * self.batch_size
+        batches = []
+        for start in range(0, len(indices), window_size):
+            window = sorted(indices[start:start + window_size], key=lambda i: self.lengths[i])
+            for b in range(0, len(window), self.batch_size):
+                batch = window[b:b + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        # Advance on our own in case nobody calls set_epoch between epochs
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def random_batches(num_examples, batch_size, seed=3407):
+    """Plain shuffled batching, as the default trainer sampler does."""
+    rng = random.Random(seed)
+    indices = list(range(num_examples))
+    rng.shuffle(indices)
+    return [indices[i:i + batch_size] for i in range(0, num_examples, batch_size)]
+
+
+def pad_tokens_per_batch(lengths, batches):
+    """Return the number of pad tokens each batch needs when padded to its longest example."""
+    pads = []
+    for batch in batches:
+        batch_lengths = [lengths[i] for i in batch]
+        pads.append(max(batch_lengths) * len(batch_lengths) - sum(batch_lengths))
+    return pads
+
+
+class LengthGroupedTrainerMixin:
+    """Trainer mixin that swaps the random train sampler for ``LengthGroupedBatchSampler``.
+
+    Use as ``class BucketedSFTTrainer(LengthGroupedTrainerMixin, SFTTrainer)``.
+    Lengths are read from the tokenized ``input_ids`` column.
+    """
+
+    shuffle_window = 64
+
+    def get_train_dataloader(self):
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        lengths = [len(ids) for ids in train_dataset["input_ids"]]
+        batch_sampler = LengthGroupedBatchSampler(
+            lengths,
+            self._train_batch_size,
+            shuffle_window=self.shuffle_window,
+            seed=self.args.seed,
+            drop_last=self.args.dataloader_drop_last,
+        )
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+
+def compare_pad_tokens(lengths, batch_size, shuffle_window, epochs=3, seed=3407):
+    """Measure pad tokens per step for random vs length-grouped batching."""
+    random_pads = []
+    for epoch in range(epochs):
+        random_pads.extend(pad_tokens_per_batch(lengths, random_batches(len(lengths), batch_size, seed + epoch)))
+
+    sampler = LengthGroupedBatchSampler(lengths, batch_size, shuffle_window=shuffle_window, seed=seed)
+    bucketed_pads = []
+    first_batches = [sorted(batch) for batch in sampler.batches(0)]
+    for epoch in range(epochs):
+        bucketed_pads.extend(pad_tokens_per_batch(lengths, sampler.batches(epoch)))
+
+    # Different epochs must produce different batches, otherwise we lost randomness
+    reshuffled = sorted(sorted(batch) for batch in sampler.batches(1)) != sorted(first_batches)
+
+    real_tokens = sum(lengths) * epochs
+    return {
+        "steps": len(random_pads),
+        "random_pad_per_step": sum(random_pads) / len(random_pads),
+        "bucketed_pad_per_step": sum(bucketed_pads) / len(bucketed_pads),
+        "random_pad_fraction": sum(random_pads) / (sum(random_pads) + real_tokens),
+        "bucketed_pad_fraction": sum(bucketed_pads) / (sum(bucketed_pads) + real_tokens),
+        "reshuffled_across_epochs": reshuffled,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pad tokens per step: random vs length-grouped batches")
+    parser.add_argument("--dataset", default="dataset/validation_enhanced.jsonl", help="JSONL with prompt/completion")
+    parser.add_argument("--tokenizer", default="unsloth/Meta-Llama-3.1-8B",
+                        help="Tokenizer used for lengths ('tiny' for the offline byte tokenizer)")
+    parser.add_argument("--max-seq-length", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--shuffle-window", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.tokenizer == "tiny":
+        from tiny_models import build_byte_tokenizer
+        tokenizer = build_byte_tokenizer()
+    else:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    with open(args.dataset, 'r', encoding='utf-8') as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+    texts = [e["prompt"] + "\n" + e["completion"] + tokenizer.eos_token for e in examples]
+    lengths = [min(len(ids), args.max_seq_length) for ids in tokenizer(texts)["input_ids"]]
+
+    stats = compare_pad_tokens(lengths, args.batch_size, args.shuffle_window, args.epochs)
+    print(f"Examples: {len(lengths)}, batch size: {args.batch_size}, shuffle window: {args.shuffle_window}")
+    print(f"Steps measured: {stats['steps']}")
+    print(f"Random batches:   {stats['random_pad_per_step']:.1f} pad tokens/step "
+          f"({stats['random_pad_fraction']:.1%} of batch tokens)")
+    print(f"Length-grouped:   {stats['bucketed_pad_per_step']:.1f} pad tokens/step "
+          f"({stats['bucketed_pad_fraction']:.1%} of batch tokens)")
+    print(f"Batches reshuffled across epochs: {stats['reshuffled_across_epochs']}")
+
+
+if __name__ == "__main__":
+    main()
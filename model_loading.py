@@ -0,0 +1,139 @@
+import hashlib
+import json
+from pathlib import Path
+
+ADAPTER_DIR = "lora_model"
+MERGED_DIR = "lora_model_merged"
+FINGERPRINT_FILE = "merge_fingerprint.json"
+
+
+def adapter_fingerprint(adapter_dir):
+    """Hash the adapter weights and config saved by ``model.save_pretrained``."""
+    adapter_dir = Path(adapter_dir)
+    digest = hashlib.sha256()
+    for name in ("adapter_config.json", "adapter_model.safetensors", "adapter_model.bin"):
+        path = adapter_dir / name
+        if path.exists():
+            digest.update(name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def base_fingerprint(config):
+    """Identify base weights by name, hub commit (if any) and config, without hashing gigabytes."""
+    digest = hashlib.sha256()
+    digest.update(str(config.name_or_path).encode('utf-8'))
+    digest.update(str(getattr(config, "_commit_hash", None)).encode('utf-8'))
+    digest.update(config.to_json_string(use_diff=False).encode('utf-8'))
+
+    # Local checkpoints have no commit hash, so include the weight file names and sizes
+    local_dir = Path(config.name_or_path)
+    if local_dir.is_dir():
+        for path in sorted(local_dir.glob("*.safetensors")) + sorted(local_dir.glob("*.bin")):
+            digest.update(f"{path.name}:{path.stat().st_size}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def current_base_fingerprint(base_model):
+    """``base_fingerprint`` of ``base_model``'s config as it resolves now, or None if it cannot be resolved."""
+    from transformers import AutoConfig
+    try:
+        return base_fingerprint(AutoConfig.from_pretrained(str(base_model)))
+    except (OSError, ValueError):
+        return None
+
+
+def read_merge_fingerprint(merged_dir):
+    """Return the fingerprint record written next to a merged export, or None."""
+    path = Path(merged_dir) / FINGERPRINT_FILE
+    if not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def merged_is_current(merged_dir=MERGED_DIR, adapter_dir=ADAPTER_DIR):
+    """True if ``merged_dir`` was exported from the adapter currently in ``adapter_dir`` and the current base.
+
+    The base recorded at export is re-resolved (config only, no weights) and
+    compared by ``base_fingerprint``; if it cannot be resolved, e.g. offline,
+    only the adapter is compared.
+    """
+    record = read_merge_fingerprint(merged_dir)
+    if record is None:
+        return False
+    if not Path(adapter_dir).exists():
+        # Merged-only deployment: there is no adapter to compare against or re-export from
+        return True
+    if record.get("adapter_fingerprint") != adapter_fingerprint(adapter_dir):
+        return False
+    current = current_base_fingerprint(record["base_model"]) if record.get("base_model") else None
+    if current is None:
+        print(f"Cannot resolve base model {record.get('base_model')}; checking the merged export by adapter only")
+        return True
+    return current == record.get("base_fingerprint")
+
+
+def quantization_kwargs(load_in_4bit):
+    """Keyword arguments that load a model in 4-bit via bitsandbytes (GPU only; ignored without CUDA)."""
+    if not load_in_4bit:
+        return {}
+    import torch
+    if not torch.cuda.is_available():
+        print("CUDA is not available; loading without 4-bit quantization (see cpu_inference.py for int8 on CPU)")
+        return {}
+    from transformers import BitsAndBytesConfig
+    return {"quantization_config": BitsAndBytesConfig(load_in_4bit=True)}
+
+
+def load_finetuned(adapter_dir=ADAPTER_DIR, merged_dir=MERGED_DIR, load_in_4bit=True, **kwargs):
+    """Load the fine-tuned model, preferring an up-to-date merged export over the PEFT adapter.
+
+    The merged checkpoint is plain safetensors loaded memory-mapped, with no
+    PEFT wrapper and no per-token adapter matmuls. If it is missing or was
+    exported from a different adapter, fall back to ``AutoPeftModelForCausalLM``.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    if Path(merged_dir).exists() and merged_is_current(merged_dir, adapter_dir):
+        print(f"Loading merged model: {merged_dir}")
+        model = AutoModelForCausalLM.from_pretrained(merged_dir, **quantization_kwargs(load_in_4bit), **kwargs)
+        tokenizer = AutoTokenizer.from_pretrained(merged_dir)
+        return model, tokenizer
+
+    if Path(merged_dir).exists():
+        print(f"Merged model in {merged_dir} is stale; re-run export_merged.py. Loading adapter instead.")
+    from peft import AutoPeftModelForCausalLM
+    print(f"Loading adapter model: {adapter_dir}")
+    model = AutoPeftModelForCausalLM.from_pretrained(adapter_dir, **quantization_kwargs(load_in_4bit), **kwargs)
+    tokenizer = AutoTokenizer.from_pretrained(adapter_dir)
+    return model, tokenizer
+
+
+def load_base_with_adapters(base_model, adapters, load_in_4bit=True, **kwargs):
+    """Load ``base_model`` once and attach every adapter in ``adapters`` (name -> directory).
+
+    Arms are then selected with ``model.set_adapter(name)`` and the plain base
+    is reached through ``with model.disable_adapter():``, so comparing base and
+    fine-tuned answers costs a single model load.
+    """
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    print(f"Loading base model: {base_model}")
+    model = AutoModelForCausalLM.from_pretrained(base_model, **quantization_kwargs(load_in_4bit), **kwargs)
+
+    names = list(adapters)
+    tokenizer = AutoTokenizer.from_pretrained(str(adapters[names[0]]) if names else base_model)
+    if not names:
+        return model, tokenizer
+
+    print(f"Attaching adapter '{names[0]}': {adapters[names[0]]}")
+    model = PeftModel.from_pretrained(model, str(adapters[names[0]]), adapter_name=names[0])
+    for name in names[1:]:
+        print(f"Attaching adapter '{name}': {adapters[name]}")
+        model.load_adapter(str(adapters[name]), adapter_name=name)
+    model.eval()
+    return model, tokenizer
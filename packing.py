@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+import argparse
+import json
+
+import torch
+
+
+def first_fit_decreasing(lengths, capacity):
+    """Assign example indices to bins of ``capacity`` tokens using first-fit-decreasing."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    bins = []
+    remaining = []
+    for idx in order:
+        # Over-long examples are truncated to the bin size by the caller
+        length = min(lengths[idx], capacity)
+        for b, space in enumerate(remaining):
+            if length <= space:
+                bins[b].append(idx)
+                remaining[b] -= length
+                break
+        else:
+            bins.append([idx])
+            remaining.append(capacity - length)
+
+    return bins
+
+
+def pack_examples(input_ids_list, max_seq_length):
+    """Pack tokenized examples into rows of at most ``max_seq_length`` tokens.
+
+    Each packed row keeps the per-example lengths so the collator can restart
+    position ids and block attention across example boundaries.
+    """
+    truncated = [ids[:max_seq_length] for ids in input_ids_list]
+    lengths = [len(ids) for ids in truncated]
+    bins = first_fit_decreasing(lengths, max_seq_length)
+
+    packed = []
+    for bin_indices in bins:
+        row = []
+        seq_lengths = []
+        for idx in bin_indices:
+            row.extend(truncated[idx])
+            seq_lengths.append(lengths[idx])
+        packed.append({
+            "input_ids": row,
+            "seq_lengths": seq_lengths,
+        })
+
+    return packed
+
+
+def packing_stats(lengths, packed, max_seq_length, batch_size=1):
+    """Compare token efficiency of packed rows against padded, unpacked batches."""
+    real_tokens = sum(min(length, max_seq_length) for length in lengths)
+
+    # Unpacked: every batch is padded to its longest example (dataset order)
+    unpacked_slots = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = [min(length, max_seq_length) for length in lengths[start:start + batch_size]]
+        unpacked_slots += max(batch) * len(batch)
+
+    # Packed: every batch is padded to its longest packed row
+    row_lengths = [len(row["input_ids"]) for row in packed]
+    packed_slots = 0
+    for start in range(0, len(row_lengths), batch_size):
+        batch = row_lengths[start:start + batch_size]
+        packed_slots += max(batch) * len(batch)
+
+    return {
+        "examples": len(lengths),
+        "packed_rows": len(packed),
+        "real_tokens": real_tokens,
+        "unpacked_token_slots": unpacked_slots,
+        "packed_token_slots": packed_slots,
+        "unpacked_efficiency": real_tokens / unpacked_slots if unpacked_slots else 0.0,
+        "packed_efficiency": real_tokens / packed_slots if packed_slots else 0.0,
+        "bin_fill": real_tokens / (len(packed) * max_seq_length) if packed else 0.0,
+    }
+
+
+def print_packing_stats(stats):
+    """Print a short packing efficiency report."""
+    print("--- Packing ---")
+    print(f"Examples: {stats['examples']} -> packed rows: {stats['packed_rows']}")
+    print(f"Real tokens: {stats['real_tokens']}")
+    print(f"Unpacked efficiency: {stats['unpacked_efficiency']:.1%} "
+          f"({stats['unpacked_token_slots']} token slots)")
+    print(f"Packed efficiency: {stats['packed_efficiency']:.1%} "
+          f"({stats['packed_token_slots']} token slots)")
+    print(f"Average bin fill: {stats['bin_fill']:.1%}")
+
+
+class PackedSequenceCollator:
+    """Collate packed rows, restarting position ids at every example boundary.
+
+    By default no ``attention_mask`` is returned, so attention backends that
+    understand packed position ids (flash-attention varlen, recent
+    transformers sdpa/eager) keep examples separated. ``block_diagonal_mask``
+    instead builds an explicit 4D additive mask for backends that do not.
+    Packed position ids are only honoured without a KV cache, so train with
+    ``model.config.use_cache = False``.
+    """
+
+    def __init__(self, pad_token_id, block_diagonal_mask=False, mask_dtype=torch.float32):
+        self.pad_token_id = pad_token_id
+        self.block_diagonal_mask = block_diagonal_mask
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        max_len = max(len(f["input_ids"]) for f in features)
+        input_ids = []
+        position_ids = []
+        labels = []
+        segments = []
+
+        for f in features:
+            ids = list(f["input_ids"])
+            seq_lengths = list(f["seq_lengths"])
+            pad_len = max_len - len(ids)
+
+            row_positions = []
+            row_labels = []
+            row_segments = []
+            start = 0
+            for segment, length in enumerate(seq_lengths):
+                row_positions.extend(range(length))
+                # The first token of an example must not be predicted from the previous one
+                row_labels.append(-100)
+                row_labels.extend(ids[start + 1:start + length])
+                row_segments.extend([segment] * length)
+                start += length
+
+            if pad_len:
+                # Padding forms its own trailing segment so real tokens never attend to it
+                row_positions.extend(range(pad_len))
+                row_labels.extend([-100] * pad_len)
+                row_segments.extend([len(seq_lengths)] * pad_len)
+                ids = ids + [self.pad_token_id] * pad_len
+
+            input_ids.append(ids)
+            position_ids.append(row_positions)
+            labels.append(row_labels)
+            segments.append(row_segments)
+
+        batch = {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long),
+            "position_ids": torch.tensor(position_ids, dtype=torch.long),
+            "labels": torch.tensor(labels, dtype=torch.long),
+        }
+        if self.block_diagonal_mask:
+            batch["attention_mask"] = self.build_block_diagonal_mask(torch.tensor(segments))
+        return batch
+
+    def build_block_diagonal_mask(self, segments):
+        """Build a ``(batch, 1, seq, seq)`` additive mask: causal within a segment, blocked across."""
+        seq_len = segments.shape[1]
+        same_segment = segments[:, :, None] == segments[:, None, :]
+        causal = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool))
+        allowed = same_segment & causal
+        mask = torch.zeros(allowed.shape, dtype=self.mask_dtype)
+        mask.masked_fill_(~allowed, torch.finfo(self.mask_dtype).min)
+        return mask[:, None, :, :]
+
+
+def tokenize_for_packing(tokenizer, texts):
+    """Tokenize already formatted training texts (EOS included) for packing."""
+    return tokenizer(list(texts), add_special_tokens=True)["input_ids"]
+
+
+def packed_logit_difference(model, collator, rows):
+    """Compare the logits of packed ``rows`` with a separate forward pass per example.
+
+    Runs the model's own forward (whatever attention backend or patching it
+    uses) without gradients, with ``use_cache=False`` as in training. Returns
+    ``{"max_diff", "mean_diff"}``: the largest absolute logit difference and the
+    largest per-example mean absolute difference.
+    """
+    device = next(model.parameters()).device
+    batch = collator(rows)
+    inputs = {k: v.to(device) for k, v in batch.items() if k != "labels"}
+    max_diff = 0.0
+    mean_diff = 0.0
+    with torch.no_grad():
+        packed_logits = model(**inputs, use_cache=False).logits.float()
+        # Recover the original examples row by row and compare with solo forward passes
+        for r, row in enumerate(rows):
+            offset = 0
+            for length in row["seq_lengths"]:
+                ids = torch.tensor([row["input_ids"][offset:offset + length]], device=device)
+                solo_logits = model(input_ids=ids, use_cache=False).logits[0].float()
+                diff = (packed_logits[r, offset:offset + length] - solo_logits).abs()
+                max_diff = max(max_diff, diff.max().item())
+                mean_diff = max(mean_diff, diff.mean().item())
+                offset += length
+    return {"max_diff": max_diff, "mean_diff": mean_diff}
+
+
+def verify_packing(num_examples=12, max_seq_length=256):
+    """Check on CPU with a tiny random Llama that packed logits match unpacked ones."""
+    import random
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    model, tokenizer = build_tiny_model_and_tokenizer()
+    rng = random.Random(0)
+    examples = [
+        [rng.randrange(3, len(tokenizer)) for _ in range(rng.randint(8, max_seq_length // 2))]
+        for _ in range(num_examples)
+    ]
+    packed = pack_examples(examples, max_seq_length)
+    print_packing_stats(packing_stats([len(e) for e in examples], packed, max_seq_length, batch_size=2))
+
+    max_diff = 0.0
+    for block_diagonal_mask in (False, True):
+        collator = PackedSequenceCollator(tokenizer.pad_token_id, block_diagonal_mask=block_diagonal_mask)
+        for start in range(0, len(packed), 2):
+            max_diff = max(max_diff, packed_logit_difference(model, collator, packed[start:start + 2])["max_diff"])
+
+    print(f"Max |packed - unpacked| logit difference: {max_diff:.2e}")
+    if max_diff > 1e-4:
+        raise RuntimeError("Packed sequences leak attention across example boundaries")
+    print("Packing verification passed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="First-fit-decreasing packing for SFT data")
+    parser.add_argument("--dataset", help="JSONL file with prompt/completion pairs to analyse")
+    parser.add_argument("--tokenizer", default="unsloth/Meta-Llama-3.1-8B", help="Tokenizer used for lengths")
+    parser.add_argument("--max-seq-length", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=2)
+    args = parser.parse_args()
+
+    if not args.dataset:
+        verify_packing()
+        return
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    with open(args.dataset, 'r', encoding='utf-8') as f:
+        examples = [json.loads(line) for line in f if line.strip()]
+    texts = [e["prompt"] + "\n" + e["completion"] + tokenizer.eos_token for e in examples]
+    input_ids = tokenize_for_packing(tokenizer, texts)
+    packed = pack_examples(input_ids, args.max_seq_length)
+    print_packing_stats(packing_stats([len(ids) for ids in input_ids], packed,
+                                      args.max_seq_length, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from dataset_cache import hash_file
+
+SCRIPT_DIR = Path(__file__).parent
+STATE_FILE = "pipeline_state.json"
+STAGES = ["download", "process", "dataset", "retrieval", "finetune", "inference", "benchmark"]
+
+# Code (and therefore configuration) each stage depends on; editing one of these re-runs the stage
+PROCESSOR_FILES = ["02_process_latex.py"]
+DATASET_FILES = ["03_prepare_dataset.py"]
+RETRIEVAL_FILES = ["retrieval.py"]
+FINETUNE_FILES = ["04_fine_tuning.py", "packing.py", "length_sampler.py", "dataset_cache.py", "validation.py",
+                  "telemetry.py", "checkpointing.py"]
+INFERENCE_FILES = ["05_inference.py", "model_loading.py", "cpu_inference.py", "retrieval.py", "speculative.py"]
+BENCHMARK_FILES = ["benchmark_models.py", "generation.py", "generation_cache.py", "prefix_cache.py",
+                   "model_loading.py", "validation.py"]
+
+
+class Task:
+    """One node of the pipeline DAG: what it reads, what it writes and how to (re)build it.
+
+    ``inputs`` is a list of paths, or a callable returning one, since some
+    inputs (the processed papers) only exist once upstream tasks have run.
+    ``action`` is a picklable ``(function, args)`` pair run on ``pool``.
+    """
+
+    def __init__(self, name, stage, action, inputs=(), outputs=(), deps=(), config=None, pool="cpu",
+                 outputs_only=False, tolerate_failed_deps=False, cache_failure=False, clear_on_change=()):
+        self.name = name
+        self.stage = stage
+        self.action = action
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.config = config or {}
+        self.pool = pool
+        self.outputs_only = outputs_only # Up to date whenever the outputs exist (e.g. downloads)
+        self.tolerate_failed_deps = tolerate_failed_deps # Run on whatever upstream succeeded
+        self.cache_failure = cache_failure # Deterministic failures are not retried until the inputs change
+        self.clear_on_change = list(clear_on_change) # Resume state that is invalid once the inputs change
+
+    def input_paths(self):
+        return self.inputs() if callable(self.inputs) else self.inputs
+
+
+def hash_path(path, digest=None):
+    """Hash a file, or every file below a directory together with its relative path."""
+    digest = digest or hashlib.sha256()
+    path = Path(path)
+    if path.is_dir():
+        for child in sorted(p for p in path.rglob("*") if p.is_file()):
+            digest.update(child.relative_to(path).as_posix().encode('utf-8'))
+            hash_file(child, digest)
+    else:
+        hash_file(path, digest)
+    return digest
+
+
+def fingerprint(task, base_dir):
+    """Map each existing input (relative path) and the task config to a short content hash."""
+    result = {"config": hashlib.sha256(json.dumps(task.config, sort_keys=True).encode('utf-8')).hexdigest()[:16]}
+    for path in task.input_paths():
+        if Path(path).exists():
+            result[os.path.relpath(path, base_dir)] = hash_path(path).hexdigest()[:16]
+    return result
+
+
+def describe_change(old, new, limit=3):
+    """Human-readable list of inputs that were added, removed or changed between two fingerprints."""
+    changes = [f"changed {k}" for k in new if k in old and old[k] != new[k]]
+    changes += [f"new {k}" for k in new if k not in old]
+    changes += [f"removed {k}" for k in old if k not in new]
+    more = f" (+{len(changes) - limit} more)" if len(changes) > limit else ""
+    return ", ".join(changes[:limit]) + more
+
+
+def stale_reason(task, record, base_dir):
+    """Return ``(why the task must run or None, current input fingerprint)``."""
+    current = fingerprint(task, base_dir)
+    missing = [p for p in task.outputs if not Path(p).exists()]
+    if task.outputs_only:
+        return (f"missing {os.path.relpath(missing[0], base_dir)}" if missing else None), current
+    if record is None:
+        return "never run", current
+    if record["fingerprint"] != current:
+        return describe_change(record["fingerprint"], current), current
+    if not record.get("complete", True):
+        return "interrupted, resuming", current
+    if missing and not record.get("failed"):
+        return f"missing {os.path.relpath(missing[0], base_dir)}", current
+    return None, current
+
+
+def read_references(base_dir):
+    download = importlib.import_module("01_download_and_extract")
+    return download.read_references(Path(base_dir) / "references.csv")
+
+
+def download_paper(base_dir, reference):
+    """Fetch the PDF and LaTeX source of one paper and extract the source to ``sources/<reference>``."""
+    download = importlib.import_module("01_download_and_extract")
+    base_dir = Path(base_dir)
+    downloads_dir = base_dir / "downloads"
+    os.makedirs(downloads_dir, exist_ok=True)
+    download.download_paper_pdf(reference, downloads_dir)
+    archive_path = download.download_paper_src(reference, downloads_dir)
+    time.sleep(1) # Keep each worker polite towards arxiv.org, as 01_download_and_extract.py does
+    return bool(archive_path) and download.extract_archive(archive_path, base_dir / "sources" / reference)
+
+
+def process_paper(base_dir, reference):
+    """Process one paper into ``outputs/<reference>`` (a fresh LatexProcessor, since it keeps per-paper state)."""
+    latex = importlib.import_module("02_process_latex")
+    base_dir = Path(base_dir)
+    output_dir = base_dir / "outputs" / reference
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    return latex.LatexProcessor(base_dir / "sources", base_dir / "outputs").process_file_src(reference)
+
+
+def prepare_dataset(base_dir):
+    """Build the basic and enhanced JSONL datasets from ``outputs/`` into ``dataset/``, as 03_prepare_dataset.py does."""
+    dataset = importlib.import_module("03_prepare_dataset")
+    base_dir = Path(base_dir)
+    preparer = dataset.DatasetPreparer(base_dir / "outputs", base_dir / "dataset")
+    if not preparer.prepare_dataset():
+        return False
+    # A fresh preparer: load_processed_papers appends, so reusing one would load every paper twice
+    return dataset.DatasetPreparer(base_dir / "outputs", base_dir / "dataset").create_enhanced_dataset()
+
+
+def run_script(base_dir, script, *args):
+    """Run one of the pipeline scripts in ``base_dir`` and report whether it succeeded."""
+    return subprocess.run([sys.executable, str(SCRIPT_DIR / script), *args], cwd=base_dir).returncode == 0
+
+
+def code_files(names):
+    return [SCRIPT_DIR / name for name in names]
+
+
+def build_tasks(base_dir, references):
+    """The pipeline DAG for ``references``: per-paper download and processing, then the whole-corpus stages."""
+    base_dir = Path(base_dir)
+    base = str(base_dir)
+    outputs_dir = base_dir / "outputs"
+    lora_dir = base_dir / "lora_model"
+    tasks = []
+    for reference in references:
+        tasks.append(Task(f"download:{reference}", "download", (download_paper, (base, reference)),
+                          outputs=[base_dir / "sources" / reference], pool="network", outputs_only=True))
+        tasks.append(Task(f"process:{reference}", "process", (process_paper, (base, reference)),
+                          inputs=[base_dir / "sources" / reference] + code_files(PROCESSOR_FILES),
+                          outputs=[outputs_dir / reference / "processed_text.md",
+                                   outputs_dir / reference / "metadata.json"],
+                          deps=[f"download:{reference}"], cache_failure=True))
+
+    def processed_papers():
+        # Exactly what DatasetPreparer and the retrieval index read
+        return sorted(outputs_dir.glob("*/processed_text.md")) + sorted(outputs_dir.glob("*/metadata.json"))
+
+    processed = [f"process:{reference}" for reference in references]
+    tasks.append(Task("dataset", "dataset", (prepare_dataset, (base,)),
+                      inputs=lambda: processed_papers() + code_files(DATASET_FILES),
+                      outputs=[base_dir / "dataset" / name for name in
+                               ("train.jsonl", "validation.jsonl", "train_enhanced.jsonl", "validation_enhanced.jsonl")],
+                      deps=processed, tolerate_failed_deps=True))
+    tasks.append(Task("retrieval", "retrieval", (run_script, (base, "retrieval.py", "build")),
+                      inputs=lambda: processed_papers() + code_files(RETRIEVAL_FILES),
+                      outputs=[base_dir / "retrieval_index" / "manifest.json"],
+                      deps=processed, tolerate_failed_deps=True))
+    tasks.append(Task("finetune", "finetune", (run_script, (base, "04_fine_tuning.py")),
+                      inputs=[base_dir / "dataset" / "train_enhanced.jsonl",
+                              base_dir / "dataset" / "validation_enhanced.jsonl"] + code_files(FINETUNE_FILES),
+                      outputs=[lora_dir / "adapter_config.json"], deps=["dataset"], pool="gpu",
+                      clear_on_change=[base_dir / "lora_checkpoints"]))
+    tasks.append(Task("inference", "inference", (run_script, (base, "05_inference.py")),
+                      inputs=[lora_dir] + code_files(INFERENCE_FILES), deps=["finetune"], pool="gpu"))
+    tasks.append(Task("benchmark", "benchmark", (run_script, (base, "benchmark_models.py")),
+                      inputs=[lora_dir] + code_files(BENCHMARK_FILES),
+                      outputs=[base_dir / "model_comparison.md"], deps=["finetune"], pool="gpu"))
+    return tasks
+
+
+def select_tasks(tasks, until=None):
+    """Keep the tasks of stage ``until`` and everything they depend on (all tasks if None)."""
+    if until is None:
+        return tasks
+    by_name = {task.name: task for task in tasks}
+    needed = set()
+    pending = [task.name for task in tasks if task.stage == until]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(by_name[name].deps)
+    return [task for task in tasks if task.name in needed]
+
+
+def read_state(state_file):
+    if not Path(state_file).exists():
+        return {"tasks": {}}
+    with open(state_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_state(state_file, state):
+    """Write the state atomically, so an interrupted run never leaves it half-written."""
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def removed_papers(state, references):
+    """Papers this runner processed earlier that are no longer listed in references.csv."""
+    listed = set(references)
+    return sorted(name.split(":", 1)[1] for name in state["tasks"]
+                  if name.startswith("process:") and name.split(":", 1)[1] not in listed)
+
+
+def plan(tasks, state, base_dir, force=()):
+    """Return ``{task name: reason}`` for every task that would run, without running anything.
+
+    A task whose upstream would run is assumed stale too; during a real run
+    it is re-fingerprinted once its upstream finished and may be skipped.
+    """
+    will_run = {}
+    for task in tasks: # Tasks are listed in dependency order
+        upstream = [dep for dep in task.deps if dep in will_run]
+        if upstream:
+            reason = f"upstream {upstream[0]} will run" + (f" (+{len(upstream) - 1} more)" if len(upstream) > 1 else "")
+        else:
+            reason, _ = stale_reason(task, state["tasks"].get(task.name), base_dir)
+        if reason is None and task.stage in force:
+            reason = "forced"
+        if reason:
+            will_run[task.name] = reason
+    return will_run
+
+
+def print_plan(tasks, will_run, removed, max_per_stage=10):
+    """Print per stage what would run and why; per-paper stages are abbreviated."""
+    for reference in removed:
+        print(f"[remove] outputs/{reference}: no longer in references.csv")
+    for stage in STAGES:
+        stage_tasks = [task for task in tasks if task.stage == stage]
+        if not stage_tasks:
+            continue
+        running = [task for task in stage_tasks if task.name in will_run]
+        print(f"{stage}: {len(running)} to run, {len(stage_tasks) - len(running)} up to date")
+        for task in running[:max_per_stage]:
+            print(f"  [run] {task.name}: {will_run[task.name]}")
+        if len(running) > max_per_stage:
+            print(f"  ... and {len(running) - max_per_stage} more")
+
+
+def run(tasks, state, state_file, base_dir, workers=4, download_workers=2, force=()):
+    """Run every stale task as soon as its dependencies have finished.
+
+    Downloads share a thread pool, paper processing and the CPU stages a
+    process pool, and GPU stages run one at a time; so papers are processed
+    while others are still downloading, and the retrieval index is built
+    while the model trains. The state file is updated after every task.
+    """
+    by_name = {task.name: task for task in tasks}
+    dependents = {task.name: [] for task in tasks}
+    waiting = {}
+    for task in tasks:
+        deps = [dep for dep in task.deps if dep in by_name]
+        waiting[task.name] = len(deps)
+        for dep in deps:
+            dependents[dep].append(task.name)
+
+    pools = {"network": ThreadPoolExecutor(download_workers), "cpu": ProcessPoolExecutor(workers),
+             "gpu": ThreadPoolExecutor(1)}
+    futures = {}
+    results = {}
+
+    def finish(name, result):
+        results[name] = result
+        for dependent in dependents[name]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                start(by_name[dependent])
+
+    def start(task):
+        failed = [dep for dep in task.deps if results.get(dep) in ("failed", "blocked")]
+        if failed and not task.tolerate_failed_deps:
+            print(f"[blocked] {task.name}: {failed[0]} failed")
+            finish(task.name, "blocked")
+            return
+        record = state["tasks"].get(task.name)
+        reason, current = stale_reason(task, record, base_dir)
+        if reason is None and task.stage in force:
+            reason = "forced"
+        if reason is None:
+            finish(task.name, "failed" if record and record.get("failed") else "skipped")
+            return
+        if record is not None and record["fingerprint"] != current:
+            for path in task.clear_on_change:
+                if Path(path).exists():
+                    print(f"Removing {path}: written for different inputs")
+                    shutil.rmtree(path)
+        print(f"[run] {task.name}: {reason}")
+        state["tasks"][task.name] = {"fingerprint": current, "complete": False}
+        write_state(state_file, state)
+        function, args = task.action
+        futures[pools[task.pool].submit(function, *args)] = task
+
+    start_time = time.perf_counter()
+    try:
+        for task in [task for task in tasks if waiting[task.name] == 0]:
+            start(task)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = futures.pop(future)
+                try:
+                    ok = bool(future.result())
+                except Exception as e:
+                    print(f"Error in {task.name}: {e}")
+                    ok = False
+                record = state["tasks"][task.name]
+                if ok:
+                    record["complete"] = True
+                elif task.cache_failure:
+                    record.update(complete=True, failed=True)
+                else:
+                    del state["tasks"][task.name]
+                write_state(state_file, state)
+                print(f"[{'done' if ok else 'failed'}] {task.name}")
+                finish(task.name, "ran" if ok else "failed")
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    print(f"\n--- Summary ({time.perf_counter() - start_time:.1f}s) ---")
+    for stage in STAGES:
+        counts = {}
+        for task in tasks:
+            if task.stage == stage:
+                result = results.get(task.name, "blocked")
+                counts[result] = counts.get(result, 0) + 1
+        if counts:
+            print(f"{stage}: " + ", ".join(f"{n} {result}" for result, n in sorted(counts.items())))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline stages that are out of date")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would run and why, then exit")
+    parser.add_argument("--until", choices=STAGES, help="Stop after this stage (e.g. 'dataset' on a CPU box)")
+    parser.add_argument("--force", action="append", choices=STAGES, default=[], help="Re-run a stage (repeatable)")
+    parser.add_argument("--workers", type=int, default=max(1, min(8, os.cpu_count() or 1)),
+                        help="Processes for paper processing and CPU stages")
+    parser.add_argument("--download-workers", type=int, default=2, help="Concurrent arxiv.org downloads")
+    parser.add_argument("--base-dir", default=str(SCRIPT_DIR), help="Directory holding references.csv and the data")
+    args = parser.parse_args()
+
+    base_dir = Path(args.base_dir).resolve()
+    state_file = base_dir / STATE_FILE
+    state = read_state(state_file)
+    references = read_references(base_dir)
+    tasks = select_tasks(build_tasks(base_dir, references), args.until)
+    removed = removed_papers(state, references)
+    print(f"Found {len(references)} references, {len(tasks)} tasks")
+
+    if args.dry_run:
+        print_plan(tasks, plan(tasks, state, base_dir, args.force), removed)
+        return
+
+    for reference in removed:
+        output_dir = base_dir / "outputs" / reference
+        print(f"Removing {output_dir}: no longer in references.csv")
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        for stage in ("download", "process"):
+            state["tasks"].pop(f"{stage}:{reference}", None)
+    write_state(state_file, state)
+    results = run(tasks, state, state_file, base_dir, args.workers, args.download_workers, args.force)
+    # Individual papers may fail, as in 01/02; a corpus-wide stage failing fails the run
+    if any(results.get(task.name) in ("failed", "blocked") for task in tasks if task.stage not in ("download", "process")):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+import copy
+import time
+
+import torch
+
+
+class PrefixCache:
+    """KV cache of a prompt prefix shared by every request (e.g. the fixed system prompt).
+
+    The prefix is prefilled once per model (or per adapter arm, via ``key``)
+    and each request continues from a copy of that cache, so only the
+    question tokens are prefilled. Prompts whose tokenization does not start
+    with the cached prefix tokens are generated without the cache.
+    """
+
+    def __init__(self, tokenizer, prefix_text):
+        self.prefix_text = prefix_text
+        self.prefix_ids = tokenizer(prefix_text)["input_ids"]
+        self.caches = {}
+        self.prefill_times = {}
+        self.requests = 0
+        self.tokens_reused = 0
+
+    def get(self, model, key="default"):
+        """Return the prefix cache for ``key``, prefilling it on first use."""
+        if key not in self.caches:
+            device = next(model.parameters()).device
+            input_ids = torch.tensor([self.prefix_ids], device=device)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            with torch.inference_mode():
+                self.caches[key] = model(input_ids=input_ids, use_cache=True).past_key_values
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            self.prefill_times[key] = time.perf_counter() - start
+        return self.caches[key]
+
+    def matches(self, input_ids):
+        """True if a tokenized prompt starts with exactly the cached prefix tokens."""
+        return list(input_ids[:len(self.prefix_ids)]) == self.prefix_ids
+
+    def saved_time(self):
+        """Estimated prefill seconds saved: reused prefix tokens at the measured prefill rate."""
+        if not self.prefill_times:
+            return 0.0
+        seconds_per_token = sum(self.prefill_times.values()) / (len(self.prefill_times) * len(self.prefix_ids))
+        return self.tokens_reused * seconds_per_token
+
+    def report(self):
+        """Print how much prefill work the cache avoided."""
+        print(f"Prefix cache: {len(self.prefix_ids)} prefix tokens, {len(self.caches)} cached model(s), "
+              f"{self.requests} requests, {self.tokens_reused} prefill tokens reused, "
+              f"~{self.saved_time():.2f}s prefill saved")
+
+
+def generate_with_prefix(model, tokenizer, prefix_cache, prompts, max_new_tokens=256, key="default", stats=None,
+                         **generate_kwargs):
+    """Greedy-decode ``prompts`` continuing from a copy of the shared prefix cache.
+
+    Rows are laid out as ``prefix | padding | suffix``: the prefix matches the
+    cached keys/values and the attention mask hides the padding, so position
+    ids (derived from the mask) are the same as for the unpadded prompt.
+    """
+    from generation import decode_new_tokens, generate_batch
+
+    full_ids = tokenizer(prompts)["input_ids"]
+    if not all(prefix_cache.matches(ids) for ids in full_ids):
+        return generate_batch(model, tokenizer, prompts, max_new_tokens, stats, **generate_kwargs)
+
+    prefix_len = len(prefix_cache.prefix_ids)
+    suffixes = [ids[prefix_len:] for ids in full_ids]
+    width = max(len(s) for s in suffixes)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    input_ids = []
+    attention_mask = []
+    for suffix in suffixes:
+        pad = width - len(suffix)
+        input_ids.append(prefix_cache.prefix_ids + [pad_token_id] * pad + suffix)
+        attention_mask.append([1] * prefix_len + [0] * pad + [1] * len(suffix))
+    device = next(model.parameters()).device
+    input_ids = torch.tensor(input_ids, device=device)
+    attention_mask = torch.tensor(attention_mask, device=device)
+
+    # generate() extends the cache in place, so every call works on its own copy
+    past_key_values = copy.deepcopy(prefix_cache.get(model, key))
+    if len(prompts) > 1:
+        past_key_values.batch_repeat_interleave(len(prompts))
+
+    generate_kwargs.setdefault("do_sample", False)
+    with torch.inference_mode():
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            pad_token_id=pad_token_id,
+            **generate_kwargs,
+        )
+
+    prefix_cache.requests += len(prompts)
+    prefix_cache.tokens_reused += prefix_len * len(prompts)
+    new_tokens = outputs[:, input_ids.shape[1]:]
+    return decode_new_tokens(tokenizer, new_tokens, pad_token_id, stats)
+
+
+def main():
+    """Check on CPU with a tiny random model that prefix-cached logits and outputs match uncached ones."""
+    from benchmark_models import PROMPT_PREFIX, QUESTIONS, format_prompt
+    from generation import generate_all
+    from tiny_models import build_tiny_model_and_tokenizer
+
+    model, tokenizer = build_tiny_model_and_tokenizer()
+    prefix_cache = PrefixCache(tokenizer, PROMPT_PREFIX)
+
+    # Logits of the question tokens: full forward pass vs continuing from the cached prefix
+    full_ids = torch.tensor([tokenizer(format_prompt(QUESTIONS[0]))["input_ids"]])
+    prefix_len = len(prefix_cache.prefix_ids)
+    with torch.inference_mode():
+        expected = model(input_ids=full_ids).logits[:, prefix_len:]
+        cache = copy.deepcopy(prefix_cache.get(model))
+        actual = model(input_ids=full_ids[:, prefix_len:], past_key_values=cache).logits
+    diff = (expected - actual).abs().max().item()
+    print(f"Max |cached - uncached| logit difference: {diff:.2e}")
+
+    prompts = [format_prompt(q) for q in QUESTIONS[:4]]
+    start = time.perf_counter()
+    uncached = generate_all(model, tokenizer, prompts, batch_size=4, max_new_tokens=16)
+    uncached_time = time.perf_counter() - start
+    start = time.perf_counter()
+    cached = generate_all(model, tokenizer, prompts, batch_size=4, max_new_tokens=16, prefix_cache=prefix_cache)
+    cached_time = time.perf_counter() - start
+    print(f"Generation: uncached {uncached_time:.2f}s, cached {cached_time:.2f}s")
+    prefix_cache.report()
+
+    if diff > 1e-4 or cached != uncached:
+        raise RuntimeError("Prefix-cached generation differs from uncached generation")
+    print("Prefix cache verification passed.")
+
+
+if __name__ == "__main__":
+    main()
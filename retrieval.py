@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+OUTPUTS_DIR = Path("outputs")
+INDEX_DIR = Path("retrieval_index")
+MANIFEST_FILE = "manifest.json"
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+MAX_CHUNK_CHARS = 1200
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = set("""
+a an and are as at be by can do does for from has have how in is it its of on or that the their this to
+was we what when which why with
+""".split())
+
+
+def tokenize(text):
+    """Lowercased alphanumeric terms without stopwords and single characters."""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def chunk_markdown(content, max_chars=MAX_CHUNK_CHARS):
+    """Split a processed paper into ``(section title, text)`` chunks of whole paragraphs."""
+    chunks = []
+    section = ""
+    current = []
+
+    def flush():
+        if current:
+            chunks.append((section, "\n\n".join(current)))
+            current.clear()
+
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if paragraph.startswith("#"):
+            flush()
+            header, _, rest = paragraph.partition("\n")
+            section = header.lstrip("#").strip()
+            paragraph = rest.strip()
+            if not paragraph:
+                continue
+        if current and sum(len(p) for p in current) + len(paragraph) > max_chars:
+            flush()
+        current.append(paragraph)
+    flush()
+    return chunks
+
+
+def paper_fingerprint(md_file):
+    digest = hashlib.sha256()
+    with open(md_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def write_segment(segment_dir, papers, max_chars=MAX_CHUNK_CHARS):
+    """Write an immutable index segment for ``papers`` (paper id -> markdown); return each paper's chunk range.
+
+    Postings are stored term by term in flat ``postings.npy``/``tfs.npy``
+    arrays (memory-mapped at query time) with ``terms.json`` giving each
+    term's offset and length. Chunk texts go to ``chunks.jsonl`` with byte
+    offsets in ``offsets.npy`` for random access.
+    """
+    tmp_dir = segment_dir.with_name(f".{segment_dir.name}.tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    postings = {}
+    doc_lengths = []
+    offsets = []
+    ranges = {}
+    with open(tmp_dir / "chunks.jsonl", 'wb') as f:
+        for paper_id, content in papers.items():
+            start = len(doc_lengths)
+            for section, text in chunk_markdown(content, max_chars):
+                doc = len(doc_lengths)
+                terms = tokenize(f"{section}\n{text}")
+                counts = {}
+                for term in terms:
+                    counts[term] = counts.get(term, 0) + 1
+                for term, tf in counts.items():
+                    postings.setdefault(term, []).append((doc, tf))
+                doc_lengths.append(len(terms))
+                offsets.append(f.tell())
+                f.write((json.dumps({"paper_id": paper_id, "section": section, "text": text}) + "\n").encode('utf-8'))
+            ranges[paper_id] = [start, len(doc_lengths)]
+
+    term_table = {}
+    docs = []
+    tfs = []
+    for term in sorted(postings):
+        term_table[term] = [len(docs), len(postings[term])]
+        for doc, tf in postings[term]:
+            docs.append(doc)
+            tfs.append(tf)
+    np.save(tmp_dir / "postings.npy", np.asarray(docs, dtype=np.int32))
+    np.save(tmp_dir / "tfs.npy", np.asarray(tfs, dtype=np.int32))
+    np.save(tmp_dir / "doc_lengths.npy", np.asarray(doc_lengths, dtype=np.int32))
+    np.save(tmp_dir / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    with open(tmp_dir / "terms.json", 'w', encoding='utf-8') as f:
+        json.dump(term_table, f)
+
+    if segment_dir.exists():
+        shutil.rmtree(segment_dir)
+    os.replace(tmp_dir, segment_dir)
+    return ranges
+
+
+def read_manifest(index_dir):
+    path = Path(index_dir) / MANIFEST_FILE
+    if not path.exists():
+        return {"next_segment": 0, "segments": []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(index_dir, manifest):
+    """Replace the manifest atomically; it is the only file that says which segments and papers are live."""
+    path = Path(index_dir) / MANIFEST_FILE
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def drop_empty_segments(manifest):
+    """Remove segments without live papers from the manifest and return their names."""
+    empty = [s for s in manifest["segments"] if not s["papers"]]
+    for segment in empty:
+        manifest["segments"].remove(segment)
+    return [s["name"] for s in empty]
+
+
+def update_index(outputs_dir=OUTPUTS_DIR, index_dir=INDEX_DIR, max_chars=MAX_CHUNK_CHARS):
+    """Index new and changed papers in a new segment and retire removed or changed ones.
+
+    Existing segments are never rewritten: a changed paper's old chunks stay
+    on disk but drop out of the manifest, so they are ignored at query time
+    until ``compact_index`` rewrites everything into one segment.
+    """
+    outputs_dir = Path(outputs_dir)
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(index_dir)
+
+    current = {}
+    for md_file in sorted(outputs_dir.glob("*/processed_text.md")):
+        current[md_file.parent.name] = (md_file, paper_fingerprint(md_file))
+
+    indexed = {}
+    for segment in manifest["segments"]:
+        for paper_id, info in segment["papers"].items():
+            indexed[paper_id] = (segment, info["fingerprint"])
+
+    removed = [p for p in indexed if p not in current or indexed[p][1] != current[p][1]]
+    added = [p for p in current if p not in indexed or indexed[p][1] != current[p][1]]
+    for paper_id in removed:
+        del indexed[paper_id][0]["papers"][paper_id]
+
+    if added:
+        papers = {}
+        for paper_id in added:
+            with open(current[paper_id][0], 'r', encoding='utf-8') as f:
+                papers[paper_id] = f.read()
+        name = f"seg_{manifest['next_segment']:06d}"
+        ranges = write_segment(index_dir / name, papers, max_chars)
+        manifest["next_segment"] += 1
+        manifest["segments"].append({
+            "name": name,
+            "papers": {p: {"fingerprint": current[p][1], "chunks": ranges[p]} for p in added},
+        })
+
+    empty = drop_empty_segments(manifest)
+    write_manifest(index_dir, manifest)
+    # Only delete segment files once the manifest no longer points at them
+    for name in empty:
+        shutil.rmtree(index_dir / name, ignore_errors=True)
+    changed = len(set(added) & set(removed))
+    print(f"Index update: {len(added) - changed} new, {changed} changed, {len(removed) - changed} removed paper(s); "
+          f"{len(manifest['segments'])} segment(s)")
+    return manifest
+
+
+def compact_index(index_dir=INDEX_DIR, max_chars=MAX_CHUNK_CHARS):
+    """Rewrite all live chunks into a single segment, dropping retired ones."""
+    index_dir = Path(index_dir)
+    index = RetrievalIndex(index_dir)
+    manifest = read_manifest(index_dir)
+    papers = {}
+    fingerprints = {}
+    for segment, entry in zip(index.segments, manifest["segments"]):
+        for paper_id, info in entry["papers"].items():
+            start, end = info["chunks"]
+            chunks = [segment.chunk(doc) for doc in range(start, end)]
+            # Each chunk gets its own header, so re-chunking keeps the chunk boundaries
+            papers[paper_id] = "\n\n".join(f"# {c['section']}\n\n{c['text']}" for c in chunks)
+            fingerprints[paper_id] = info["fingerprint"]
+
+    old = [s["name"] for s in manifest["segments"]]
+    name = f"seg_{manifest['next_segment']:06d}"
+    ranges = write_segment(index_dir / name, papers, max_chars)
+    manifest["next_segment"] += 1
+    manifest["segments"] = [{
+        "name": name,
+        "papers": {p: {"fingerprint": fingerprints[p], "chunks": ranges[p]} for p in papers},
+    }]
+    write_manifest(index_dir, manifest)
+    for segment_name in old:
+        shutil.rmtree(index_dir / segment_name, ignore_errors=True)
+    print(f"Compacted {len(old)} segment(s) into {name}")
+
+
+class Segment:
+    """Read-only view of one segment with memory-mapped postings."""
+
+    def __init__(self, segment_dir, papers):
+        self.dir = Path(segment_dir)
+        with open(self.dir / "terms.json", 'r', encoding='utf-8') as f:
+            self.terms = json.load(f)
+        self.postings = np.load(self.dir / "postings.npy", mmap_mode="r")
+        self.tfs = np.load(self.dir / "tfs.npy", mmap_mode="r")
+        self.doc_lengths = np.load(self.dir / "doc_lengths.npy", mmap_mode="r")
+        self.offsets = np.load(self.dir / "offsets.npy", mmap_mode="r")
+        self.live = np.zeros(len(self.doc_lengths), dtype=bool)
+        for info in papers.values():
+            start, end = info["chunks"]
+            self.live[start:end] = True
+        self._chunks = open(self.dir / "chunks.jsonl", 'rb')
+
+    def term_postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None, None
+        start, count = entry
+        return self.postings[start:start + count], self.tfs[start:start + count]
+
+    def chunk(self, doc):
+        self._chunks.seek(int(self.offsets[doc]))
+        return json.loads(self._chunks.readline())
+
+
+class RetrievalIndex:
+    """BM25 over paragraph chunks of the processed papers, across all live segments."""
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = Path(index_dir)
+        manifest = read_manifest(self.index_dir)
+        self.segments = [Segment(self.index_dir / s["name"], s["papers"]) for s in manifest["segments"]]
+        self.num_docs = sum(int(s.live.sum()) for s in self.segments)
+        total_length = sum(int(np.asarray(s.doc_lengths)[s.live].sum()) for s in self.segments)
+        self.avg_length = total_length / self.num_docs if self.num_docs else 0.0
+
+    def search(self, query, k=3):
+        """Top-``k`` live chunks for ``query`` as dicts with paper_id, section, text and score."""
+        terms = set(tokenize(query))
+        if not terms or not self.num_docs:
+            return []
+
+        # Document frequencies over live chunks only, so retired chunks do not skew the IDF
+        matches = {}
+        df = {}
+        for term in terms:
+            for i, segment in enumerate(self.segments):
+                docs, tfs = segment.term_postings(term)
+                if docs is None:
+                    continue
+                live = segment.live[docs]
+                matches.setdefault(i, []).append((term, docs[live], tfs[live]))
+                df[term] = df.get(term, 0) + int(live.sum())
+
+        candidates = []
+        for i, term_matches in matches.items():
+            segment = self.segments[i]
+            scores = np.zeros(len(segment.doc_lengths), dtype=np.float32)
+            for term, docs, tfs in term_matches:
+                idf = math.log(1 + (self.num_docs - df[term] + 0.5) / (df[term] + 0.5))
+                tfs = tfs.astype(np.float32)
+                norm = K1 * (1 - B + B * segment.doc_lengths[docs] / self.avg_length)
+                scores[docs] += idf * tfs * (K1 + 1) / (tfs + norm) # Postings hold each doc once per term
+            top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+            candidates.extend((float(scores[doc]), i, int(doc)) for doc in top if scores[doc] > 0)
+
+        results = []
+        for score, i, doc in sorted(candidates, reverse=True)[:k]:
+            results.append({**self.segments[i].chunk(doc), "score": score})
+        return results
+
+
+def format_context(passages):
+    """Render retrieved passages as a numbered context block to prepend to a question."""
+    if not passages:
+        return ""
+    lines = ["Use the following excerpts from the papers if they are relevant:"]
+    for i, passage in enumerate(passages, 1):
+        title = f"{passage['paper_id']}, {passage['section']}" if passage["section"] else passage["paper_id"]
+        lines.append(f"[{i}] ({title}) {passage['text']}")
+    return "\n\n".join(lines) + "\n\nQuestion: "
+
+
+def synthetic_corpus(outputs_dir, num_papers, paragraphs=40, vocab_size=50000, seed=3407):
+    """Write ``num_papers`` random Zipf-distributed papers in the processed_text.md layout."""
+    rng = np.random.default_rng(seed)
+    vocab = np.array([f"w{i}" for i in range(vocab_size)])
+    for p in range(num_papers):
+        paper_dir = Path(outputs_dir) / f"paper{p:06d}"
+        paper_dir.mkdir(parents=True, exist_ok=True)
+        sections = []
+        for s in range(paragraphs // 8):
+            body = []
+            for _ in range(8):
+                words = vocab[np.minimum(rng.zipf(1.3, size=80), vocab_size) - 1]
+                body.append(" ".join(words))
+            sections.append(f"## Section {s}\n\n" + "\n\n".join(body))
+        with open(paper_dir / "processed_text.md", 'w', encoding='utf-8') as f:
+            f.write("\n\n".join(sections))
+
+
+def benchmark(index, queries, k=3, repeats=3):
+    """Time ``index.search`` over the queries and print p50/p95/max latency in ms."""
+    for query in queries: # Warm the page cache and term tables
+        index.search(query, k)
+    times = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, k)
+            times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    print(f"{len(times)} queries over {index.num_docs} chunks in {len(index.segments)} segment(s): "
+          f"p50 {times[len(times) // 2]:.2f} ms, p95 {times[int(len(times) * 0.95)]:.2f} ms, max {times[-1]:.2f} ms")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BM25 retrieval index over the processed papers")
+    parser.add_argument("--index-dir", default=str(INDEX_DIR))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Index new/changed papers and retire removed ones")
+    build.add_argument("--outputs-dir", default=str(OUTPUTS_DIR))
+    subparsers.add_parser("compact", help="Merge all segments into one")
+    query = subparsers.add_parser("query", help="Print the top-k passages for a question")
+    query.add_argument("question")
+    query.add_argument("-k", type=int, default=3)
+    bench = subparsers.add_parser("bench", help="Measure query latency")
+    bench.add_argument("--synthetic-papers", type=int, default=0,
+                       help="Benchmark a temporary synthetic corpus of this many papers instead")
+    bench.add_argument("-k", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        update_index(args.outputs_dir, args.index_dir)
+    elif args.command == "compact":
+        compact_index(args.index_dir)
+    elif args.command == "query":
+        for passage in RetrievalIndex(args.index_dir).search(args.question, args.k):
+            print(f"[{passage['score']:.2f}] {passage['paper_id']} / {passage['section']}\n{passage['text'][:300]}\n")
+    elif args.command == "bench":
+        from benchmark_models import QUESTIONS
+        if args.synthetic_papers:
+            import tempfile
+            with tempfile.TemporaryDirectory() as tmp:
+                start = time.perf_counter()
+                synthetic_corpus(Path(tmp) / "outputs", args.synthetic_papers)
+                update_index(Path(tmp) / "outputs", Path(tmp) / "index")
+                print(f"Built synthetic index in {time.perf_counter() - start:.1f}s")
+                queries = [" ".join(f"w{i}" for i in np.random.default_rng(q).integers(0, 2000, 8))
+                           for q in range(50)]
+                benchmark(RetrievalIndex(Path(tmp) / "index"), queries, args.k)
+        else:
+            benchmark(RetrievalIndex(args.index_dir), QUESTIONS, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+import torch
+
+DRAFT_TOKENS = 5
+
+
+def new_stats():
+    return {"drafted": 0, "accepted": 0, "target_forwards": 0, "new_tokens": 0, "seconds": 0.0}
+
+
+def report(stats):
+    """Print acceptance rate and tokens produced per (expensive) target forward pass."""
+    acceptance = stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0
+    per_forward = stats["new_tokens"] / stats["target_forwards"] if stats["target_forwards"] else 0.0
+    print(f"Speculative decoding: {stats['new_tokens']} tokens, acceptance rate {acceptance:.1%}, "
+          f"{per_forward:.2f} tokens per target forward, {stats['seconds']:.1f}s")
+
+
+def _crop(cache, length):
+    """Keep the first ``length`` positions of a KV cache."""
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+
+
+def _forward(model, input_ids, past_key_values):
+    outputs = model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+    return outputs.logits, outputs.past_key_values
+
+
+def speculative_generate(target, draft, tokenizer, prompt, max_new_tokens=256, num_draft_tokens=DRAFT_TOKENS,
+                         stats=None):
+    """Greedy-decode one prompt with ``draft`` proposing tokens and ``target`` verifying them.
+
+    Each round the draft greedily proposes ``num_draft_tokens`` tokens, the
+    target scores all of them in one forward pass, the longest prefix that
+    matches the target's own greedy choices is kept plus the target's next
+    token, and both KV caches are cropped back to the accepted sequence. The
+    result is the target's greedy output; only the number of target forward
+    passes changes. Both models must share the tokenizer.
+    """
+    stats = stats if stats is not None else new_stats()
+    start = time.perf_counter()
+    device = next(target.parameters()).device
+    draft_device = next(draft.parameters()).device
+    eos_token_ids = target.generation_config.eos_token_id
+    if eos_token_ids is None:
+        eos_token_ids = tokenizer.eos_token_id
+    eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids])
+
+    sequence = tokenizer(prompt)["input_ids"]
+    prompt_len = len(sequence)
+    target_cache = None
+    draft_cache = None
+    draft_len = 0 # Tokens of ``sequence`` already in the draft cache
+
+    with torch.inference_mode():
+        # The caches always cover sequence[:-1]; the last token is fed with the next round's input
+        if prompt_len > 1:
+            _, target_cache = _forward(target, torch.tensor([sequence[:-1]], device=device), None)
+            stats["target_forwards"] += 1
+
+        while True:
+            remaining = max_new_tokens - (len(sequence) - prompt_len)
+            if remaining <= 0:
+                break
+            k = min(num_draft_tokens, remaining - 1)
+
+            # Draft: catch up on the accepted tokens it has not seen, then propose k tokens one by one
+            proposal = []
+            if k > 0:
+                draft_input = sequence[draft_len:]
+                for _ in range(k):
+                    logits, draft_cache = _forward(draft, torch.tensor([draft_input], device=draft_device),
+                                                   draft_cache)
+                    draft_len += len(draft_input)
+                    token = int(logits[0, -1].argmax())
+                    proposal.append(token)
+                    if token in eos_token_ids:
+                        break
+                    draft_input = [token]
+
+            # Target: verify the last accepted token plus the proposal in one forward pass
+            verify_input = torch.tensor([[sequence[-1]] + proposal], device=device)
+            logits, target_cache = _forward(target, verify_input, target_cache)
+            stats["target_forwards"] += 1
+            choices = logits[0].argmax(-1).tolist()
+
+            accepted = 0
+            while accepted < len(proposal) and proposal[accepted] == choices[accepted]:
+                accepted += 1
+            new_tokens = proposal[:accepted] + [choices[accepted]]
+            stats["drafted"] += len(proposal)
+            stats["accepted"] += accepted
+
+            done = False
+            for i, token in enumerate(new_tokens):
+                if token in eos_token_ids:
+                    new_tokens = new_tokens[:i + 1]
+                    done = True
+                    break
+            sequence.extend(new_tokens)
+
+            # Drop cache entries for rejected draft tokens; the newest token is fed next round
+            _crop(target_cache, len(sequence) - 1)
+            draft_len = min(draft_len, len(sequence) - 1)
+            if draft_cache is not None:
+                _crop(draft_cache, draft_len)
+            if done:
+                break
+
+    generated = sequence[prompt_len:prompt_len + max_new_tokens]
+    stats["new_tokens"] += len(generated)
+    stats["seconds"] += time.perf_counter() - start
+    return tokenizer.decode(generated, skip_special_tokens=True).strip()
+
+
+def speculative_generate_all(target, draft, tokenizer, prompts, max_new_tokens=256, num_draft_tokens=DRAFT_TOKENS,
+                             stats=None):
+    """Answer prompts one at a time with draft-model assistance (verification is per sequence)."""
+    answers = []
+    for i, prompt in enumerate(prompts):
+        answers.append(speculative_generate(target, draft, tokenizer, prompt, max_new_tokens, num_draft_tokens,
+                                            stats))
+        print(f"Generated {i + 1}/{len(prompts)}")
+    return answers
+
+
+def load_draft_model(model_name, load_in_4bit=True, **kwargs):
+    """Load a small draft model; it must use the same tokenizer (vocabulary) as the target."""
+    from transformers import AutoModelForCausalLM
+    from model_loading import quantization_kwargs
+
+    print(f"Loading draft model: {model_name}")
+    model = AutoModelForCausalLM.from_pretrained(model_name, **quantization_kwargs(load_in_4bit), **kwargs)
+    model.eval()
+    return model
+
+
+def self_check(max_new_tokens=48):
+    """Check on CPU with two tiny models that speculative output equals plain greedy output."""
+    from generation import generate_batch
+    from tiny_models import build_tiny_llama, build_byte_tokenizer
+
+    tokenizer = build_byte_tokenizer()
+    target = build_tiny_llama(tokenizer, hidden_size=128, num_layers=6).eval()
+    prompts = [
+        "Explain what a transmon is.",
+        "Describe cross-entropy benchmarking in the characterization of multi-qubit processors.",
+        "What is a qubit?",
+    ]
+
+    start = time.perf_counter()
+    expected = [generate_batch(target, tokenizer, [p], max_new_tokens=max_new_tokens)[0] for p in prompts]
+    baseline_time = time.perf_counter() - start
+
+    # A perfect draft (the target itself) and an unrelated random one bound the acceptance rate
+    drafts = {
+        "self-draft": target,
+        "random draft": build_tiny_llama(tokenizer, hidden_size=32, num_layers=1, seed=7).eval(),
+    }
+    failed = False
+    for name, draft in drafts.items():
+        stats = new_stats()
+        actual = [speculative_generate(target, draft, tokenizer, p, max_new_tokens, stats=stats) for p in prompts]
+        mismatches = sum(a != e for a, e in zip(actual, expected))
+        print(f"[{name}] mismatches vs greedy: {mismatches}/{len(prompts)}, "
+              f"speedup {baseline_time / stats['seconds']:.2f}x")
+        report(stats)
+        failed = failed or mismatches > 0
+    if failed:
+        raise RuntimeError("Speculative decoding output differs from greedy decoding")
+    print("Speculative decoding verification passed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Draft-model assisted greedy decoding")
+    parser.add_argument("--self-check", action="store_true", help="Verify with two tiny CPU models")
+    parser.add_argument("--max-new-tokens", type=int, default=48)
+    args = parser.parse_args()
+    if args.self_check:
+        self_check(args.max_new_tokens)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+import argparse
+import gc
+import importlib
+import json
+import time
+from pathlib import Path
+
+import torch
+from datasets import load_dataset
+from transformers import set_seed
+
+from length_sampler import LengthGroupedTrainerMixin
+from telemetry import TelemetryCallback
+from validation import evaluate_perplexity, prepare_validation_examples, select_examples
+
+# The training script name starts with a digit, so it cannot be imported with a plain import statement
+fine_tuning = importlib.import_module("04_fine_tuning")
+
+SWEEP_DIR = Path("sweeps")
+
+# Each entry overrides lora_config ("lora") and training_config ("training") from 04_fine_tuning.py
+DEFAULT_SWEEP = [
+    {"name": "r16_a16", "lora": {"r": 16, "lora_alpha": 16}},
+    {"name": "r32_a16", "lora": {"r": 32, "lora_alpha": 16}},
+    {"name": "r16_a32", "lora": {"r": 16, "lora_alpha": 32}},
+    {"name": "r16_attn_only", "lora": {"r": 16, "target_modules": ["q_proj", "k_proj", "v_proj", "o_proj"]}},
+    {"name": "r16_lr1e-4", "lora": {"r": 16}, "training": {"learning_rate": 1e-4}},
+]
+
+
+def load_base(model_name):
+    """Load the base model once for the whole sweep."""
+    if model_name == "tiny":
+        from tiny_models import build_tiny_model_and_tokenizer
+        return build_tiny_model_and_tokenizer()
+    return fine_tuning.load_model(model_name)
+
+
+def attach_adapter(base, lora_overrides, use_unsloth):
+    """Attach a freshly initialised LoRA adapter to the resident base model."""
+    set_seed(fine_tuning.training_config["seed"])
+    if use_unsloth:
+        return fine_tuning.add_lora(base, **lora_overrides)
+    from peft import LoraConfig, get_peft_model
+    return get_peft_model(base, LoraConfig(task_type="CAUSAL_LM", **{**fine_tuning.lora_config, **lora_overrides}))
+
+
+def build_cpu_trainer(model, tokenizer, train_dataset, data_collator, packing, callbacks, **overrides):
+    """Plain transformers Trainer with the training script's settings, for the tiny CPU model."""
+    from transformers import Trainer, TrainingArguments
+
+    class BucketedTrainer(LengthGroupedTrainerMixin, Trainer):
+        """Trainer that batches examples of similar length to cut padding."""
+    BucketedTrainer.shuffle_window = fine_tuning.shuffle_window
+
+    if packing:
+        model.config.use_cache = False
+    config = {**fine_tuning.training_config, **overrides}
+    config["optim"] = "adamw_torch" # adamw_8bit needs bitsandbytes on a GPU
+    trainer_class = Trainer if packing else BucketedTrainer
+    return trainer_class(
+        model=model,
+        args=TrainingArguments(use_cpu=True, remove_unused_columns=False, disable_tqdm=True, **config),
+        train_dataset=train_dataset,
+        data_collator=data_collator,
+        callbacks=callbacks,
+    )
+
+
+def run_sweep(model_name, sweep, output_dir, train_file, validation_file, max_steps=None, max_seq_length=None):
+    """Train, evaluate and save one adapter per sweep entry on a single resident base model."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    use_unsloth = model_name != "tiny"
+    max_seq_length = max_seq_length or fine_tuning.max_seq_length
+
+    start = time.perf_counter()
+    base, tokenizer = load_base(model_name)
+    base_load_time = time.perf_counter() - start
+    print(f"Base model loaded once in {base_load_time:.1f}s")
+
+    train_dataset, data_collator = fine_tuning.load_train_dataset(
+        tokenizer, train_file, max_seq_length=max_seq_length, mask_dtype=base.dtype)
+    validation_dataset = load_dataset("json", data_files=str(validation_file), split="train")
+    validation_dataset = fine_tuning.format_dataset(validation_dataset, tokenizer)
+    validation_examples = select_examples(
+        prepare_validation_examples(validation_dataset, tokenizer, max_seq_length),
+        fine_tuning.eval_max_examples, fine_tuning.eval_token_budget, seed=fine_tuning.training_config["seed"])
+
+    results = []
+    for i, entry in enumerate(sweep):
+        name = entry["name"]
+        run_dir = output_dir / name
+        print(f"\n=== Sweep {i+1}/{len(sweep)}: {name} ===")
+
+        start = time.perf_counter()
+        model = attach_adapter(base, entry.get("lora", {}), use_unsloth)
+        attach_time = time.perf_counter() - start
+        trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        if i == 0 and fine_tuning.packing:
+            fine_tuning.check_packed_attention(model, train_dataset, data_collator)
+
+        overrides = {"output_dir": str(run_dir), **entry.get("training", {})}
+        if max_steps:
+            overrides["max_steps"] = max_steps
+        telemetry = TelemetryCallback(run_dir / "telemetry.jsonl", tokenizer.pad_token_id, run_name=name)
+        if use_unsloth:
+            trainer = fine_tuning.build_trainer(model, tokenizer, train_dataset, data_collator,
+                                                callbacks=[telemetry], **overrides)
+        else:
+            trainer = build_cpu_trainer(model, tokenizer, train_dataset, data_collator, fine_tuning.packing,
+                                        [telemetry], **overrides)
+
+        start = time.perf_counter()
+        train_output = trainer.train()
+        train_time = time.perf_counter() - start
+
+        report = evaluate_perplexity(model, validation_examples, tokenizer.pad_token_id,
+                                     fine_tuning.eval_batch_tokens, fine_tuning.eval_time_budget)
+        model.save_pretrained(str(run_dir / "adapter"))
+        tokenizer.save_pretrained(str(run_dir / "adapter"))
+
+        results.append({
+            "name": name,
+            "lora": {**fine_tuning.lora_config, **entry.get("lora", {})},
+            "training": entry.get("training", {}),
+            "trainable_params": trainable,
+            "attach_time": attach_time,
+            "train_time": train_time,
+            "tokens_per_sec": telemetry.totals["real_tokens"] / train_time if train_time else 0.0,
+            "train_loss": train_output.training_loss,
+            "val_loss": report["loss"],
+            "val_perplexity": report["perplexity"],
+            "adapter_dir": str(run_dir / "adapter"),
+        })
+        print(f"{name}: train {train_time:.1f}s, val ppl {report['perplexity']:.3f}")
+
+        # Detach the adapter so the next entry starts from the untouched base weights
+        base = fine_tuning.remove_lora(model)
+        del trainer, model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    summary = {"base_model": model_name, "base_load_time": base_load_time, "results": results}
+    with open(output_dir / "results.json", 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    save_table(summary, output_dir / "sweep_results.md")
+    return summary
+
+
+def save_table(summary, path):
+    """Write the sweep comparison as a Markdown table."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("# LoRA Sweep Results\n\n")
+        f.write(f"**Base Model**: {summary['base_model']} (loaded once in {summary['base_load_time']:.1f}s)\n\n")
+        f.write("| Config | r | alpha | Target modules | LR | Trainable params | Train time (s) "
+                "| Tokens/s | Train loss | Val loss | Val ppl |\n")
+        f.write("|---|---|---|---|---|---|---|---|---|---|---|\n")
+        for r in summary["results"]:
+            lr = r["training"].get("learning_rate", "default")
+            f.write(f"| {r['name']} | {r['lora']['r']} | {r['lora']['lora_alpha']} "
+                    f"| {', '.join(r['lora']['target_modules'])} | {lr} | {r['trainable_params']:,} "
+                    f"| {r['train_time']:.1f} | {r['tokens_per_sec']:.0f} | {r['train_loss']:.4f} "
+                    f"| {r['val_loss']:.4f} | {r['val_perplexity']:.3f} |\n")
+    print(f"Sweep results saved to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train several LoRA configs on one resident base model")
+    parser.add_argument("--config", help="JSON file with a list of {name, lora, training} entries")
+    parser.add_argument("--model", default=fine_tuning.MODEL_NAME, help="Base model, or 'tiny' for a CPU smoke run")
+    parser.add_argument("--output-dir", default=str(SWEEP_DIR))
+    parser.add_argument("--train-file", default=str(fine_tuning.TRAIN_FILE))
+    parser.add_argument("--validation-file", default=str(fine_tuning.VALIDATION_FILE))
+    parser.add_argument("--max-steps", type=int, default=None, help="Override max_steps for every entry")
+    parser.add_argument("--max-seq-length", type=int, default=None)
+    args = parser.parse_args()
+
+    sweep = DEFAULT_SWEEP
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            sweep = json.load(f)
+
+    run_sweep(args.model, sweep, args.output_dir, args.train_file, args.validation_file,
+              args.max_steps, args.max_seq_length)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import json
+import os
+import resource
+import time
+from pathlib import Path
+
+import torch
+from transformers import TrainerCallback
+
+
+def peak_host_memory_bytes():
+    """Peak resident set size of this process (Linux reports ru_maxrss in KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_tokens(inputs, pad_token_id):
+    """Return ``(token_slots, real_tokens)`` for the keyword inputs of a forward call."""
+    input_ids = inputs.get("input_ids")
+    if input_ids is None:
+        return 0, 0
+    attention_mask = inputs.get("attention_mask")
+    if attention_mask is not None and attention_mask.dim() == 2:
+        real = int(attention_mask.sum())
+    else:
+        # Packed batches carry no 2D mask; padding is the only place pad ids appear
+        real = int((input_ids != pad_token_id).sum())
+    return input_ids.numel(), real
+
+
+class TelemetryCallback(TrainerCallback):
+    """Record per-step throughput, timing and memory to JSONL and an optional Prometheus textfile.
+
+    Tokens are counted by a forward pre-hook on the model while it is in
+    training mode, i.e. when a micro-batch is actually consumed (the data
+    loader prefetches ahead, and validation runs in eval mode). Data-loader
+    wait is the time between the end of one step and the start of the next,
+    which is where the trainer fetches the next micro-batches.
+    Optimizer time spans the ``on_pre_optimizer_step``/``on_optimizer_step``
+    hooks and is reported as None on transformers versions without them.
+    """
+
+    def __init__(self, jsonl_path, pad_token_id, prometheus_path=None, run_name="fine_tuning"):
+        self.pad_token_id = pad_token_id
+        self.jsonl_path = Path(jsonl_path)
+        self.prometheus_path = Path(prometheus_path) if prometheus_path else None
+        self.run_name = run_name
+        self.totals = {"tokens": 0, "real_tokens": 0, "pad_tokens": 0}
+        self._reset_step()
+        self.last_step_end = None
+        self.hook = None
+
+    def _reset_step(self):
+        self.step_tokens = 0
+        self.step_real_tokens = 0
+        self.optimizer_start = None
+        self.optimizer_time = None
+
+    def count_forward(self, module, args, kwargs):
+        """Forward pre-hook: add a training micro-batch to the current step."""
+        if module.training:
+            token_slots, real_tokens = count_tokens(kwargs, self.pad_token_id)
+            self.step_tokens += token_slots
+            self.step_real_tokens += real_tokens
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if model is not None and self.hook is None:
+            self.hook = model.register_forward_pre_hook(self.count_forward, with_kwargs=True)
+        self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+        self.last_step_end = time.perf_counter()
+        self.step_begin = self.last_step_end
+        self._reset_device_peak()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.step_begin = time.perf_counter()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._synchronize()
+        self.optimizer_start = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self.optimizer_start is not None:
+            self._synchronize()
+            self.optimizer_time = time.perf_counter() - self.optimizer_start
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self._synchronize()
+        now = time.perf_counter()
+        step_time = now - self.last_step_end
+        data_wait = self.step_begin - self.last_step_end
+        self.last_step_end = now
+
+        pad_tokens = self.step_tokens - self.step_real_tokens
+        self.totals["tokens"] += self.step_tokens
+        self.totals["real_tokens"] += self.step_real_tokens
+        self.totals["pad_tokens"] += pad_tokens
+
+        record = {
+            "step": state.global_step,
+            "time": time.time(),
+            "tokens": self.step_tokens,
+            "real_tokens": self.step_real_tokens,
+            "pad_tokens": pad_tokens,
+            "tokens_per_sec": self.step_real_tokens / step_time if step_time > 0 else 0.0,
+            "step_time": step_time,
+            "data_wait_time": data_wait,
+            "optimizer_time": self.optimizer_time,
+            "peak_host_memory_bytes": peak_host_memory_bytes(),
+            "peak_device_memory_bytes": self._device_peak(),
+        }
+        self._reset_step()
+        self._reset_device_peak()
+
+        if state.is_world_process_zero:
+            with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+            if self.prometheus_path:
+                self.write_prometheus(record)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.hook is not None:
+            self.hook.remove()
+            self.hook = None
+
+    def write_prometheus(self, record):
+        """Rewrite the node-exporter textfile with the latest step (atomically, via rename)."""
+        label = f'{{run="{self.run_name}"}}'
+        gauges = [
+            ("llm_ft_step", "Last completed optimizer step", record["step"]),
+            ("llm_ft_step_tokens", "Token slots in the last step", record["tokens"]),
+            ("llm_ft_step_pad_tokens", "Pad tokens in the last step", record["pad_tokens"]),
+            ("llm_ft_tokens_per_second", "Real tokens per second in the last step", record["tokens_per_sec"]),
+            ("llm_ft_step_seconds", "Wall time of the last step", record["step_time"]),
+            ("llm_ft_data_wait_seconds", "Data-loader wait in the last step", record["data_wait_time"]),
+            ("llm_ft_optimizer_seconds", "Optimizer time in the last step", record["optimizer_time"]),
+            ("llm_ft_peak_host_memory_bytes", "Peak host RSS of the training process",
+             record["peak_host_memory_bytes"]),
+            ("llm_ft_peak_device_memory_bytes", "Peak device memory allocated in the last step",
+             record["peak_device_memory_bytes"]),
+        ]
+        counters = [
+            ("llm_ft_tokens_total", "Token slots processed", self.totals["tokens"]),
+            ("llm_ft_real_tokens_total", "Real (non-pad) tokens processed", self.totals["real_tokens"]),
+            ("llm_ft_pad_tokens_total", "Pad tokens processed", self.totals["pad_tokens"]),
+        ]
+
+        lines = []
+        for kind, metrics in (("gauge", gauges), ("counter", counters)):
+            for name, help_text, value in metrics:
+                if value is None:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{label} {value}")
+
+        self.prometheus_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.prometheus_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_path)
+
+    def _synchronize(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def _device_peak(self):
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated()
+        return None
+
+    def _reset_device_peak(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
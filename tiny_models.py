@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# Tiny, randomly initialised stand-ins for the 8B model so data-path and
+# inference changes can be checked on a CPU-only box without downloads.
+SPECIAL_TOKENS = ["<s>", "</s>", "<pad>"]
+
+
+def build_byte_tokenizer():
+    """Build a byte-level tokenizer (one token per byte) that needs no training files."""
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + sorted(alphabet))}
+
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.add_special_tokens(SPECIAL_TOKENS)
+
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+    )
+
+
+def build_tiny_llama(tokenizer, hidden_size=64, num_layers=2, max_positions=4096, seed=3407):
+    """Build a randomly initialised Llama model sized for CPU smoke tests."""
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=max_positions,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config)
+    model.eval()
+    return model
+
+
+def build_tiny_model_and_tokenizer(**kwargs):
+    """Return a ``(model, tokenizer)`` pair with the same interface as the real loaders."""
+    tokenizer = build_byte_tokenizer()
+    model = build_tiny_llama(tokenizer, **kwargs)
+    return model, tokenizer
+
+
+if __name__ == "__main__":
+    model, tokenizer = build_tiny_model_and_tokenizer()
+    inputs = tokenizer(["Explain what a transmon is."], return_tensors="pt")
+    with torch.no_grad():
+        outputs = model(**inputs)
+    print(f"Vocab size: {len(tokenizer)}")
+    print(f"Parameters: {sum(p.numel() for p in model.parameters())}")
+    print(f"Logits shape: {outputs.logits.shape}")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+import argparse
+import importlib
+import re
+from pathlib import Path
+
+MODEL_NAME = "unsloth/Meta-Llama-3.1-8B"
+REPORT_FILE = "token_fertility.md"
+
+MATH_PATTERN = re.compile(r'\$\$\n.*?\n\$\$|\$[^$]+?\$', re.DOTALL) # As saved by LatexProcessor.clean_latex_commands
+
+# Constructs inside math and in the surrounding text; the first pattern that claims a character wins
+MATH_CONSTRUCTS = [
+    ("math: labels/numbering", re.compile(r'\\(?:label\{[^}]*\}|nonumber|notag)')),
+    ("math: \\left/\\right sizing", re.compile(r'\\(?:left|right|[Bb]igg?[lrm]?)(?![A-Za-z])\.?')),
+    ("math: spacing", re.compile(r'\\[,;:!]|\\q?quad(?![A-Za-z])|~')),
+    ("math: font/style", re.compile(r'\\(?:mathrm|mathbf|mathit|mathsf|mathtt|mathcal|mathbb|mathfrak|boldsymbol|bm|rm'
+                                    r'|text|textrm|operatorname|displaystyle|textstyle)(?![A-Za-z])')),
+    ("math: other commands", re.compile(r'\\[A-Za-z]+')),
+    ("math: braces/scripts", re.compile(r'[{}_^]')),
+    ("math: alignment", re.compile(r'&|\\\\')),
+]
+TEXT_CONSTRUCTS = [
+    ("text: leftover LaTeX", re.compile(r'\\[A-Za-z]+\*?(?:\{[^}\n]*\})?')),
+    ("text: citations", re.compile(r'\[[^\]\n]{1,300}\]')),
+    ("text: headers", re.compile(r'^#+ ', re.MULTILINE)),
+]
+COMMAND_PATTERN = re.compile(r'\\[A-Za-z]+')
+
+
+def label_characters(text):
+    """Return the construct label of every character and ``(start, end, command)`` spans of math commands."""
+    labels = ["text: prose"] * len(text)
+    claimed = [False] * len(text)
+    commands = []
+
+    def claim(label, start, end):
+        for i in range(start, end):
+            if not claimed[i]:
+                labels[i] = label
+                claimed[i] = True
+
+    for math in MATH_PATTERN.finditer(text):
+        segment = math.group(0)
+        for label, pattern in MATH_CONSTRUCTS:
+            for match in pattern.finditer(segment):
+                claim(label, math.start() + match.start(), math.start() + match.end())
+        for match in COMMAND_PATTERN.finditer(segment):
+            commands.append((math.start() + match.start(), math.start() + match.end(), match.group(0)))
+        claim("math: symbols/variables", math.start(), math.end())
+    for label, pattern in TEXT_CONSTRUCTS:
+        for match in pattern.finditer(text):
+            claim(label, match.start(), match.end())
+    return labels, commands
+
+
+def analyze(text, tokenizer, totals=None, command_totals=None):
+    """Attribute every token of ``text`` to the construct its first non-space character belongs to.
+
+    Accumulates ``{label: {"chars", "tokens"}}`` into ``totals`` and
+    ``{command: {"uses", "tokens"}}`` for math commands into ``command_totals``.
+    Returns the number of tokens.
+    """
+    totals = totals if totals is not None else {}
+    command_totals = command_totals if command_totals is not None else {}
+    labels, commands = label_characters(text)
+    for label in labels:
+        totals.setdefault(label, {"chars": 0, "tokens": 0})["chars"] += 1
+
+    command_at = {}
+    for start, end, name in commands:
+        command_totals.setdefault(name, {"uses": 0, "tokens": 0})["uses"] += 1
+        for i in range(start, end):
+            command_at[i] = name
+
+    offsets = tokenizer(text, return_offsets_mapping=True, add_special_tokens=False)["offset_mapping"]
+    for start, end in offsets:
+        position = start
+        while position < end - 1 and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            continue
+        totals.setdefault(labels[position], {"chars": 0, "tokens": 0})["tokens"] += 1
+        if position in command_at:
+            command_totals[command_at[position]]["tokens"] += 1
+    return len(offsets)
+
+
+def construct_table(before, after, top=15):
+    """Markdown table of characters, tokens and tokens/char per construct, before and after normalization."""
+    total_tokens = sum(v["tokens"] for v in before.values()) or 1
+    lines = ["| Construct | Chars | Tokens | Share of tokens | Tokens/char | Tokens after normalization |",
+             "|---|---:|---:|---:|---:|---:|"]
+    for label, values in sorted(before.items(), key=lambda item: -item[1]["tokens"])[:top]:
+        fertility = values["tokens"] / values["chars"] if values["chars"] else 0.0
+        lines.append(f"| {label} | {values['chars']} | {values['tokens']} | {values['tokens'] / total_tokens:.1%} | "
+                     f"{fertility:.3f} | {after.get(label, {}).get('tokens', 0)} |")
+    return lines
+
+
+def command_table(command_totals, top=20):
+    lines = ["| Math command | Uses | Tokens | Tokens/use |", "|---|---:|---:|---:|"]
+    for name, values in sorted(command_totals.items(), key=lambda item: -item[1]["tokens"])[:top]:
+        lines.append(f"| `{name}` | {values['uses']} | {values['tokens']} | {values['tokens'] / values['uses']:.2f} |")
+    return lines
+
+
+def run(sources_dir, tokenizer, references=None, limit=None):
+    """Convert each paper with and without normalization; returns the report as Markdown lines."""
+    latex = importlib.import_module("02_process_latex")
+    sources_dir = Path(sources_dir)
+    references = references or sorted(d.name for d in sources_dir.iterdir() if d.is_dir())
+    references = references[:limit] if limit else references
+    plain = latex.LatexProcessor(sources_dir, "outputs")
+    normalized = latex.LatexProcessor(sources_dir, "outputs", normalize=True)
+
+    before, after, commands, after_commands = {}, {}, {}, {}
+    rows = []
+    for reference in references:
+        converted = plain.convert_file_src(reference)
+        converted_normalized = normalized.convert_file_src(reference)
+        if converted is None or converted_normalized is None:
+            continue
+        tokens = analyze(converted[0], tokenizer, before, commands)
+        tokens_after = analyze(converted_normalized[0], tokenizer, after, after_commands)
+        rows.append((reference, len(converted[0]), tokens, tokens_after))
+
+    total_before = sum(row[2] for row in rows)
+    total_after = sum(row[3] for row in rows)
+    total_chars = sum(row[1] for row in rows)
+    saved = (total_before - total_after) / total_before if total_before else 0.0
+    lines = [
+        "# LaTeX Token Fertility",
+        "",
+        f"Tokenizer: `{tokenizer.name_or_path}`, {len(rows)} papers, {total_chars} characters, "
+        f"{total_before} tokens ({total_before / max(total_chars, 1):.3f} tokens/char).",
+        f"Normalization (macro expansion and math canonicalization): {total_after} tokens, {saved:.1%} fewer.",
+        "",
+        "## Tokens by construct",
+        "",
+    ] + construct_table(before, after) + [
+        "",
+        "## Most expensive math commands (before normalization)",
+        "",
+    ] + command_table(commands) + [
+        "",
+        "## Savings per paper",
+        "",
+        "| Paper | Chars | Tokens | Tokens normalized | Saved |",
+        "|---|---:|---:|---:|---:|",
+    ]
+    for reference, chars, tokens, tokens_after in sorted(rows, key=lambda row: row[3] / row[2] if row[2] else 1):
+        lines.append(f"| {reference} | {chars} | {tokens} | {tokens_after} | "
+                     f"{(tokens - tokens_after) / tokens if tokens else 0.0:.1%} |")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure tokens per character by LaTeX construct and the savings "
+                                                 "from macro expansion and math normalization")
+    parser.add_argument("--sources-dir", default="sources")
+    parser.add_argument("--tokenizer", default=MODEL_NAME, help="Tokenizer name or directory (needs a fast tokenizer)")
+    parser.add_argument("--papers", nargs="+", help="References to analyze (default: all in --sources-dir)")
+    parser.add_argument("--limit", type=int, default=None, help="Analyze at most this many papers")
+    parser.add_argument("--output", default=REPORT_FILE)
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    lines = run(args.sources_dir, tokenizer, args.papers, args.limit)
+    print("\n".join(lines))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"\nReport saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+import argparse
+import json
+import math
+import random
+import time
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+from transformers import TrainerCallback
+
+# Prompt prefixes written by DatasetPreparer.create_enhanced_dataset, in enhanced_dataset_info.json order
+EXAMPLE_TYPE_PREFIXES = [
+    ("summary", "Please summarize the paper"),
+    ("methodology", "What methodology was used"),
+    ("math_concepts", "Explain the key mathematical concepts"),
+    ("sections", "Explain the '"),
+    ("full_paper", "Provide the full content"),
+]
+
+
+def example_type(prompt):
+    """Map a dataset prompt back to the example type that produced it."""
+    for name, prefix in EXAMPLE_TYPE_PREFIXES:
+        if prompt.startswith(prefix):
+            return name
+    return "other"
+
+
+def prepare_validation_examples(dataset, tokenizer, max_seq_length):
+    """Tokenize a formatted dataset (``text`` and ``prompt`` columns) for evaluation."""
+    input_ids = tokenizer(list(dataset["text"]), add_special_tokens=True)["input_ids"]
+    return [
+        {"input_ids": ids[:max_seq_length], "type": example_type(prompt)}
+        for ids, prompt in zip(input_ids, dataset["prompt"])
+    ]
+
+
+def prepare_conditional_examples(prompts, answers, tokenizer, max_seq_length, types=None):
+    """Tokenize prompt/answer pairs so only the answer tokens are scored (conditional log-likelihood).
+
+    Prompt and answer are tokenized separately and concatenated, so the
+    boundary is exact; long answers are truncated to ``max_seq_length``.
+    """
+    prompt_ids = tokenizer(list(prompts), add_special_tokens=True)["input_ids"]
+    answer_ids = tokenizer(list(answers), add_special_tokens=False)["input_ids"]
+    examples = []
+    for i, (prompt, answer) in enumerate(zip(prompt_ids, answer_ids)):
+        ids = (prompt + answer + [tokenizer.eos_token_id])[:max_seq_length]
+        examples.append({"input_ids": ids, "target_start": min(len(prompt), len(ids) - 1), "id": i,
+                         "type": types[i] if types is not None else "other"})
+    return examples
+
+
+def select_examples(examples, max_examples=None, token_budget=None, seed=3407):
+    """Pick a fixed random subsample, capped by example count and total tokens.
+
+    The same seed gives the same subsample at every evaluation, so the loss
+    curve compares like with like.
+    """
+    order = list(range(len(examples)))
+    random.Random(seed).shuffle(order)
+    if max_examples is not None:
+        order = order[:max_examples]
+
+    selected = []
+    tokens = 0
+    for idx in order:
+        length = len(examples[idx]["input_ids"])
+        if token_budget is not None and tokens + length > token_budget:
+            continue
+        selected.append(examples[idx])
+        tokens += length
+    return selected
+
+
+def length_sorted_batches(examples, max_batch_tokens, max_batch_size=64):
+    """Group examples, longest first, into batches of at most ``max_batch_tokens`` padded tokens."""
+    ordered = sorted(examples, key=lambda e: len(e["input_ids"]), reverse=True)
+    batches = []
+    batch = []
+    for example in ordered:
+        # The first example of a batch is its longest, so it sets the padded width
+        width = len(batch[0]["input_ids"]) if batch else len(example["input_ids"])
+        if batch and (width * (len(batch) + 1) > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(example)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def evaluate_perplexity(model, examples, pad_token_id, max_batch_tokens=16384, time_budget=None):
+    """Compute token-level loss and perplexity per example type in length-sorted batches.
+
+    Stops early once ``time_budget`` seconds have passed and reports how many
+    examples were covered. Examples with a ``target_start`` are scored only
+    from that token on, and examples with an ``id`` get their own entry in
+    ``report["per_example"]``.
+    """
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+
+    totals = {}
+    per_example = {}
+    covered = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for batch in length_sorted_batches(examples, max_batch_tokens):
+            if time_budget is not None and time.perf_counter() - start > time_budget:
+                break
+
+            width = len(batch[0]["input_ids"])
+            input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+            target_mask = torch.zeros((len(batch), width - 1))
+            for i, example in enumerate(batch):
+                ids = example["input_ids"]
+                input_ids[i, :len(ids)] = torch.tensor(ids)
+                attention_mask[i, :len(ids)] = 1
+                # Shifted: position j scores token j + 1, so the first scored token is target_start
+                target_mask[i, max(example.get("target_start", 1) - 1, 0):len(ids) - 1] = 1
+            input_ids = input_ids.to(device)
+            attention_mask = attention_mask.to(device)
+            target_mask = target_mask.to(device)
+
+            logits = model(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).logits
+            # Token i predicts token i + 1; padding (and any prompt) is excluded through the target mask
+            nll = F.cross_entropy(
+                logits[:, :-1].float().transpose(1, 2), input_ids[:, 1:], reduction="none",
+            )
+            example_nll = (nll * target_mask).sum(dim=1).tolist()
+            example_tokens = target_mask.sum(dim=1).tolist()
+
+            for example, nll_sum, tokens in zip(batch, example_nll, example_tokens):
+                stats = totals.setdefault(example["type"], {"nll": 0.0, "tokens": 0, "examples": 0})
+                stats["nll"] += nll_sum
+                stats["tokens"] += int(tokens)
+                stats["examples"] += 1
+                if "id" in example:
+                    per_example[example["id"]] = {"nll": nll_sum, "tokens": int(tokens)}
+            covered += len(batch)
+
+    if was_training:
+        model.train()
+
+    report = {"elapsed": time.perf_counter() - start, "examples": covered, "requested": len(examples), "types": {}}
+    overall_nll = sum(s["nll"] for s in totals.values())
+    overall_tokens = sum(s["tokens"] for s in totals.values())
+    for name, stats in sorted(totals.items()):
+        loss = stats["nll"] / max(stats["tokens"], 1)
+        report["types"][name] = {"loss": loss, "perplexity": math.exp(loss),
+                                 "tokens": stats["tokens"], "examples": stats["examples"]}
+    report["loss"] = overall_nll / max(overall_tokens, 1)
+    report["perplexity"] = math.exp(report["loss"])
+    report["tokens"] = overall_tokens
+    if per_example:
+        report["per_example"] = per_example
+    return report
+
+
+def print_report(report, step=None):
+    """Print a per-type perplexity table."""
+    header = f"--- Validation (step {step}) ---" if step is not None else "--- Validation ---"
+    print(header)
+    for name, stats in report["types"].items():
+        print(f"{name:>14}: ppl {stats['perplexity']:10.3f}  loss {stats['loss']:.4f}  "
+              f"({stats['examples']} examples, {stats['tokens']} tokens)")
+    print(f"{'overall':>14}: ppl {report['perplexity']:10.3f}  loss {report['loss']:.4f}  "
+          f"({report['examples']}/{report['requested']} examples in {report['elapsed']:.1f}s)")
+
+
+class FastValidationCallback(TrainerCallback):
+    """Run ``evaluate_perplexity`` every ``eval_steps`` optimizer steps and at the end of training.
+
+    Reports are printed and appended to ``validation_log.jsonl`` in the
+    trainer's output directory.
+    """
+
+    def __init__(self, examples, pad_token_id, eval_steps=20, max_batch_tokens=16384, time_budget=None):
+        self.examples = examples
+        self.pad_token_id = pad_token_id
+        self.eval_steps = eval_steps
+        self.max_batch_tokens = max_batch_tokens
+        self.time_budget = time_budget
+        self.last_step = None
+
+    def run(self, args, state, model):
+        report = evaluate_perplexity(model, self.examples, self.pad_token_id,
+                                     self.max_batch_tokens, self.time_budget)
+        print_report(report, state.global_step)
+        self.last_step = state.global_step
+
+        if state.is_world_process_zero:
+            Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+            with open(Path(args.output_dir) / "validation_log.jsonl", 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"step": state.global_step, **report}) + '\n')
+        return report
+
+    def on_step_end(self, args, state, control, model=None, **kwargs):
+        if self.eval_steps and state.global_step % self.eval_steps == 0:
+            self.run(args, state, model)
+
+    def on_train_end(self, args, state, control, model=None, **kwargs):
+        if self.last_step != state.global_step:
+            self.run(args, state, model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched validation perplexity per example type")
+    parser.add_argument("--dataset", default="dataset/validation_enhanced.jsonl")
+    parser.add_argument("--model", default="tiny", help="'tiny' for a random CPU Llama, or a model/adapter path")
+    parser.add_argument("--max-seq-length", type=int, default=512)
+    parser.add_argument("--max-examples", type=int, default=None)
+    parser.add_argument("--token-budget", type=int, default=None)
+    parser.add_argument("--batch-tokens", type=int, default=16384)
+    parser.add_argument("--time-budget", type=float, default=None, help="Seconds per evaluation")
+    args = parser.parse_args()
+
+    if args.model == "tiny":
+        from tiny_models import build_tiny_model_and_tokenizer
+        model, tokenizer = build_tiny_model_and_tokenizer()
+    else:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        model = AutoModelForCausalLM.from_pretrained(args.model, device_map="auto")
+        tokenizer = AutoTokenizer.from_pretrained(args.model)
+
+    from datasets import Dataset
+    import importlib
+    fine_tuning = importlib.import_module("04_fine_tuning")
+    with open(args.dataset, 'r', encoding='utf-8') as f:
+        dataset = Dataset.from_list([json.loads(line) for line in f if line.strip()])
+    dataset = fine_tuning.format_dataset(dataset, tokenizer, num_proc=1)
+
+    examples = prepare_validation_examples(dataset, tokenizer, args.max_seq_length)
+    examples = select_examples(examples, args.max_examples, args.token_budget)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    report = evaluate_perplexity(model, examples, pad_token_id, args.batch_tokens, args.time_budget)
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()